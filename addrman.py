@@ -0,0 +1,281 @@
+'''
+A table of peer addresses learned from `addr` messages.
+
+Entries live in packed arrays rather than an object each: the 16 byte IP
+and 2 byte port of every address sit back to back in one bytearray (the
+same 18 bytes they take on the wire, which is also the dedup key), with
+their time, services, failed attempts and last attempt in parallel arrays.
+Tens of thousands of addresses cost a few MB.
+
+Every address belongs to the bucket of its network group (the /16 of an
+IPv4 address, the /32 of an IPv6 one). A group can only hold so many
+addresses, so a peer sending us addresses from the few networks it controls
+can't crowd out everybody else. Candidates are picked by choosing a group
+and then an address in it at random, with fresh addresses that haven't
+been failing more likely to be taken, which is O(1) on average. An address
+isn't handed out again until a backoff that doubles with every failure has
+passed since it was last tried.
+'''
+import ipaddress
+import random
+import struct
+import time
+from array import array
+
+from utils import read_varint
+
+# time, services, IP and port. The port is big endian unlike everything
+# else, but IP and port together are the key so they're kept as one field
+ADDR_ENTRY = struct.Struct('<IQ18s')
+KEY_SIZE = 18
+IPV4_PREFIX = bytes(10) + b'\xff\xff'
+ONIONCAT_PREFIX = bytes.fromhex('fd87d87eeb43')
+
+MAX_ADDR_PER_MESSAGE = 1000
+ADDRMAN_CAPACITY = 65536
+GROUP_CAPACITY = 256
+# how many entries are looked at to pick one to evict
+EVICTION_SAMPLES = 4
+# addresses not heard about in this long aren't worth keeping
+ADDR_HORIZON = 30 * 24 * 60 * 60
+# the chance of picking an address halves once it's this old ...
+ADDR_HALF_LIFE = 24 * 60 * 60
+# ... and shrinks by this much with every failed attempt
+ATTEMPT_PENALTY = 0.66
+MAX_ATTEMPTS_COUNTED = 8
+# an address isn't retried for RETRY_BACKOFF * 2 ** failed attempts seconds, at most RETRY_BACKOFF_MAX
+RETRY_BACKOFF = 60
+RETRY_BACKOFF_MAX = 4 * 60 * 60
+# how many addresses select() looks at before deciding they're all backing off
+SELECT_TRIES = 64
+
+
+def network_group(key):
+    '''The bucket an address goes in, its /16 for IPv4 and /32 otherwise'''
+    if key[:12] == IPV4_PREFIX:
+        return bytes(key[:14])
+    return bytes(key[:4])
+
+
+def routable(ip):
+    '''Whether a 16 byte IP is one we could connect to over the internet'''
+    if ip[:12] == IPV4_PREFIX:
+        a, b = ip[12], ip[13]
+        return not (a in (0, 10, 127) or a >= 224 or (a, b) == (192, 168) or (a, b) == (169, 254)
+                    or (a == 172 and 16 <= b < 32) or (a == 100 and 64 <= b < 128))
+    if ip[:6] == ONIONCAT_PREFIX:
+        return True
+    # unspecified and loopback, unique local (fc00::/7), link local (fe80::/10)
+    return not (ip[:15] == bytes(15) or ip[0] & 0xfe == 0xfc or (ip[0] == 0xfe and ip[1] & 0xc0 == 0x80))
+
+
+def address_key(host, port):
+    '''The 18 byte key of a "host", port pair'''
+    ip = ipaddress.ip_address(host)
+    packed = IPV4_PREFIX + ip.packed if ip.version == 4 else ip.packed
+    return packed + port.to_bytes(2, 'big')
+
+
+def key_address(key):
+    '''The ("host", port) of an 18 byte key'''
+    ip = bytes(key[:16])
+    host = str(ipaddress.IPv4Address(ip[12:])) if ip[:12] == IPV4_PREFIX else str(ipaddress.IPv6Address(ip))
+    return host, int.from_bytes(key[16:18], 'big')
+
+
+def read_addr(s):
+    '''Parses an `addr` payload into a list of (time, services, key)'''
+    count = read_varint(s)
+    if count > MAX_ADDR_PER_MESSAGE:
+        raise RuntimeError(f'addr message with {count} addresses')
+    data = s.read(count * ADDR_ENTRY.size)
+    if len(data) < count * ADDR_ENTRY.size:
+        raise RuntimeError('addr message is truncated')
+    return list(ADDR_ENTRY.iter_unpack(data))
+
+
+class AddrMan:
+
+    def __init__(self, capacity=ADDRMAN_CAPACITY, group_capacity=GROUP_CAPACITY, clock=time.time):
+        self.capacity = capacity
+        self.group_capacity = group_capacity
+        self.clock = clock
+        # slot i is keys[i * 18:(i + 1) * 18] and the i-th item of each array.
+        # Slots are kept dense, removing one moves the last into its place
+        self.keys = bytearray()
+        self.times = array('I')
+        self.services = array('Q')
+        self.attempts = array('B')
+        self.last_tries = array('I')
+        # where each slot is in its group's list of slots
+        self.group_positions = array('I')
+        # key -> slot
+        self.index = {}
+        # network group -> slots in it, and the groups in a list to pick from
+        self.groups = {}
+        self.group_keys = []
+        self.group_index = {}
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, address):
+        return address_key(*address) in self.index
+
+    def key(self, slot):
+        return bytes(self.keys[slot * KEY_SIZE:(slot + 1) * KEY_SIZE])
+
+    def add_message(self, s):
+        '''Takes in an `addr` payload, returns (addresses in it, new ones)'''
+        entries = read_addr(s)
+        return len(entries), self.add_entries(entries)
+
+    def add(self, host, port, services=0, timestamp=None):
+        if timestamp is None:
+            timestamp = self.clock()
+        return self.add_entries([(int(timestamp), services, address_key(host, port))])
+
+    def add_entries(self, entries):
+        '''Adds (time, services, key) entries, returns how many were new'''
+        now = int(self.clock())
+        index = self.index
+        times = self.times
+        added = 0
+        for timestamp, services, key in entries:
+            if key[16:] == b'\x00\x00' or not routable(key):
+                continue
+            if timestamp > now + 10 * 60:
+                # a time in the future is made up, treat it as old news
+                timestamp = now - 5 * 24 * 60 * 60
+            elif timestamp < now - ADDR_HORIZON:
+                continue
+            slot = index.get(key)
+            if slot is not None:
+                if timestamp > times[slot]:
+                    times[slot] = timestamp
+                self.services[slot] |= services
+                continue
+            group = network_group(key)
+            members = self.groups.get(group)
+            if members is not None and len(members) >= self.group_capacity:
+                # the group is full, only replace one of its worst
+                victim = self._worst(members, now)
+                if self.chance(victim, now) >= self._chance(timestamp, 0, now):
+                    continue
+                self.remove_slot(victim)
+            elif len(times) >= self.capacity:
+                self.remove_slot(self._worst(range(len(times)), now))
+            self._insert(key, group, timestamp, services)
+            added += 1
+        return added
+
+    def _insert(self, key, group, timestamp, services):
+        slot = len(self.times)
+        self.keys += key
+        self.times.append(timestamp)
+        self.services.append(services)
+        self.attempts.append(0)
+        self.last_tries.append(0)
+        members = self.groups.get(group)
+        if members is None:
+            members = self.groups[group] = []
+            self.group_index[group] = len(self.group_keys)
+            self.group_keys.append(group)
+        self.group_positions.append(len(members))
+        members.append(slot)
+        self.index[key] = slot
+
+    def remove_slot(self, slot):
+        key = self.key(slot)
+        group = network_group(key)
+        members = self.groups[group]
+        moved = members.pop()
+        if moved != slot:
+            position = self.group_positions[slot]
+            members[position] = moved
+            self.group_positions[moved] = position
+        if not members:
+            del self.groups[group]
+            position = self.group_index.pop(group)
+            last_group = self.group_keys.pop()
+            if last_group != group:
+                self.group_keys[position] = last_group
+                self.group_index[last_group] = position
+        del self.index[key]
+
+        # move the last slot into the hole
+        last = len(self.times) - 1
+        if slot != last:
+            last_key = self.key(last)
+            self.keys[slot * KEY_SIZE:(slot + 1) * KEY_SIZE] = last_key
+            self.times[slot] = self.times[last]
+            self.services[slot] = self.services[last]
+            self.attempts[slot] = self.attempts[last]
+            self.last_tries[slot] = self.last_tries[last]
+            position = self.group_positions[slot] = self.group_positions[last]
+            self.groups[network_group(last_key)][position] = slot
+            self.index[last_key] = slot
+        del self.keys[last * KEY_SIZE:]
+        self.times.pop()
+        self.services.pop()
+        self.attempts.pop()
+        self.last_tries.pop()
+        self.group_positions.pop()
+
+    def _chance(self, timestamp, attempts, now):
+        age = max(0, now - timestamp)
+        return ATTEMPT_PENALTY ** min(attempts, MAX_ATTEMPTS_COUNTED) / (1 + age / ADDR_HALF_LIFE)
+
+    def chance(self, slot, now=None):
+        '''How likely the address in `slot` is to be picked, from 0 to 1'''
+        if now is None:
+            now = self.clock()
+        return self._chance(self.times[slot], self.attempts[slot], now)
+
+    def _worst(self, slots, now):
+        samples = [slots[random.randrange(len(slots))] for _ in range(EVICTION_SAMPLES)]
+        return min(samples, key=lambda slot: self.chance(slot, now))
+
+    def backing_off(self, slot, now):
+        '''Whether the address in `slot` was tried too recently to try again'''
+        backoff = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** min(self.attempts[slot], 16))
+        return now - self.last_tries[slot] < backoff
+
+    def select(self):
+        '''A ("host", port) to try connecting to, or None if there are none
+        that aren't backing off
+        '''
+        if not self.times:
+            return None
+        now = self.clock()
+        group_keys = self.group_keys
+        # every miss makes the next pick more likely to be accepted, so
+        # even a table of stale addresses returns after a few rounds
+        factor = 1.0
+        for _ in range(SELECT_TRIES):
+            members = self.groups[group_keys[random.randrange(len(group_keys))]]
+            slot = members[random.randrange(len(members))]
+            if self.backing_off(slot, now):
+                continue
+            if random.random() < factor * self.chance(slot, now):
+                return key_address(self.key(slot))
+            factor *= 1.2
+        return None
+
+    def attempt(self, host, port):
+        '''Records that we're trying to connect to an address'''
+        slot = self.index.get(address_key(host, port))
+        if slot is not None:
+            self.last_tries[slot] = int(self.clock())
+            if self.attempts[slot] < 255:
+                self.attempts[slot] += 1
+
+    def good(self, host, port):
+        '''Records that an address answered, it's fresh again'''
+        slot = self.index.get(address_key(host, port))
+        if slot is not None:
+            self.attempts[slot] = 0
+            self.times[slot] = int(self.clock())
+
+    def __repr__(self):
+        return f"<AddrMan {len(self)} addresses in {len(self.groups)} groups>"
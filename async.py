@@ -1,29 +1,178 @@
+import argparse
 import asyncio
+import hashlib
+import random
+import time
+from collections import deque
 
 from async_models import Message, NETWORK_MAGIC
-from utils import double_sha256, int_to_little_endian, little_endian_to_int
+from addrman import AddrMan
+from capture import CaptureWriter
+from metrics import Metrics, OTHER_COMMAND
+import profiling
+import events
+from utils import (
+    int_to_little_endian,
+    little_endian_to_int,
+    BufferReader,
+    finish_checksum,
+    MAX_PAYLOAD_SIZE,
+    PAYLOAD_CHUNK_SIZE,
+)
 
 
 VERSION = bytes.fromhex(
     "f9beb4d976657273696f6e0000000000650000005f1a69d2721101000100000000000000bc8f5e5400000000010000000000000000000000000000000000ffffc61b6409208d010000000000000000000000000000000000ffffcb0071c0208d128035cbc97953f80f2f5361746f7368693a302e392e332fcf05050001"
 )
 VERACK = bytes.fromhex("f9beb4d976657261636b000000000000000000005df6e0e2")
+GETADDR = bytes.fromhex("f9beb4d9676574616464720000000000000000005df6e0e2")
 
 first_host = "35.187.200.6"
 port = 8333
 
 last_host = "176.9.113.254"
 
+# how many peers we try to stay connected to
+TARGET_PEERS = 8
+# how many of those may be in the middle of connecting at once
+MAX_CONNECTING = 4
+CONNECT_TIMEOUT = 10
+# reconnect backoff, doubles with every failure in a row
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+# bytes queued for a peer past which we stop reading from it until it catches up ...
+OUTBOUND_HIGH_WATER = 1024 * 1024
+# ... and past which we give up on it
+OUTBOUND_MAX = 8 * 1024 * 1024
+# how long a peer over the high-water mark gets to catch up
+DRAIN_TIMEOUT = 30
+# commands that get their own metrics series and profiles, the rest are OTHER_COMMAND
+KNOWN_COMMANDS = {
+    b"version", b"verack", b"addr", b"inv", b"getdata", b"notfound", b"getblocks",
+    b"getheaders", b"tx", b"block", b"headers", b"getaddr", b"mempool", b"ping",
+    b"pong", b"reject", b"sendheaders", b"feefilter", b"sendcmpct", b"cmpctblock",
+    b"getblocktxn", b"blocktxn", b"wtxidrelay", b"sendaddrv2", b"addrv2",
+}
+# how often to look for addresses when there are no candidates
+CANDIDATE_POLL = 1
+
+# peers we've heard about through `addr`, connected to once the seeds run out
+addresses = AddrMan()
+
+
+class SlowPeerError(ConnectionError):
+    pass
+
+
+class PeerWriter:
+    '''The outbound side of a peer connection, in front of its StreamWriter.
+
+    Whatever is written during one tick of the event loop goes out as one
+    write. Once more than `high_water` bytes are waiting on the peer, drain()
+    blocks until it takes them in, and a peer that takes longer than
+    DRAIN_TIMEOUT, or lets more than `max_buffered` bytes pile up in the
+    meantime, is dropped.
+    '''
+
+    def __init__(self, writer, high_water=OUTBOUND_HIGH_WATER, max_buffered=OUTBOUND_MAX, metrics=None):
+        self.writer = writer
+        self.transport = writer.transport
+        self.high_water = high_water
+        self.max_buffered = max_buffered
+        self.metrics = metrics
+        # written but not handed to the transport yet
+        self.queue = []
+        self.queued = 0
+        self.flush_handle = None
+        self.dropped = False
+        # the StreamWriter's drain() waits once the transport holds this much
+        self.transport.set_write_buffer_limits(high=high_water)
+
+    def buffered(self):
+        return self.queued + self.transport.get_write_buffer_size()
+
+    def write(self, data):
+        if self.dropped:
+            return
+        self.queue.append(data)
+        self.queued += len(data)
+        if self.buffered() > self.max_buffered:
+            self.drop()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        '''Hands everything queued to the transport in one write'''
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if not self.queue:
+            return
+        data = self.queue[0] if len(self.queue) == 1 else b"".join(self.queue)
+        self.queue = []
+        self.queued = 0
+        self.writer.write(data)
+        if self.metrics is not None:
+            self.metrics.inc('bpw_outbound_writes_total')
+            self.metrics.inc('bpw_outbound_bytes_total', value=len(data))
+
+    async def drain(self):
+        self.flush()
+        if self.dropped:
+            raise SlowPeerError('dropped, too far behind on reading')
+        if self.transport.get_write_buffer_size() > self.high_water:
+            try:
+                await asyncio.wait_for(self.writer.drain(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.drop()
+                raise SlowPeerError(f'took over {DRAIN_TIMEOUT}s to read {self.buffered()} bytes')
 
-async def read_message(reader):
-    magic = await reader.read(4)
-    if magic != NETWORK_MAGIC:
+    def drop(self):
+        if self.dropped:
+            return
+        self.dropped = True
+        self.queue = []
+        self.queued = 0
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.transport.abort()
+        if self.metrics is not None:
+            self.metrics.inc('bpw_slow_peers_dropped_total')
+
+    def close(self):
+        if not self.dropped:
+            self.flush()
+        self.writer.close()
+
+
+async def read_message(reader, max_payload=MAX_PAYLOAD_SIZE, capture=None, peer='', metrics=None):
+    # readexactly, a short read would leave the stream in the middle of a frame
+    header = await reader.readexactly(24)
+    if header[:4] != NETWORK_MAGIC:
         raise RuntimeError("Network Magic not at beginning of stream")
-    command = await reader.read(12)
-    payload_length = little_endian_to_int(await reader.read(4))
-    checksum = await reader.read(4)
-    payload = await reader.read(payload_length)
-    if double_sha256(payload)[:4] != checksum:
+    command = header[4:16]
+    payload_length = little_endian_to_int(header[16:20])
+    checksum = header[20:24]
+    if payload_length > max_payload:
+        raise ConnectionError(f"Payload of {payload_length} bytes is over the {max_payload} byte limit")
+    # hash whatever has arrived each time we wake up, so a big block never
+    # holds up the other peers with one long hashing call at the end
+    payload = bytearray(payload_length)
+    sha = hashlib.sha256()
+    received = 0
+    while received < payload_length:
+        chunk = await reader.read(min(payload_length - received, PAYLOAD_CHUNK_SIZE))
+        if not chunk:
+            raise asyncio.IncompleteReadError(bytes(payload[:received]), payload_length)
+        sha.update(chunk)
+        payload[received:received + len(chunk)] = chunk
+        received += len(chunk)
+    if capture is not None:
+        capture.write(header + payload, peer)
+    if finish_checksum(sha) != checksum:
+        if metrics is not None:
+            metrics.inc('bpw_checksum_failures_total')
         raise RuntimeError("Payload and Checksum do not match")
     return Message(command, payload)
 
@@ -31,44 +180,197 @@ async def read_message(reader):
 async def handle_message(env, writer, host):
     if env.command.startswith(b"version"):
         writer.write(VERACK)
+        writer.write(GETADDR)
         return f"({host}) sent verack"
     if env.command.startswith(b"verack"):
         return f"({host}) received verack"
     if env.command.startswith(b"addr"):
-        return env.payload
+        received, added = addresses.add_message(BufferReader(env.payload))
+        return f"({host}) sent {received} addresses, {added} new, {len(addresses)} known"
     else:
         command = env.command.replace(b"\x00", b"")
         return f"received {command} from {host}"
 
 
-async def connect(host, port, bootstrap=False):
-    reader, writer = await asyncio.open_connection(host, port)
-    print(f"({host}) connected")
-    writer.write(VERSION)
-    env = await read_message(reader)
-    print(f"({host}) {env}")
-    response = await handle_message(env, writer, host)
-    print(f"({host}) {response}")
+async def dispatch(dispatcher, envelope, writer, host, metrics=None, profiler=None):
+    command = envelope.command.rstrip(b"\x00")
+    if command not in KNOWN_COMMANDS:
+        command = OTHER_COMMAND
+    if metrics is not None:
+        metrics.message(command, host, len(envelope.payload))
+    start = time.perf_counter()
+    if profiler is None:
+        msg = await dispatcher(envelope, writer, host)
+    else:
+        msg = await profiler.call_async(command, dispatcher, envelope, writer, host)
+    if metrics is not None:
+        metrics.observe('bpw_handler_seconds', (('command', command),), time.perf_counter() - start)
+    return msg
+
+
+async def loop(host, port, reader, writer, dispatcher=handle_message, capture=None, metrics=None,
+               profiler=None):
+    # read messages from this peer until it goes away
+    while True:
+        envelope = await read_message(reader, capture=capture, peer=host, metrics=metrics)
+        events.info('handled', peer=host, result=await dispatch(dispatcher, envelope, writer, host, metrics, profiler))
+        # stop reading from a peer that isn't reading what we send it
+        await writer.drain()
+
+
+class PeerManager:
+    '''Keeps `target` peers connected, each with its own read loop.
+
+    Peers that drop or fail to connect go back in the queue of candidates
+    after an exponential backoff. Once that queue is empty, candidates come
+    from `addrman`, which keeps track of their failures itself. Every peer
+    shares one `dispatcher`.
+    '''
+
+    def __init__(self, hosts, port=port, target=TARGET_PEERS, max_connecting=MAX_CONNECTING,
+                 dispatcher=handle_message, capture=None, metrics=None, profiler=None, addrman=None):
+        self.port = port
+        self.target = target
+        self.max_connecting = max_connecting
+        self.dispatcher = dispatcher
+        # a capture.CaptureWriter that every peer's messages are recorded to
+        self.capture = capture
+        # a metrics.Metrics that every peer's messages are counted in
+        self.metrics = metrics
+        # a profiling.Profiler that samples the dispatcher
+        self.profiler = profiler
+        # an addrman.AddrMan to pick ("host", port) candidates from
+        self.addrman = addrman
+        self.candidates = deque(hosts)
+        # host -> task running that peer
+        self.peers = {}
+        # peer -> PeerWriter of each connected one
+        self.writers = {}
+        # host -> failures in a row
+        self.failures = {}
+        if metrics is not None:
+            metrics.gauge('bpw_peers_connected', lambda: len(self.peers))
+            metrics.gauge('bpw_peer_candidates', lambda: len(self.candidates))
+            metrics.gauge('bpw_outbound_buffered_bytes',
+                          lambda: sum(writer.buffered() for writer in list(self.writers.values())))
+            if addrman is not None:
+                metrics.gauge('bpw_known_addresses', lambda: len(addrman))
+
+    async def run(self):
+        # the semaphores belong to the running event loop, so they're made here
+        self.slots = asyncio.Semaphore(self.target)
+        self.connecting = asyncio.Semaphore(self.max_connecting)
+        self.candidate_added = asyncio.Event()
+        try:
+            while True:
+                await self.slots.acquire()
+                host = await self.next_candidate()
+                self.peers[host] = asyncio.create_task(self.run_peer(host))
+        finally:
+            for task in list(self.peers.values()):
+                task.cancel()
+            await asyncio.gather(*self.peers.values(), return_exceptions=True)
+
+    def add_candidate(self, host):
+        if host not in self.peers and host not in self.candidates:
+            self.candidates.append(host)
+            self.candidate_added.set()
 
-    if bootstrap:
-        # create another task and add it to the loop
-        asyncio.ensure_future(connect(last_host, port))
+    def broadcast(self, data):
+        '''Queues a message for every connected peer'''
+        for writer in list(self.writers.values()):
+            writer.write(data)
 
-    await loop(host, port, reader, writer)
+    async def next_candidate(self):
+        while not self.candidates:
+            if self.addrman is not None and len(self.addrman) > len(self.peers):
+                # None when every address it looked at is backing off
+                candidate = self.addrman.select()
+                if candidate is not None and candidate not in self.peers:
+                    return candidate
+            self.candidate_added.clear()
+            waiter = asyncio.ensure_future(self.candidate_added.wait())
+            try:
+                # not wait_for, which can swallow a cancel that lands just as
+                # the event is set and leave run() going forever
+                await asyncio.wait((waiter,), timeout=CANDIDATE_POLL)
+            finally:
+                waiter.cancel()
+        return self.candidates.popleft()
 
+    async def run_peer(self, peer):
+        # the seeds are just a host, candidates from addrman come with their port
+        host, port = peer if isinstance(peer, tuple) else (peer, self.port)
+        writer = None
+        try:
+            async with self.connecting:
+                if self.addrman is not None:
+                    self.addrman.attempt(host, port)
+                reader, stream_writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), CONNECT_TIMEOUT)
+                writer = self.writers[peer] = PeerWriter(stream_writer, metrics=self.metrics)
+                events.info('connected', peer=host)
+                writer.write(VERSION)
+                env = await asyncio.wait_for(
+                    read_message(reader, capture=self.capture, peer=host, metrics=self.metrics),
+                    CONNECT_TIMEOUT)
+            # they answered our version, so this peer is good to go
+            self.failures.pop(peer, None)
+            if self.addrman is not None:
+                self.addrman.good(host, port)
+            events.info('handled', peer=host,
+                        result=await dispatch(self.dispatcher, env, writer, host, self.metrics, self.profiler))
+            await loop(host, port, reader, writer, self.dispatcher, self.capture, self.metrics,
+                       self.profiler)
+        except (OSError, RuntimeError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            events.info('disconnected', peer=host, error=repr(e))
+        finally:
+            if writer is not None:
+                writer.close()
+                del self.writers[peer]
+            del self.peers[peer]
+            self.slots.release()
+            if not isinstance(peer, tuple):
+                self.retry_later(peer)
 
-async def loop(host, port, reader, writer):
-    # recursively read the next message from this peer
-    envelope = await read_message(reader)
-    msg = await handle_message(envelope, writer, host)
-    print(msg)
-    await loop(host, port, reader, writer)
+    def retry_later(self, host):
+        failures = self.failures.get(host, 0)
+        self.failures[host] = failures + 1
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** failures)
+        # jitter so peers that dropped together don't all come back together
+        delay *= random.uniform(0.5, 1.5)
+        asyncio.get_running_loop().call_later(delay, self.add_candidate, host)
 
 
-async def main():
-    task = connect(first_host, port, bootstrap=True)
-    await asyncio.gather(task)
+async def main(capture_path=None, metrics_port=None, profile_dir=None):
+    capture = CaptureWriter(capture_path) if capture_path else None
+    profiler = profiling.Profiler(profile_dir) if profile_dir else profiling.from_env()
+    metrics = None
+    if metrics_port:
+        metrics = Metrics()
+        metrics.serve(metrics_port)
+    manager = PeerManager([first_host, last_host], port, capture=capture, metrics=metrics,
+                          profiler=profiler, addrman=addresses)
+    try:
+        await manager.run()
+    finally:
+        if capture is not None:
+            capture.close()
+        if metrics is not None:
+            metrics.close()
+        if profiler is not None:
+            profiler.close()
+        events.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capture', metavar='PATH', help='record every message received to PATH')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on localhost:PORT/metrics')
+    parser.add_argument('--profile', metavar='DIR', help='write sampled handler profiles to DIR')
+    parser.add_argument('--log-level', default='info', choices=events.LEVELS, help='drop events below this level')
+    parser.add_argument('--log-file', metavar='PATH', help='write events to PATH instead of stdout')
+    parser.add_argument('--log-json', action='store_true', help='write events as JSON lines')
+    args = parser.parse_args()
+    events.configure(args.log_level, args.log_file, args.log_json)
+    asyncio.run(main(args.capture, args.metrics_port, args.profile))
@@ -0,0 +1,366 @@
+'''
+Benchmarks for the codec hot paths in models.py and utils.py
+
+    python bench.py                 # run everything, compare with bench_baseline.json
+    python bench.py block headers   # only cases with one of these in their name
+    python bench.py --save          # store this run as the new baseline
+
+Each case reports operations/sec, MB/s, how many memory blocks the result of
+an operation keeps alive and its peak traced memory.
+
+Raw speed depends on the machine, so right after each case a fixed reference
+workload is timed too and the case is scored as its speed relative to that.
+The checked-in baseline holds those scores (the median of a few runs, a
+single run's can be off by 20% on a busy machine), and a case scoring more
+than `--tolerance` below its baseline makes the run exit non-zero.
+'''
+import argparse
+import gc
+import hashlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import fixtures
+from models import (
+    Message,
+    Headers,
+    Block,
+    BlockStream,
+    Tx,
+    GetData,
+    InventoryItem,
+    InventoryVector,
+    CmpctBlock,
+    frame_message,
+)
+from utils import (
+    read_varint,
+    BufferReader,
+)
+from merkle import merkle_root
+from inventory import InventoryFilter
+from mempool import Mempool
+from compact import PartialBlock, short_id, short_id_key
+from addrman import AddrMan
+from validation import (
+    check_block_payload,
+    check_blocks,
+    make_pool,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+MIN_TIME = 0.5
+REPEAT = 5
+TOLERANCE = 0.3
+
+# name -> setup(), which builds the fixture and returns (operation, bytes per operation),
+# optionally followed by a function that cleans up after the case
+BENCHMARKS = {}
+# cases whose score depends on more than the speed of one core, e.g. on the
+# number of cores, they're reported but never fail a run
+UNCOMPARED = set()
+
+
+def benchmark(name, compare=True):
+    def register(setup):
+        BENCHMARKS[name] = setup
+        if not compare:
+            UNCOMPARED.add(name)
+        return setup
+    return register
+
+
+def reference_op():
+    '''What every case is scored against: slicing, int decoding and sha256
+    over 80 byte records, the same kind of work but none of the code under test
+    '''
+    data = bytes(range(256)) * 320
+
+    def op():
+        total = 0
+        for start in range(0, len(data), 80):
+            record = data[start:start + 80]
+            total += int.from_bytes(record[68:72], 'little')
+            total ^= int.from_bytes(hashlib.sha256(record).digest()[:8], 'little')
+        return total
+    return op
+
+
+@benchmark('read_varint_10k')
+def bench_read_varint():
+    data = fixtures.make_varints(10000)
+
+    def op():
+        s = io.BytesIO(data)
+        for _ in range(10000):
+            read_varint(s)
+    return op, len(data)
+
+
+@benchmark('message_parse_inv')
+def bench_message_parse_inv():
+    data = fixtures.frame(b'inv', fixtures.make_inv_payload(10))
+    return (lambda: Message.parse(io.BytesIO(data))), len(data)
+
+
+@benchmark('message_serialize_inv')
+def bench_message_serialize_inv():
+    msg = Message(b'inv', fixtures.make_inv_payload(10))
+    return msg.serialize, len(msg.payload) + 24
+
+
+@benchmark('getdata_frame_50k')
+def bench_getdata_frame():
+    # a full getdata (50k items), serialized and framed in one go
+    items = [InventoryItem(2, n.to_bytes(32, 'little')) for n in range(50000)]
+    getdata = GetData(items=items)
+    return (lambda: frame_message(getdata)), len(frame_message(getdata))
+
+
+@benchmark('inventory_filter_inv_500')
+def bench_inventory_filter():
+    # an inv of 500 transactions we've already been told about
+    payload = fixtures.make_inv_payload(500)
+    known = InventoryFilter()
+    known.filter_new(InventoryVector.parse(io.BytesIO(payload)).items)
+    return (lambda: known.filter_new(InventoryVector.parse(io.BytesIO(payload)).items)), len(payload)
+
+
+@benchmark('addrman_add_addr_1000')
+def bench_addrman_add():
+    # an addr of 1000 addresses into a full table, mostly ones it already has
+    payload = fixtures.make_addr_payload(1000)
+    table = AddrMan(clock=lambda: 1700000000)
+    for seed in range(1, 70):
+        table.add_message(io.BytesIO(fixtures.make_addr_payload(1000, seed)))
+    return (lambda: table.add_message(io.BytesIO(payload))), len(payload)
+
+
+@benchmark('message_parse_block_4mb')
+def bench_message_parse_block():
+    data = fixtures.frame(b'block', fixtures.make_block(4_000_000))
+    return (lambda: Message.parse(io.BytesIO(data))), len(data)
+
+
+@benchmark('message_serialize_block_4mb')
+def bench_message_serialize_block():
+    msg = Message(b'block', fixtures.make_block(4_000_000))
+    return msg.serialize, len(msg.payload) + 24
+
+
+@benchmark('headers_parse_2000')
+def bench_headers_parse():
+    data = fixtures.make_headers_payload(2000)
+    return (lambda: Headers.parse(io.BytesIO(data))), len(data)
+
+
+@benchmark('tx_parse')
+def bench_tx_parse():
+    data = fixtures.make_block(1000)
+    # just past the header and a 1 byte txn_count
+    start = 81
+    return (lambda: Tx.parse(BufferReader(data, start))), len(data) - start
+
+
+@benchmark('block_parse_1mb')
+def bench_block_parse_1mb():
+    data = fixtures.make_block(1_000_000)
+    return (lambda: Block.parse(BufferReader(data))), len(data)
+
+
+@benchmark('block_parse_4mb')
+def bench_block_parse_4mb():
+    data = fixtures.make_block(4_000_000)
+    return (lambda: Block.parse(BufferReader(data))), len(data)
+
+
+@benchmark('block_parse_4mb_mempool_half')
+def bench_block_parse_4mb_mempool():
+    # half of the block's transactions were already relayed to us
+    data = fixtures.make_block(4_000_000)
+    mempool = Mempool()
+    for i, tx in enumerate(Block.parse(BufferReader(data)).txns):
+        if i % 2:
+            mempool.add(tx)
+    return (lambda: Block.parse(BufferReader(data), mempool=mempool)), len(data)
+
+
+@benchmark('compact_rebuild_4mb')
+def bench_compact_rebuild_4mb():
+    # a cmpctblock whose txns (all but the coinbase) are all in the mempool,
+    # short ids matched and the block payload put back together
+    data = fixtures.make_block(4_000_000)
+    txns = Block.parse(BufferReader(data)).txns
+    mempool = Mempool()
+    for tx in txns[1:]:
+        mempool.add(tx)
+    key = short_id_key(data[:80], 0)
+    cmpct = CmpctBlock(data[:80], 0, [short_id(key, tx.wtxid()) for tx in txns[1:]], [(0, txns[0])])
+
+    def op():
+        partial = PartialBlock(cmpct, mempool)
+        assert not partial.missing()
+        return partial.payload()
+    return op, len(cmpct.serialize())
+
+
+@benchmark('block_parse_4mb_lazy')
+def bench_block_parse_4mb_lazy():
+    data = fixtures.make_block(4_000_000)
+    return (lambda: Block.parse(BufferReader(data), lazy=True)), len(data)
+
+
+@benchmark('block_stream_4mb')
+def bench_block_stream_4mb():
+    data = fixtures.make_block(4_000_000)
+
+    def op():
+        for _ in BlockStream.parse(data):
+            pass
+    return op, len(data)
+
+
+@benchmark('merkle_root_4mb')
+def bench_merkle_root_4mb():
+    # just the tree, from txids that are already known
+    data = fixtures.make_block(4_000_000)
+    txids = Block.parse(BufferReader(data), lazy=True).txids()
+    return (lambda: merkle_root(txids)), len(data)
+
+
+@benchmark('block_check_merkle_4mb')
+def bench_block_check_merkle_4mb():
+    # parse, hash every tx and build the tree, one block at a time
+    data = fixtures.make_block(4_000_000)
+    assert check_block_payload(data)
+    return (lambda: check_block_payload(data)), len(data)
+
+
+@benchmark('block_check_merkle_4mb_x8_pool', compare=False)
+def bench_block_check_merkle_pool():
+    # 8 blocks per op across a process pool, blocks/s is 8x ops/s
+    blocks = [fixtures.make_block(4_000_000, seed=seed) for seed in range(8)]
+    pool = make_pool()
+    # start the workers before timing
+    check_blocks(blocks[:1], pool)
+    return (lambda: check_blocks(blocks, pool)), sum(len(block) for block in blocks), pool.shutdown
+
+
+def time_op(op, min_time, repeat=REPEAT):
+    '''Best ops/sec over `repeat` runs of at least `min_time` seconds each'''
+    best = 0
+    for _ in range(repeat):
+        iterations = 1
+        while True:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                op()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+            iterations *= 2
+        best = max(best, iterations / elapsed)
+    return best
+
+
+def measure_memory(op):
+    '''(memory blocks the result of `op` keeps alive, peak bytes traced while it runs)'''
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        result = op()
+        after = tracemalloc.take_snapshot()
+        kept = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+        del result
+        gc.collect()
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        op()
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return kept, peak
+
+
+def run(names, min_time):
+    results = {}
+    reference = reference_op()
+    for name in names:
+        op, nbytes, *cleanup = BENCHMARKS[name]()
+        try:
+            op()  # warm up
+            ops = 0
+            scores = []
+            for _ in range(REPEAT):
+                case_ops = time_op(op, min_time, 1)
+                # straight after, so both see the machine in the same state
+                scores.append(case_ops / time_op(reference, min_time, 1))
+                ops = max(ops, case_ops)
+            kept, peak = measure_memory(op)
+        finally:
+            for close in cleanup:
+                close()
+        results[name] = {
+            'ops_per_sec': ops,
+            'mb_per_sec': ops * nbytes / 1e6,
+            'score': statistics.median(scores),
+            'kept_blocks': kept,
+            'peak_kb': peak / 1024,
+        }
+        yield name, results[name]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the codec hot paths')
+    parser.add_argument('filters', nargs='*', help='only run cases whose name contains one of these')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help='how much slower than the baseline counts as a regression')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds per timing run')
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if not args.filters or any(f in name for f in args.filters)]
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save:
+        print(f"no baseline at {args.baseline}, run with --save to make one", file=sys.stderr)
+        return 1
+
+    print(f"{'case':<30} {'ops/s':>12} {'MB/s':>9} {'score':>9} {'kept blks':>10} {'peak KB':>10} {'vs base':>8}")
+    results = {}
+    regressions = []
+    for name, result in run(names, args.min_time):
+        results[name] = result
+        change = ''
+        if name in baseline:
+            ratio = result['score'] / baseline[name]['score']
+            change = f"{ratio - 1:+.0%}"
+            if ratio < 1 - args.tolerance and name not in UNCOMPARED:
+                regressions.append((name, ratio))
+        print(f"{name:<30} {result['ops_per_sec']:>12.1f} {result['mb_per_sec']:>9.1f} {result['score']:>9.4f} "
+              f"{result['kept_blocks']:>10} {result['peak_kb']:>10.1f} {change:>8}")
+
+    if args.save:
+        # only the scores carry over to another machine
+        baseline.update({name: {'score': result['score']} for name, result in results.items()})
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    for name, ratio in regressions:
+        print(f"REGRESSION: {name} scores {ratio:.0%} of its baseline", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,188 @@
+'''
+Record every framed message a node receives and play it back offline.
+
+    python node.py --capture traffic.bpwc      # record
+    python capture.py traffic.bpwc             # replay through node.handle_msg
+    python capture.py traffic.bpwc --async     # ... or through async.handle_message
+    python capture.py traffic.bpwc --speed 1   # at the recorded pace
+
+A capture is a file header followed by records. A record is a kind byte, a
+timestamp, a peer id and a length, followed by that many bytes. A PEER
+record's bytes name a peer ("host:port") the first time it shows up, and a
+MESSAGE record's bytes are a whole message as it came off the wire, header
+included.
+'''
+import argparse
+import asyncio
+import contextlib
+import importlib
+import os
+import struct
+import sys
+import time
+
+import events
+
+CAPTURE_MAGIC = b'BPWC'
+# 2 widened the peer id to 32 bits, a long running node sees more than 65535 peers
+CAPTURE_VERSION = 2
+FILE_HEADER = struct.Struct('<4sI')
+# kind, unix time, peer id, length of the bytes that follow
+RECORD = struct.Struct('<BdII')
+PEER = 0
+MESSAGE = 1
+
+
+class CaptureWriter:
+    '''Appends messages to a capture file'''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION))
+        # peer name -> id
+        self.peers = {}
+
+    def write(self, frame, peer='', timestamp=None):
+        '''Records one whole framed message (header + payload) from `peer`'''
+        if timestamp is None:
+            timestamp = time.time()
+        peer_id = self.peers.get(peer)
+        if peer_id is None:
+            peer_id = self.peers[peer] = len(self.peers)
+            name = peer.encode()
+            self.file.write(RECORD.pack(PEER, timestamp, peer_id, len(name)) + name)
+        self.file.write(RECORD.pack(MESSAGE, timestamp, peer_id, len(frame)))
+        self.file.write(frame)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_capture(path):
+    '''Yields (timestamp, peer, frame) for every message in a capture'''
+    with open(path, 'rb', buffering=1024 * 1024) as f:
+        header = f.read(FILE_HEADER.size)
+        if not header:
+            return
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        version = FILE_HEADER.unpack(header)[1]
+        if version != CAPTURE_VERSION:
+            raise ValueError(f'{path} is a version {version} capture, only version {CAPTURE_VERSION} can be read')
+        peers = {}
+        while True:
+            record = f.read(RECORD.size)
+            if len(record) < RECORD.size:
+                break
+            kind, timestamp, peer_id, length = RECORD.unpack(record)
+            body = f.read(length)
+            if len(body) < length:
+                # the recording was cut off halfway through a record
+                break
+            if kind == PEER:
+                peers[peer_id] = body.decode()
+            elif kind == MESSAGE:
+                yield timestamp, peers.get(peer_id, ''), body
+
+
+def replay(path, dispatch, speed=None):
+    '''Calls `dispatch(peer, frame)` for every message in the capture.
+
+    With `speed` the original gaps between messages are kept (divided by
+    `speed`), otherwise it goes as fast as it can.
+    Returns (messages, bytes, seconds).
+    '''
+    count = total = 0
+    start = time.perf_counter()
+    first = None
+    for timestamp, peer, frame in read_capture(path):
+        if speed:
+            if first is None:
+                first = timestamp
+            delay = (timestamp - first) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        dispatch(peer, frame)
+        count += 1
+        total += len(frame)
+    return count, total, time.perf_counter() - start
+
+
+class NullSocket:
+    '''Stands in for the peer's socket (or stream writer) when replaying, and
+    just counts what would have been sent back
+    '''
+
+    def __init__(self):
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+
+    send = write = sendall
+
+
+def node_dispatcher():
+    import node
+    from models import Message
+    from utils import BufferReader
+    sock = NullSocket()
+    # the handlers request blocks from whoever sent the headers
+    node.scheduler.add_peer(sock)
+
+    def dispatch(peer, frame):
+        try:
+            node.handle_msg(Message.parse(BufferReader(frame)), sock)
+        except (RuntimeError, ConnectionError) as e:
+            # a bad message doesn't stop the run, nor does a peer we'd hang up on
+            events.error('message_failed', error=e)
+    return dispatch
+
+
+def async_dispatcher():
+    peers = importlib.import_module('async')
+    writer = NullSocket()
+    loop = asyncio.new_event_loop()
+
+    def dispatch(peer, frame):
+        reader = asyncio.StreamReader(loop=loop)
+        reader.feed_data(frame)
+
+        async def handle():
+            env = await peers.read_message(reader)
+            return await peers.handle_message(env, writer, peer)
+        events.info('handled', peer=peer, result=loop.run_until_complete(handle()))
+    return dispatch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a capture through the message handlers')
+    parser.add_argument('path')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help="use async.py's dispatcher instead of node.handle_msg")
+    parser.add_argument('--speed', type=float, default=None,
+                        help='keep the recorded timing, sped up by this factor (default: as fast as possible)')
+    parser.add_argument('--verbose', action='store_true', help="show the handlers' output")
+    args = parser.parse_args(argv)
+
+    dispatch = async_dispatcher() if args.use_async else node_dispatcher()
+    with open(os.devnull, 'w') as devnull:
+        output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)
+        with output:
+            count, total, elapsed = replay(args.path, dispatch, args.speed)
+            # whatever the handlers emitted goes to the same place
+            events.flush()
+    print(f"{count} messages, {total / 1e6:.1f} MB in {elapsed:.2f}s: "
+          f"{count / elapsed:.0f} msgs/s {total / 1e6 / elapsed:.1f} MB/s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+from array import array
+
+from utils import (
+    little_endian_to_int,
+    int_to_little_endian,
+)
+
+HASH_SIZE = 32
+# the index is kept at most half full so probe sequences stay short,
+# the slot count must be a power of two
+MIN_INDEX_SLOTS = 1024
+
+
+class HeaderChain:
+    '''The best header chain, as a list of block hashes ordered by height.
+
+    Hashes are stored packed as 32-byte little endian records in one bytearray
+    (instead of a ~60 byte Python int each) and an open addressing table maps
+    hash -> height, so lookups and `in` checks don't scan the chain.
+
+    Like the old `blocks` list, hashes go in and come out as ints.
+    '''
+
+    def __init__(self, genesis):
+        self.records = bytearray()
+        # slot -> height + 1, 0 means the slot is empty
+        self.index = array('i', bytes(4 * MIN_INDEX_SLOTS))
+        # heights below this are in the index, the rest are added on the next lookup
+        self.indexed = 0
+        self.append(genesis)
+
+    def __len__(self):
+        return len(self.records) // HASH_SIZE
+
+    def _record(self, height):
+        start = height * HASH_SIZE
+        return self.records[start:start + HASH_SIZE]
+
+    def __getitem__(self, height):
+        if isinstance(height, slice):
+            return [self[h] for h in range(*height.indices(len(self)))]
+        if height < 0:
+            height += len(self)
+        if not 0 <= height < len(self):
+            raise IndexError('height out of range')
+        return little_endian_to_int(self._record(height))
+
+    def __iter__(self):
+        for height in range(len(self)):
+            yield self[height]
+
+    def __contains__(self, hash_):
+        return self.height_of(hash_) is not None
+
+    @property
+    def tip(self):
+        return self[-1]
+
+    def _slot(self, record):
+        # block hashes are uniformly distributed, so their low bytes make a good
+        # hash. (the high bytes are the proof-of-work zeros)
+        return little_endian_to_int(record[:8]) & (len(self.index) - 1)
+
+    def _probe(self, record):
+        mask = len(self.index) - 1
+        slot = self._slot(record)
+        while True:
+            entry = self.index[slot]
+            if not entry:
+                return slot, None
+            if self._record(entry - 1) == record:
+                return slot, entry - 1
+            slot = (slot + 1) & mask
+
+    def _find(self, record):
+        '''Returns (slot, height) for `record`, or (first empty slot, None)'''
+        self._catch_up()
+        return self._probe(record)
+
+    def _catch_up(self):
+        # hashes appended in bulk are only indexed once something is looked up
+        if self.indexed == len(self):
+            return
+        if 2 * len(self) > len(self.index):
+            slots = len(self.index)
+            while 2 * len(self) > slots:
+                slots *= 2
+            self.index = array('i', bytes(4 * slots))
+            self.indexed = 0
+        for height in range(self.indexed, len(self)):
+            slot, _ = self._probe(self._record(height))
+            self.index[slot] = height + 1
+        self.indexed = len(self)
+
+    def height_of(self, hash_):
+        '''Returns the height of `hash_` in the chain, or None'''
+        _, height = self._find(int_to_little_endian(hash_, HASH_SIZE))
+        return height
+
+    def append(self, hash_):
+        record = int_to_little_endian(hash_, HASH_SIZE)
+        _, height = self._find(record)
+        if height is not None:
+            raise ValueError(f'{hash_:064x} is already in the chain at height {height}')
+        self.records += record
+
+    def extend_packed(self, records):
+        '''Appends hashes given as packed 32-byte little endian records.
+
+        The caller vouches that they link up, so there's no duplicate check and
+        indexing them is put off until the first lookup.
+        '''
+        if len(records) % HASH_SIZE:
+            raise ValueError('hash records must be 32 bytes each')
+        self.records += records
+
+    def truncate(self, height):
+        '''Drops every hash at `height` and above'''
+        if height < len(self):
+            del self.records[height * HASH_SIZE:]
+            # removing keys from a linear probing table needs tombstones, reorgs
+            # are rare enough that rebuilding is simpler
+            self.index = array('i', bytes(len(self.index) * 4))
+            self.indexed = 0
+
+    def connect(self, prev_hash, hashes):
+        '''Connects a run of consecutive hashes whose first entry builds on `prev_hash`.
+
+        Hashes we already have are skipped. If the run forks off below the tip
+        it only replaces our branch when that makes the chain longer.
+        Returns how many hashes were added.
+        '''
+        # the common case while syncing, no lookup needed
+        if prev_hash == self.tip:
+            height = len(self) - 1
+        else:
+            height = self.height_of(prev_hash)
+            if height is None:
+                return 0
+        height += 1
+        hashes = list(hashes)
+        # skip the part of the run that's already on our chain
+        skip = 0
+        while skip < len(hashes) and height + skip < len(self) and self[height + skip] == hashes[skip]:
+            skip += 1
+        height += skip
+        hashes = hashes[skip:]
+        if not hashes:
+            return 0
+        if height < len(self):
+            if height + len(hashes) <= len(self):
+                # a competing branch that isn't longer than ours
+                return 0
+            self.truncate(height)
+        # a linked run can't repeat a hash that's already on the chain
+        self.extend_packed(b''.join(int_to_little_endian(hash_, HASH_SIZE) for hash_ in hashes))
+        return len(hashes)
+
+    def __repr__(self):
+        return f"<HeaderChain height={len(self) - 1} tip={self.tip:064x}>"
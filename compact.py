@@ -0,0 +1,129 @@
+import hashlib
+import struct
+
+from utils import (
+    encode_varint,
+    siphash24,
+    siphash24_hashes,
+)
+
+# the 6 low bytes of the siphash
+SHORT_ID_MASK = 0xffffffffffff
+SIPHASH_KEY = struct.Struct('<QQ')
+# mempools bigger than this get their short ids worked out in chunks across
+# the process pool, a pure python siphash is ~15us a transaction
+MATCH_CHUNK_SIZE = 5000
+
+
+def short_id_key(header, nonce):
+    '''The (k0, k1) siphash key of a compact block: the first 16 bytes of
+    sha256(header || nonce)
+    '''
+    return SIPHASH_KEY.unpack_from(hashlib.sha256(header + nonce.to_bytes(8, 'little')).digest())
+
+
+def short_id(key, hash_):
+    '''Short id of a transaction from its wtxid (or txid for version 1), internal byte order'''
+    return siphash24(key[0], key[1], hash_) & SHORT_ID_MASK
+
+
+def short_ids(key, hashes):
+    '''short_id of every hash in a list, a plain function so it can run in a worker'''
+    return [id_ & SHORT_ID_MASK for id_ in siphash24_hashes(key[0], key[1], hashes)]
+
+
+def iter_short_ids(key, hashes, pool=None, chunk_size=MATCH_CHUNK_SIZE):
+    '''Yields the short id of each hash in order, computed as they're asked
+    for, or a chunk at a time on `pool` when there are enough of them. Chunks
+    that haven't started yet are cancelled once the generator is closed.
+    '''
+    if pool is None or len(hashes) <= chunk_size:
+        for id_ in siphash24_hashes(key[0], key[1], hashes):
+            yield id_ & SHORT_ID_MASK
+        return
+    futures = [pool.submit(short_ids, key, hashes[start:start + chunk_size])
+               for start in range(0, len(hashes), chunk_size)]
+    try:
+        for future in futures:
+            yield from future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+class PartialBlock:
+    '''A block being rebuilt from a cmpctblock.
+
+    Prefilled transactions go in as they are and every short id is matched
+    against the mempool, on `pool` if it's big; whatever's left has to be
+    asked for with getblocktxn and handed to `fill`. Transactions are kept as
+    raw bytes so the finished block is just their concatenation behind the
+    header.
+    '''
+
+    def __init__(self, cmpct, mempool=None, version=2, pool=None):
+        self.header = cmpct.header
+        self.block_hash = cmpct.pow()
+        count = len(cmpct.short_ids) + len(cmpct.prefilled)
+        self.txns = [None] * count
+        for index, tx in cmpct.prefilled:
+            if index >= count:
+                raise RuntimeError('prefilled index out of range')
+            self.txns[index] = tx.serialize()
+        # the short ids fill the gaps between the prefilled txns, in order
+        self.slots = {}
+        self.collided = False
+        gaps = (i for i, raw in enumerate(self.txns) if raw is None)
+        for index, id_ in zip(gaps, cmpct.short_ids):
+            if id_ in self.slots:
+                # two txns in one block with the same short id, it can't be rebuilt
+                self.collided = True
+            self.slots[id_] = index
+        if mempool is not None and self.slots and not self.collided:
+            self.match(mempool, short_id_key(cmpct.header, cmpct.nonce), version, pool)
+
+    def match(self, mempool, key, version, pool=None):
+        # the hashes are cached on each Tx, it's the short ids that cost. Like
+        # Core we stop as soon as every short id has a txn, and a short id two
+        # mempool txns share is left for getblocktxn
+        entries = list(mempool.transactions())
+        hashes = [tx.wtxid() if version == 2 else tx.txid() for _, tx in entries]
+        ids = iter_short_ids(key, hashes, pool)
+        seen = set()
+        found = 0
+        try:
+            for (raw, _), id_ in zip(entries, ids):
+                index = self.slots.get(id_)
+                if index is None:
+                    continue
+                if id_ in seen:
+                    if self.txns[index] is not None:
+                        self.txns[index] = None
+                        found -= 1
+                    continue
+                seen.add(id_)
+                self.txns[index] = raw
+                found += 1
+                if found == len(self.slots):
+                    break
+        finally:
+            ids.close()
+
+    def missing(self):
+        '''Indexes of the transactions we still need'''
+        return [i for i, raw in enumerate(self.txns) if raw is None]
+
+    def fill(self, txns):
+        '''Fills the missing transactions, in order, from a blocktxn'''
+        missing = self.missing()
+        if len(txns) != len(missing):
+            raise RuntimeError(f'expected {len(missing)} txns, got {len(txns)}')
+        for index, tx in zip(missing, txns):
+            self.txns[index] = tx.serialize()
+
+    def payload(self):
+        '''The rebuilt block as a `block` payload'''
+        return b''.join([self.header, encode_varint(len(self.txns))] + self.txns)
+
+    def __repr__(self):
+        return f"<PartialBlock {len(self.txns)} txns {len(self.missing())} missing>"
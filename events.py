@@ -0,0 +1,170 @@
+'''
+A non-blocking sink for what the node has to say.
+
+    events.info('block_received', hash=..., txns=...)
+    events.debug('tx', tx=tx)    # the repr is only built if DEBUG is on
+
+Events below the sink's level are dropped before anything is formatted. The
+rest go in a bounded queue that a background thread drains every
+`flush_interval` seconds, formatting a whole batch and writing it with one
+call, as text lines or JSON lines, to stdout or a file. If the queue is full
+the event is dropped and counted rather than making the caller wait.
+'''
+import atexit
+import json
+import sys
+import threading
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {level: name.upper() for name, level in LEVELS.items()}
+
+EVENT_QUEUE_SIZE = 10000
+FLUSH_INTERVAL = 0.1
+
+
+def format_text(timestamp, level, event, fields):
+    stamp = time.strftime('%H:%M:%S', time.localtime(timestamp)) + f'.{int(timestamp * 1000) % 1000:03d}'
+    parts = [stamp, LEVEL_NAMES.get(level, str(level)), event]
+    parts += [f'{key}={value}' for key, value in fields.items()]
+    return ' '.join(parts) + '\n'
+
+
+def format_json(timestamp, level, event, fields):
+    record = {'time': timestamp, 'level': LEVEL_NAMES.get(level, level), 'event': event}
+    record.update(fields)
+    return json.dumps(record, default=str) + '\n'
+
+
+class EventSink:
+
+    def __init__(self, level=INFO, path=None, json_lines=False, queue_size=EVENT_QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL):
+        self.level = level
+        self.path = path
+        self.format = format_json if json_lines else format_text
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.queue = deque()
+        self.dropped = 0
+        self.file = None
+        self.thread = None
+        self.closed = threading.Event()
+        # only one drain writes at a time, the thread's or a flush()
+        self.write_lock = threading.Lock()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def emit(self, level, event, **fields):
+        if level < self.level:
+            return
+        if len(self.queue) >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append((time.time(), level, event, fields))
+        if self.thread is None:
+            self.start()
+
+    def debug(self, event, **fields):
+        self.emit(DEBUG, event, **fields)
+
+    def info(self, event, **fields):
+        self.emit(INFO, event, **fields)
+
+    def warning(self, event, **fields):
+        self.emit(WARNING, event, **fields)
+
+    def error(self, event, **fields):
+        self.emit(ERROR, event, **fields)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.closed.clear()
+        self.thread = threading.Thread(target=self._run, name='events', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self.closed.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''Formats and writes everything queued so far'''
+        with self.write_lock:
+            batch = []
+            queue = self.queue
+            while queue:
+                batch.append(self.format(*queue.popleft()))
+            if self.dropped:
+                batch.append(self.format(time.time(), WARNING, 'events_dropped', {'count': self.dropped}))
+                self.dropped = 0
+            if not batch:
+                return
+            if self.path is not None:
+                if self.file is None:
+                    self.file = open(self.path, 'a')
+                out = self.file
+            else:
+                # looked up every time so redirect_stdout works
+                out = sys.stdout
+            out.write(''.join(batch))
+            out.flush()
+
+    def close(self):
+        if self.thread is not None:
+            self.closed.set()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# the sink the module level functions write to
+sink = EventSink()
+
+
+def configure(level=INFO, path=None, json_lines=False, **kwargs):
+    '''Replaces the default sink, `level` can be a name like "debug"'''
+    global sink
+    sink.close()
+    if isinstance(level, str):
+        level = LEVELS[level.lower()]
+    sink = EventSink(level, path, json_lines, **kwargs)
+    return sink
+
+
+def enabled(level):
+    return sink.enabled(level)
+
+
+def debug(event, **fields):
+    sink.emit(DEBUG, event, **fields)
+
+
+def info(event, **fields):
+    sink.emit(INFO, event, **fields)
+
+
+def warning(event, **fields):
+    sink.emit(WARNING, event, **fields)
+
+
+def error(event, **fields):
+    sink.emit(ERROR, event, **fields)
+
+
+def flush():
+    sink.flush()
+
+
+def close():
+    sink.close()
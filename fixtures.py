@@ -0,0 +1,98 @@
+'''
+Deterministic synthetic wire data for benchmarks and tests.
+
+Everything is generated from a seeded random.Random so the same call always
+returns the same bytes.
+'''
+import random
+
+from utils import (
+    int_to_little_endian,
+    encode_varint,
+    encode_varstr,
+    double_sha256,
+)
+from models import Message
+from merkle import merkle_root
+
+
+def make_tx(rng, num_inputs=2, num_outputs=2):
+    '''A legacy (non-segwit) transaction with P2PKH-sized scripts'''
+    tx = int_to_little_endian(1, 4)
+    tx += encode_varint(num_inputs)
+    for _ in range(num_inputs):
+        tx += rng.randbytes(32) + int_to_little_endian(rng.randrange(4), 4)
+        # ~ a signature and a compressed pubkey
+        tx += encode_varstr(rng.randbytes(106))
+        tx += b'\xff\xff\xff\xff'
+    tx += encode_varint(num_outputs)
+    for _ in range(num_outputs):
+        tx += int_to_little_endian(rng.randrange(10**8), 8)
+        tx += encode_varstr(b'\x76\xa9\x14' + rng.randbytes(20) + b'\x88\xac')
+    tx += int_to_little_endian(0, 4)
+    return tx
+
+
+def make_header(rng, prev_block=None):
+    header = int_to_little_endian(0x20000000, 4)
+    header += prev_block if prev_block is not None else rng.randbytes(32)
+    # merkle root
+    header += rng.randbytes(32)
+    header += int_to_little_endian(1500000000 + rng.randrange(10**8), 4)
+    header += bytes.fromhex('17053894')
+    header += rng.randbytes(4)
+    return header
+
+
+def make_block(size=1_000_000, seed=0):
+    '''A block payload of just under `size` bytes made of 1-3 in/out
+    transactions, with a merkle root that matches them
+    '''
+    rng = random.Random(seed)
+    txns = []
+    # the header and a 5 byte tx count, a block is never over MAX_PAYLOAD_SIZE
+    total = 85
+    while True:
+        tx = make_tx(rng, rng.randint(1, 3), rng.randint(1, 3))
+        if total + len(tx) > size:
+            break
+        txns.append(tx)
+        total += len(tx)
+    root, _ = merkle_root(b''.join(double_sha256(tx) for tx in txns))
+    header = make_header(rng)
+    header = header[:36] + root + header[68:]
+    return header + encode_varint(len(txns)) + b''.join(txns)
+
+
+def make_headers_payload(count=2000, seed=0):
+    rng = random.Random(seed)
+    return encode_varint(count) + b''.join(make_header(rng) + b'\x00' for _ in range(count))
+
+
+def make_inv_payload(count=10, seed=0):
+    rng = random.Random(seed)
+    items = b''.join(int_to_little_endian(1, 4) + rng.randbytes(32) for _ in range(count))
+    return encode_varint(count) + items
+
+
+def make_addr_payload(count=1000, seed=0, timestamp=1700000000):
+    '''An `addr` of `count` random public IPv4 addresses'''
+    rng = random.Random(seed)
+    entries = b''.join(
+        int_to_little_endian(timestamp - rng.randrange(86400), 4) + int_to_little_endian(1, 8)
+        + bytes(10) + b'\xff\xff' + bytes([rng.randrange(1, 224)]) + rng.randbytes(3) + (8333).to_bytes(2, 'big')
+        for _ in range(count))
+    return encode_varint(count) + entries
+
+
+def make_varints(count=10000, seed=0):
+    '''A mix of every varint width, weighted like real traffic (mostly 1 byte)'''
+    rng = random.Random(seed)
+    widths = [0xfc, 0xffff, 0xffffffff, 0xffffffffffffffff]
+    return b''.join(encode_varint(rng.randint(0, rng.choices(widths, [80, 15, 4, 1])[0]))
+                    for _ in range(count))
+
+
+def frame(command, payload):
+    '''A whole message on the wire: header plus payload'''
+    return Message(command, payload).serialize()
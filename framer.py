@@ -0,0 +1,115 @@
+import hashlib
+
+from utils import (
+    little_endian_to_int,
+    parse_command,
+    finish_checksum,
+    MAX_PAYLOAD_SIZE,
+)
+
+from models import (
+    Message,
+    NETWORK_MAGIC,
+)
+
+# magic (4) + command (12) + payload length (4) + checksum (4)
+HEADER_SIZE = 24
+BUFFER_SIZE = 256 * 1024
+
+
+class MessageFramer:
+    '''Reads whole messages off a socket through one growable receive buffer.
+
+    Bytes are pulled in with `recv_into` in chunks as large as the free space
+    in the buffer, so a multi-MB block costs a handful of syscalls. The payload
+    of each returned Message is a memoryview into the receive buffer.
+    '''
+
+    def __init__(self, sock, buffer_size=BUFFER_SIZE, max_payload=MAX_PAYLOAD_SIZE, capture=None, metrics=None):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.max_payload = max_payload
+        # a metrics.Metrics that checksum failures are counted in
+        self.metrics = metrics
+        # a capture.CaptureWriter every message read is recorded to
+        self.capture = capture
+        self.peer = ''
+        if capture is not None:
+            try:
+                self.peer = '%s:%s' % sock.getpeername()[:2]
+            except (OSError, TypeError):
+                pass
+        self.buf = bytearray(buffer_size)
+        # self.buf[start:end] has been received but not handed out yet
+        self.start = 0
+        self.end = 0
+
+    def _grow(self, needed):
+        # Messages that were already handed out still point into the current
+        # buffer, so rather than compacting in place we move the unread bytes
+        # into a fresh buffer and let the old one go once nobody references it
+        unread = self.end - self.start
+        buf = bytearray(max(self.buffer_size, needed))
+        buf[:unread] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.start = 0
+        self.end = unread
+
+    def _fill(self, needed, sha=None):
+        '''Blocks until at least `needed` unread bytes are buffered.
+
+        With `sha`, the bytes past the message header up to `needed` are fed
+        to it as they arrive.
+        '''
+        if len(self.buf) - self.start < needed:
+            self._grow(needed)
+        # offsets from self.start, which stays put from here on
+        hashed = HEADER_SIZE
+        while True:
+            if sha is not None:
+                available = min(self.end - self.start, needed)
+                if available > hashed:
+                    with memoryview(self.buf) as view:
+                        sha.update(view[self.start + hashed:self.start + available])
+                    hashed = available
+            if self.end - self.start >= needed:
+                break
+            with memoryview(self.buf) as view:
+                n = self.sock.recv_into(view[self.end:])
+            if not n:
+                raise ConnectionError('peer closed the connection')
+            self.end += n
+
+    def read_message(self):
+        self._fill(HEADER_SIZE)
+        header = bytes(self.buf[self.start:self.start + HEADER_SIZE])
+        if header[:4] != NETWORK_MAGIC:
+            raise ValueError('magic is not right')
+
+        command = parse_command(header[4:16])
+        payload_length = little_endian_to_int(header[16:20])
+        checksum = header[20:24]
+        if payload_length > self.max_payload:
+            raise ConnectionError(f'payload of {payload_length} bytes is over the {self.max_payload} byte limit')
+
+        # the payload is hashed as it comes in, not all at once at the end
+        sha = hashlib.sha256()
+        self._fill(HEADER_SIZE + payload_length, sha)
+        payload_start = self.start + HEADER_SIZE
+        payload = memoryview(self.buf)[payload_start:payload_start + payload_length]
+        self.start = payload_start + payload_length
+
+        if self.capture is not None:
+            with memoryview(self.buf) as view:
+                self.capture.write(view[payload_start - HEADER_SIZE:self.start], self.peer)
+
+        if finish_checksum(sha) != checksum:
+            if self.metrics is not None:
+                self.metrics.inc('bpw_checksum_failures_total')
+            raise RuntimeError('checksum does not match')
+
+        return Message(command, payload)
+
+    def __iter__(self):
+        while True:
+            yield self.read_message()
@@ -0,0 +1,140 @@
+import mmap
+import os
+import struct
+import zlib
+
+from utils import (
+    little_endian_to_int,
+    int_to_little_endian,
+    double_sha256,
+)
+
+HEADER_SIZE = 80
+STORE_MAGIC = b'BPWH'
+STORE_VERSION = 1
+# magic, version, record count, tip hash, crc32 of the fields before it
+TRAILER = struct.Struct('<4sII32sI')
+
+
+class HeaderStore:
+    '''Append-only file of 80-byte block headers, read through mmap.
+
+    The file is the raw header records back to back followed by a small
+    trailer with the record count and the hash of the last header. Appending
+    writes the new records over the old trailer and puts a new one after them,
+    so the existing records are never rewritten.
+
+    Record `i` is the header at height `i + 1` of the HeaderChain, the chain's
+    starting hash itself has no record.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self.file = open(path, 'r+b')
+        self.map = None
+        self.count = 0
+        self.tip_hash = None
+        self._load()
+
+    def _remap(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.map = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _load(self):
+        self._remap()
+        size = len(self.map) if self.map is not None else 0
+        if size >= TRAILER.size:
+            magic, version, count, tip_hash, crc = TRAILER.unpack_from(self.map, size - TRAILER.size)
+            if (magic == STORE_MAGIC and version == STORE_VERSION
+                    and crc == zlib.crc32(self.map[size - TRAILER.size:size - 4])
+                    and size == count * HEADER_SIZE + TRAILER.size):
+                self.count = count
+                self.tip_hash = little_endian_to_int(tip_hash) if count else None
+                return
+        # no valid trailer, we must have died halfway through an append.
+        # keep every whole record that still links to the one before it.
+        count = size // HEADER_SIZE
+        while count > 1 and self._record(count - 1)[4:36] != double_sha256(self._record(count - 2)):
+            count -= 1
+        self._reset(count)
+
+    def _record(self, i):
+        start = i * HEADER_SIZE
+        return self.map[start:start + HEADER_SIZE]
+
+    def _write_trailer(self):
+        tip_hash = int_to_little_endian(self.tip_hash or 0, 32)
+        trailer = TRAILER.pack(STORE_MAGIC, STORE_VERSION, self.count, tip_hash, 0)
+        trailer = trailer[:-4] + struct.pack('<I', zlib.crc32(trailer[:-4]))
+        self.file.write(trailer)
+        self.file.truncate()
+        self.file.flush()
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('record out of range')
+        return self._record(i)
+
+    def append(self, records, tip_hash=None):
+        '''Appends a run of 80-byte header records. `tip_hash` is the hash of
+        the last one, it's computed if not given.
+        '''
+        if not records:
+            return
+        if len(records) % HEADER_SIZE:
+            raise ValueError('header records must be 80 bytes each')
+        if tip_hash is None:
+            tip_hash = little_endian_to_int(double_sha256(records[-HEADER_SIZE:]))
+        self.file.seek(self.count * HEADER_SIZE)
+        self.file.write(records)
+        # the records have to be on disk before a trailer that counts them
+        self.file.flush()
+        self.count += len(records) // HEADER_SIZE
+        self.tip_hash = tip_hash
+        self._write_trailer()
+        self._remap()
+
+    def truncate(self, count):
+        '''Keeps only the first `count` records'''
+        if count < self.count:
+            self._reset(count)
+
+    def _reset(self, count):
+        self.tip_hash = little_endian_to_int(double_sha256(self._record(count - 1))) if count else None
+        self.count = count
+        self.file.seek(count * HEADER_SIZE)
+        self._write_trailer()
+        self._remap()
+
+    def chain_hashes(self):
+        '''Returns the hashes of every stored header as packed 32-byte records,
+        ready for HeaderChain.extend_packed.
+
+        Each header carries the hash of the one before it and the trailer has
+        the tip's, so nothing needs to be hashed.
+        '''
+        if not self.count:
+            return b''
+        hashes = b''.join(self.map[start + 4:start + 36]
+                          for start in range(HEADER_SIZE, self.count * HEADER_SIZE, HEADER_SIZE))
+        return hashes + int_to_little_endian(self.tip_hash, 32)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __repr__(self):
+        return f"<HeaderStore {self.path} {self.count} headers>"
@@ -0,0 +1,111 @@
+import math
+from collections import OrderedDict
+
+# inventory types whose hashes only go through the exact filter, a false
+# positive there would mean never fetching a block
+MSG_BLOCK = 2
+MSG_FILTERED_BLOCK = 3
+MSG_CMPCT_BLOCK = 4
+MSG_WITNESS_FLAG = 1 << 30
+BLOCK_TYPES = {MSG_BLOCK, MSG_FILTERED_BLOCK, MSG_CMPCT_BLOCK}
+
+INVENTORY_CAPACITY = 50000
+INVENTORY_FP_RATE = 0.000001
+RECENT_CAPACITY = 1000
+
+
+class RollingBloomFilter:
+    '''A bloom filter that remembers roughly the last `capacity` to
+    `2 * capacity` items added to it.
+
+    It's two generations of plain bloom filters: items go into the current
+    one, and once it holds `capacity` items it becomes the previous one and
+    the oldest generation is dropped. Memory stays fixed no matter how much
+    goes through it.
+
+    Positions come from Python's hash(), which is salted per process, so
+    peers can't pick hashes that collide in everybody's filter.
+    '''
+
+    def __init__(self, capacity=INVENTORY_CAPACITY, fp_rate=INVENTORY_FP_RATE):
+        self.capacity = capacity
+        # two generations are checked, so each gets half the false positive budget
+        bits = math.ceil(-capacity * math.log(fp_rate / 2) / math.log(2) ** 2)
+        self.num_bits = max(8, bits)
+        self.num_hashes = max(1, round(self.num_bits / capacity * math.log(2)))
+        self.current = bytearray((self.num_bits + 7) // 8)
+        self.previous = bytearray(len(self.current))
+        self.count = 0
+
+    def _positions(self, item):
+        # double hashing, k positions out of one 64-bit hash
+        h = hash(item) & 0xffffffffffffffff
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, item):
+        if self.count >= self.capacity:
+            self.previous, self.current = self.current, self.previous
+            self.current[:] = bytes(len(self.current))
+            self.count = 0
+        bits = self.current
+        for pos in self._positions(item):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        positions = self._positions(item)
+        for bits in (self.current, self.previous):
+            if all(bits[pos >> 3] & (1 << (pos & 7)) for pos in positions):
+                return True
+        return False
+
+    def clear(self):
+        self.current[:] = bytes(len(self.current))
+        self.previous[:] = bytes(len(self.previous))
+        self.count = 0
+
+    def __repr__(self):
+        return f"<RollingBloomFilter {self.num_bits} bits x2 {self.num_hashes} hashes>"
+
+
+class InventoryFilter:
+    '''Remembers which inventory hashes we've already seen or asked for, so
+    an item announced by several peers is only fetched once.
+
+    The last `recent` hashes are kept exactly in an LRU, older ones only in a
+    rolling bloom filter. Block hashes are only ever matched exactly, a
+    transaction we wrongly think we've seen just isn't relayed to us, a block
+    would never be downloaded.
+    '''
+
+    def __init__(self, capacity=INVENTORY_CAPACITY, fp_rate=INVENTORY_FP_RATE, recent=RECENT_CAPACITY):
+        self.bloom = RollingBloomFilter(capacity, fp_rate)
+        self.recent = OrderedDict()
+        self.recent_capacity = recent
+
+    def add(self, hash_):
+        self.bloom.add(hash_)
+        self.recent[hash_] = None
+        self.recent.move_to_end(hash_)
+        if len(self.recent) > self.recent_capacity:
+            self.recent.popitem(last=False)
+
+    def seen(self, hash_, exact=False):
+        if hash_ in self.recent:
+            self.recent.move_to_end(hash_)
+            return True
+        return not exact and hash_ in self.bloom
+
+    def filter_new(self, items):
+        '''Returns the InventoryItems we haven't seen yet and marks them as seen'''
+        new = []
+        for item in items:
+            exact = (item.type & ~MSG_WITNESS_FLAG) in BLOCK_TYPES
+            if not self.seen(item.hash, exact):
+                self.add(item.hash)
+                new.append(item)
+        return new
+
+    def __repr__(self):
+        return f"<InventoryFilter {len(self.recent)} recent {self.bloom}>"
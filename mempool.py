@@ -0,0 +1,113 @@
+import time
+from collections import OrderedDict
+
+# how much memory the cached transactions may take up
+MEMPOOL_MAX_BYTES = 64 * 1024 * 1024
+# what a parsed Tx costs on top of its raw bytes, roughly (measured with
+# tracemalloc on CPython 3.11): the Tx and its entry here, and each TxIn/TxOut
+TX_OVERHEAD = 800
+TXIN_OVERHEAD = 330
+TXOUT_OVERHEAD = 140
+# transactions that haven't made it into a block after this many seconds are dropped
+MEMPOOL_EXPIRY = 14 * 24 * 60 * 60
+
+
+def entry_size(raw, tx):
+    '''Roughly how much memory caching `tx` takes'''
+    return len(raw) + TX_OVERHEAD + TXIN_OVERHEAD * len(tx.tx_ins) + TXOUT_OVERHEAD * len(tx.tx_outs)
+
+
+class Mempool:
+    '''Transactions we've been sent, keyed by txid (internal byte order).
+
+    Each entry keeps the raw wire bytes and the parsed Tx, so when a block
+    with a transaction we've already seen arrives it can reuse the Tx instead
+    of decoding it again. Least recently used entries go first once the
+    entries add up to more than `max_bytes`, and entries older than `expiry`
+    seconds are dropped.
+
+    An entry is counted as its raw bytes plus an estimate of what the parsed
+    Tx takes (see entry_size), typically 3-6 times the raw size for small
+    transactions, so `max_bytes` is close to the real memory used.
+    '''
+
+    def __init__(self, max_bytes=MEMPOOL_MAX_BYTES, expiry=MEMPOOL_EXPIRY, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+        self.clock = clock
+        # txid -> (raw, tx, time added), least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, tx):
+        '''Caches `tx`, returns its txid.
+
+        A Tx that was parsed off a buffer is detached from it, so it doesn't
+        keep the whole receive buffer alive.
+        '''
+        txid = tx.txid()
+        if txid in self.entries:
+            self.entries.move_to_end(txid)
+            return txid
+        raw = tx.detach()
+        self.entries[txid] = (raw, tx, self.clock())
+        self.total_bytes += entry_size(raw, tx)
+        while self.total_bytes > self.max_bytes:
+            self._evict(next(iter(self.entries)))
+        return txid
+
+    def _evict(self, txid):
+        raw, tx, _ = self.entries.pop(txid)
+        self.total_bytes -= entry_size(raw, tx)
+
+    def get(self, txid, raw=None):
+        '''Returns the cached Tx with this txid or None.
+
+        With `raw` the cached bytes must match it exactly, a tx with the same
+        txid but a different witness isn't the same tx.
+        '''
+        entry = self.entries.get(txid)
+        if entry is not None and self.clock() - entry[2] > self.expiry:
+            self._evict(txid)
+            entry = None
+        if entry is None or (raw is not None and entry[0] != raw):
+            self.misses += 1
+            return None
+        self.entries.move_to_end(txid)
+        self.hits += 1
+        return entry[1]
+
+    def transactions(self):
+        '''Yields (raw, tx) for every cached transaction'''
+        for raw, tx, _ in self.entries.values():
+            yield raw, tx
+
+    def remove(self, txids):
+        '''Drops the given txids, e.g. once they're confirmed in a block'''
+        for txid in txids:
+            if txid in self.entries:
+                self._evict(txid)
+
+    def expire(self):
+        '''Drops every entry older than the expiry, returns how many went'''
+        deadline = self.clock() - self.expiry
+        expired = [txid for txid, (_, _, added) in self.entries.items() if added < deadline]
+        for txid in expired:
+            self._evict(txid)
+        return len(expired)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return (f"<Mempool {len(self.entries)} txns {self.total_bytes} bytes "
+                f"{self.hits} hits {self.misses} misses>")
@@ -0,0 +1,29 @@
+from utils import double_sha256
+
+HASH_SIZE = 32
+
+
+def merkle_root(hashes):
+    '''Computes the merkle root of `hashes`, 32-byte hashes packed back to back.
+
+    The tree is built a level at a time: every level is one contiguous buffer,
+    so each pair is hashed straight out of a 64 byte slice of it.
+    Returns (root, mutated). `mutated` flags a pair of equal hashes on some
+    level, the CVE-2012-2459 trick for getting the same root out of a
+    different list of transactions.
+    '''
+    level = bytes(hashes)
+    if not level or len(level) % HASH_SIZE:
+        raise ValueError('need a non-empty run of 32-byte hashes')
+    mutated = False
+    while len(level) > HASH_SIZE:
+        if not mutated:
+            mutated = any(level[i:i + HASH_SIZE] == level[i + HASH_SIZE:i + 2 * HASH_SIZE]
+                          for i in range(0, len(level) - HASH_SIZE, 2 * HASH_SIZE))
+        if len(level) % (2 * HASH_SIZE):
+            # odd number of nodes, the last one is paired with itself
+            level += level[-HASH_SIZE:]
+        with memoryview(level) as view:
+            level = b''.join([double_sha256(view[i:i + 2 * HASH_SIZE])
+                              for i in range(0, len(level), 2 * HASH_SIZE)])
+    return level, mutated
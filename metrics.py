@@ -0,0 +1,175 @@
+'''
+Counters, gauges and latency histograms, served as Prometheus text.
+
+    python node.py --metrics-port 9333
+    curl localhost:9333/metrics
+
+Recording is a dict update (or a bisect for histograms), all the formatting
+happens when somebody scrapes.
+'''
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds, from a varint to a multi-MB block
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+METRICS_HOST = '127.0.0.1'
+# the command label for commands we don't know, peers pick them and every
+# distinct label value would be another series
+OTHER_COMMAND = 'other'
+
+
+class Histogram:
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        # counts[i] is how many values fell in (buckets[i - 1], buckets[i]], the last is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def format_labels(labels, extra=()):
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        if isinstance(value, bytes):
+            value = value.decode(errors='replace')
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def sort_key(item):
+    # label values can be bytes or str, so sort on how they're rendered
+    (name, labels), _ = item
+    return name, format_labels(labels)
+
+
+class Metrics:
+    '''A registry of metrics, keyed by name and a tuple of (label, value) pairs.
+
+    Gauges are functions that are only called when the metrics are rendered,
+    so a queue depth costs nothing until someone looks at it.
+    '''
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+        self.server = None
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histogram = self.histograms.get((name, labels))
+        if histogram is None:
+            histogram = self.histograms[(name, labels)] = Histogram()
+        histogram.observe(value)
+
+    def timer(self, name, labels=()):
+        return Timer(self, name, labels)
+
+    def gauge(self, name, function, labels=()):
+        self.gauges[(name, labels)] = function
+
+    def message(self, command, peer, size):
+        '''Counts a received message per command and per peer. Map commands
+        you don't handle to OTHER_COMMAND before they get here.
+        '''
+        command = (('command', command),)
+        peer = (('peer', peer),)
+        self.inc('bpw_messages_total', command)
+        self.inc('bpw_message_bytes_total', command, size)
+        self.inc('bpw_peer_messages_total', peer)
+        self.inc('bpw_peer_bytes_total', peer, size)
+
+    def render(self):
+        '''The current values in the Prometheus text format'''
+        lines = []
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+
+        # list() takes a snapshot, the node thread keeps adding entries meanwhile
+        for (name, labels), value in sorted(list(self.counters.items()), key=sort_key):
+            declare(name, 'counter')
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), function in sorted(list(self.gauges.items()), key=sort_key):
+            declare(name, 'gauge')
+            lines.append(f'{name}{format_labels(labels)} {function()}')
+        for (name, labels), histogram in sorted(list(self.histograms.items()), key=sort_key):
+            declare(name, 'histogram')
+            counts = list(histogram.counts)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+            lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host=METRICS_HOST):
+        '''Serves /metrics on a background thread, returns the server'''
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+class Timer:
+    '''Records how long the `with` block took in a histogram'''
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.labels, time.perf_counter() - self.start)
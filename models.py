@@ -5,20 +5,29 @@ import struct
 import random
 import datetime
 import math
+from array import array
 
 from utils import (
     little_endian_to_int, 
     int_to_little_endian, 
     read_varint, 
+    read_varint_at,
     encode_varint,
+    encode_varint_into,
+    varint_size,
     read_varstr, 
     encode_varstr,
     double_sha256,
+    double_sha256_spans,
+    bits_to_target,
     read_bool,
+    skip,
     make_nonce,
     consume_stream,
-    encode_command,
+    read_payload,
+    MAX_PAYLOAD_SIZE,
     parse_command,
+    BufferReader,
 )
 
 NETWORK_MAGIC = b'\xf9\xbe\xb4\xd9'
@@ -30,6 +39,17 @@ MY_RELAY = 1 # from version 70001 onwards, fRelay should be appended to version
 
 PEER = ("35.187.200.6", 8333)
 
+# precompiled layouts of the fixed-size parts of messages
+MESSAGE_HEADER = struct.Struct('<4s12sI4s')
+ADDRESS_TIME = struct.Struct('<I')
+ADDRESS = struct.Struct('<Q16sH')
+VERSION_HEAD = struct.Struct('<IQQ')
+VERSION_NONCE = struct.Struct('<Q')
+VERSION_TAIL = struct.Struct('<IB')
+INVENTORY_ITEM = struct.Struct('<I32s')
+LOCATOR_VERSION = struct.Struct('<I')
+BLOCK_HEADER = struct.Struct('<I32s32sI4s4s')
+
 inv_map = {
     0: "ERROR",
     1: "MSG_TX",
@@ -41,6 +61,8 @@ inv_map = {
 
 class Address:
 
+    __slots__ = ('services', 'ip', 'port', 'time')
+
     def __init__(self, services, ip, port, time):
         self.services = services
         self.ip = ip
@@ -60,13 +82,10 @@ class Address:
         return cls(services, ip, port, time)
 
     def serialize(self, version_msg=False):
-        msg = b""
+        msg = ADDRESS.pack(self.services, int_to_little_endian(self.ip, 16), self.port)
         # FIXME: What's the right condition here
         if self.time:
-            msg += int_to_little_endian(self.time, 4)
-        msg += int_to_little_endian(self.services, 8)
-        msg += int_to_little_endian(self.ip, 16)
-        msg += int_to_little_endian(self.port, 2)
+            msg = ADDRESS_TIME.pack(self.time) + msg
         return msg
 
     def __repr__(self):
@@ -96,6 +115,8 @@ def another_recover(sock):
 
 class Message:
 
+    __slots__ = ('command', 'payload')
+
     def __init__(self, command, payload):
         self.command = command
         self.payload = payload
@@ -104,7 +125,7 @@ class Message:
         return f'<Message {self.command} {self.payload} >'
 
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, max_payload=MAX_PAYLOAD_SIZE):
         magic = consume_stream(s, 4)
         if magic != NETWORK_MAGIC:
             raise ValueError('magic is not right')
@@ -112,30 +133,49 @@ class Message:
         command = parse_command(consume_stream(s, 12))
         payload_length = little_endian_to_int(consume_stream(s, 4))
         checksum = consume_stream(s, 4)
-        payload = consume_stream(s, payload_length)
-        calculated_checksum = double_sha256(payload)[:4]
+        # hashed chunk by chunk while it's read in
+        payload, calculated_checksum = read_payload(s, payload_length, max_payload)
 
         if calculated_checksum != checksum:
             raise RuntimeError('checksum does not match')
 
-        if payload_length != len(payload):
-            raise RuntimeError("Tried to read {payload_length} bytes, only received {len(payload)} bytes")
-
         return cls(command, payload)
 
     def serialize(self):
-        result = NETWORK_MAGIC
-        result += encode_command(self.command)
-        result += int_to_little_endian(len(self.payload), 4)
-        result += double_sha256(self.payload)[:4]
-        result += self.payload
-        return result
+        # '12s' pads the command with zeros the way encode_command does
+        header = MESSAGE_HEADER.pack(
+            NETWORK_MAGIC, self.command, len(self.payload), double_sha256(self.payload)[:4])
+        return b"".join((header, self.payload))
 
     def __repr__(self):
         return f"<Message {self.command} {self.payload}>"
 
+def frame_message(obj):
+    '''Serializes a message object (GetData, GetHeaders, ...) into a whole
+    framed message ready to send.
+
+    Objects with serialize_into are written straight in after the 24-byte
+    header, then the checksum is taken over that part of the same buffer and
+    the header is filled in in front of it, so the payload is never copied.
+    '''
+    if not hasattr(obj, 'serialize_into'):
+        return Message(obj.command, obj.serialize()).serialize()
+    size = obj.serialized_size()
+    buf = bytearray(MESSAGE_HEADER.size + size)
+    obj.serialize_into(buf, MESSAGE_HEADER.size)
+    with memoryview(buf) as view:
+        checksum = double_sha256(view[MESSAGE_HEADER.size:])[:4]
+    MESSAGE_HEADER.pack_into(buf, 0, NETWORK_MAGIC, obj.command, size, checksum)
+    return buf
+
+
 class Version:
 
+    __slots__ = (
+        'version', 'services', 'timestamp', 'addr_recv', 'addr_from',
+        'nonce', 'user_agent', 'start_height', 'relay',
+    )
+
     command = b'version'
 
     def __init__(self, version, services, timestamp, addr_recv, addr_from, nonce, user_agent, start_height, relay):
@@ -164,21 +204,20 @@ class Version:
         return cls(version, services, timestamp, addr_recv, addr_from, nonce, user_agent, start_height, relay)
 
     def serialize(self):
-        msg = b""
-        msg += int_to_little_endian(self.version, 4)
-        msg += int_to_little_endian(self.services, 8)
-        msg += int_to_little_endian(self.timestamp, 8)
-        msg += self.addr_recv.serialize()
-        msg += self.addr_from.serialize()
-        msg += int_to_little_endian(self.nonce, 8)
-        msg += encode_varstr(self.user_agent)
-        msg += int_to_little_endian(self.start_height, 4)
-        msg += int_to_little_endian(self.relay, 1)
-        return msg
+        return b"".join([
+            VERSION_HEAD.pack(self.version, self.services, self.timestamp),
+            self.addr_recv.serialize(),
+            self.addr_from.serialize(),
+            VERSION_NONCE.pack(self.nonce),
+            encode_varstr(self.user_agent),
+            VERSION_TAIL.pack(self.start_height, self.relay),
+        ])
 
 
 class Verack:
 
+    __slots__ = ()
+
     command = b'verack'
 
     @classmethod
@@ -189,8 +228,40 @@ class Verack:
         return b""
 
 
+class SendHeaders:
+    '''Asks the peer to announce new blocks with `headers` rather than `inv` (BIP130)'''
+
+    __slots__ = ()
+
+    command = b'sendheaders'
+
+    @classmethod
+    def parse(cls, s):
+        return cls()
+
+    def serialize(self):
+        return b""
+
+
+class GetAddr:
+    '''Asks the peer for addresses of other nodes, it answers with `addr`'''
+
+    __slots__ = ()
+
+    command = b'getaddr'
+
+    @classmethod
+    def parse(cls, s):
+        return cls()
+
+    def serialize(self):
+        return b""
+
+
 class InventoryItem:
 
+    __slots__ = ('type', 'hash')
+
     def __init__(self, type_, hash_):
         self.type = type_
         self.hash = hash_
@@ -202,16 +273,20 @@ class InventoryItem:
         return cls(type_, hash_)
 
     def serialize(self):
-        msg = b""
-        msg += int_to_little_endian(self.type, 4)
-        msg += self.hash
-        return msg
+        return INVENTORY_ITEM.pack(self.type, self.hash)
+
+    def serialize_into(self, buf, offset):
+        INVENTORY_ITEM.pack_into(buf, offset, self.type, self.hash)
+        return offset + INVENTORY_ITEM.size
     
     def __repr__(self):
         return f"<InvItem {inv_map[self.type]} {self.hash}>"
 
 
 class InventoryVector:
+
+    __slots__ = ('items',)
+
     command = b"inv"
 
     def __init__(self, items=None):
@@ -226,14 +301,29 @@ class InventoryVector:
         items = [InventoryItem.parse(s) for _ in range(count)]
         return cls(items)
 
+    def serialized_size(self):
+        return varint_size(len(self.items)) + INVENTORY_ITEM.size * len(self.items)
+
+    def serialize_into(self, buf, offset):
+        offset = encode_varint_into(buf, offset, len(self.items))
+        for item in self.items:
+            INVENTORY_ITEM.pack_into(buf, offset, item.type, item.hash)
+            offset += INVENTORY_ITEM.size
+        return offset
+
     def serialize(self):
-        pass
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return buf
 
     def __repr__(self):
         return f"<InvVec {repr(self.items)}>"
 
 
 class GetData:
+
+    __slots__ = ('items',)
+
     command = b"getdata"
 
     def __init__(self, items=None):
@@ -246,11 +336,9 @@ class GetData:
     def parse(cls, s):
         pass
 
-    def serialize(self):
-        msg = encode_varint(len(self.items))
-        for item in self.items:
-            msg += item.serialize()
-        return msg
+    serialized_size = InventoryVector.serialized_size
+    serialize_into = InventoryVector.serialize_into
+    serialize = InventoryVector.serialize
 
 
     def __repr__(self):
@@ -259,6 +347,8 @@ class GetData:
 
 class GetBlocks:
 
+    __slots__ = ('locator', 'hashstop')
+
     command = b"getblocks"
 
     def __init__(self, locator, hashstop=0):
@@ -269,14 +359,24 @@ class GetBlocks:
     def parse(cls, s):
         pass
 
+    def serialized_size(self):
+        return self.locator.serialized_size() + 32
+
+    def serialize_into(self, buf, offset):
+        offset = self.locator.serialize_into(buf, offset)
+        buf[offset:offset + 32] = int_to_little_endian(self.hashstop, 32)
+        return offset + 32
+
     def serialize(self):
-        msg = self.locator.serialize()
-        msg += int_to_little_endian(self.hashstop, 32)
-        return msg
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return buf
     
 
 class GetHeaders:
 
+    __slots__ = ('locator', 'hashstop')
+
     command = b"getheaders"
 
     def __init__(self, locator, hashstop=0):
@@ -287,14 +387,24 @@ class GetHeaders:
     def parse(cls, s):
         pass
 
+    def serialized_size(self):
+        return self.locator.serialized_size() + 32
+
+    def serialize_into(self, buf, offset):
+        offset = self.locator.serialize_into(buf, offset)
+        buf[offset:offset + 32] = int_to_little_endian(self.hashstop, 32)
+        return offset + 32
+
     def serialize(self):
-        msg = self.locator.serialize()
-        msg += int_to_little_endian(self.hashstop, 32)
-        return msg
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return buf
 
 
 class BlockLocator:
 
+    __slots__ = ('items', 'version')
+
     def __init__(self, items=None, version=MY_VERSION):
         # self.items is a list of block hashes ... not sure on data type
         if items:
@@ -308,16 +418,27 @@ class BlockLocator:
     def parse(cls, s):
         pass
 
-    def serialize(self):
-        msg = int_to_little_endian(self.version, 4)
-        msg += encode_varint(len(self.items))
+    def serialized_size(self):
+        return LOCATOR_VERSION.size + varint_size(len(self.items)) + 32 * len(self.items)
+
+    def serialize_into(self, buf, offset):
+        LOCATOR_VERSION.pack_into(buf, offset, self.version)
+        offset = encode_varint_into(buf, offset + LOCATOR_VERSION.size, len(self.items))
         for hash_ in self.items:
-            msg += int_to_little_endian(hash_, 32)
-        return msg
+            buf[offset:offset + 32] = int_to_little_endian(hash_, 32)
+            offset += 32
+        return offset
+
+    def serialize(self):
+        buf = bytearray(self.serialized_size())
+        self.serialize_into(buf, 0)
+        return buf
     
 
 class Headers:
 
+    __slots__ = ('count', 'headers')
+
     command = b"headers"
 
     def __init__(self, count, headers):
@@ -343,6 +464,8 @@ class Headers:
 
 class BlockHeader:
 
+    __slots__ = ('version', 'prev_block', 'merkle_root', 'timestamp', 'bits', 'nonce', 'txn_count')
+
     def __init__(self, version, prev_block, merkle_root, timestamp, bits, nonce, txn_count):
         self.version = version
         self.prev_block = prev_block
@@ -366,43 +489,35 @@ class BlockHeader:
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count)
 
     def serialize(self):
-        # version - 4 bytes, little endian
-        result = int_to_little_endian(self.version, 4)
-        # prev_block - 32 bytes, little endian
-        result += int_to_little_endian(self.prev_block, 32)
-        # merkle_root - 32 bytes, little endian
-        result += int_to_little_endian(self.merkle_root, 32)
-        # timestamp - 4 bytes, little endian
-        result += int_to_little_endian(self.timestamp, 4)
-        # bits - 4 bytes
-        result += self.bits
-        # nonce - 4 bytes
-        result += self.nonce
-        return result
+        # version, timestamp - 4 bytes, little endian
+        # prev_block, merkle_root - 32 bytes, little endian
+        # bits, nonce - 4 bytes, as they were read
+        return BLOCK_HEADER.pack(
+            self.version,
+            int_to_little_endian(self.prev_block, 32),
+            int_to_little_endian(self.merkle_root, 32),
+            self.timestamp,
+            self.bits,
+            self.nonce,
+        )
 
     def hash(self):
         '''Returns the double-sha256 interpreted little endian of the block'''
-        # serialize
-        s = self.serialize()
+        # serialize, just the header even for a Block
+        s = BlockHeader.serialize(self)
         # double-sha256
         sha = double_sha256(s)
         # reverse
         return sha[::-1]
 
     def pow(self):
-        s = self.serialize()
+        s = BlockHeader.serialize(self)
         sha = double_sha256(s)
         return little_endian_to_int(sha)
 
     def target(self):
         '''Returns the proof-of-work target based on the bits'''
-        # last byte is exponent
-        exponent = self.bits[-1]
-        # the first three bytes are the coefficient in little endian
-        coefficient = little_endian_to_int(self.bits[:-1])
-        # the formula is:
-        # coefficient * 2**(8*(exponent-3))
-        return coefficient * 2**(8*(exponent-3))
+        return bits_to_target(self.bits)
 
     def check_pow(self):
         '''Returns whether this block satisfies proof of work'''
@@ -421,12 +536,20 @@ class BlockHeader:
 
 class Block(BlockHeader):
 
+    __slots__ = ('txns',)
+
     def __init__(self, version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns):
         super().__init__(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count)
         self.txns = txns
 
     @classmethod
-    def parse(cls, s):
+    def parse(cls, s, lazy=False, mempool=None):
+        '''Parses a block payload. With `lazy=True` only the header is decoded
+        up front and `txns` is a LazyTxns that decodes each Tx on first access.
+
+        Transactions already in `mempool` (a mempool.Mempool) are taken from
+        there instead of being decoded again.
+        '''
         version = little_endian_to_int(s.read(4))
         #prev_block = s.read(32)[::-1]  # little endian
         prev_block = little_endian_to_int(s.read(32))
@@ -436,24 +559,261 @@ class Block(BlockHeader):
         bits = s.read(4)
         nonce = s.read(4)
         txn_count = read_varint(s)  # apparently this is always 0?
-        txns = [Tx.parse(s) for _ in range(txn_count)]
+        if lazy:
+            txns = LazyTxns.index(s, txn_count, mempool)
+        elif mempool is not None and hasattr(s, 'getbuffer'):
+            txns = cls.parse_txns_cached(s, txn_count, mempool)
+        else:
+            txns = [Tx.parse(s) for _ in range(txn_count)]
         return cls(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, txns)
 
+    @staticmethod
+    def parse_txns_cached(s, count, mempool):
+        # every tx gets hashed to look it up, which check_merkle_root needs anyway
+        buf = s.getbuffer()
+        txns = []
+        for _ in range(count):
+            start = s.tell()
+            witness_start, end = tx_layout(buf, start)
+            txid = double_sha256_spans(buf, layout_stripped_spans(start, witness_start, end))
+            tx = mempool.get(txid, buf[start:end])
+            if tx is None:
+                tx = Tx.parse(s)
+                tx._txid = txid
+            else:
+                s.seek(end)
+            txns.append(tx)
+        return txns
+
     def serialize(self):
         pass
 
+    def txids(self):
+        '''The txids of every transaction, packed back to back in block order'''
+        if isinstance(self.txns, LazyTxns):
+            return self.txns.txids()
+        return b''.join([tx.txid() for tx in self.txns])
+
     def __repr__(self):
         return f"<Block merkle_root={self.merkle_root} | {len(self.txns)} txns>"
 
 
+class BlockStream(BlockHeader):
+    '''A block read straight off a payload buffer or stream.
+
+    The header fields are parsed up front, iterating yields `(index, Tx)` one
+    transaction at a time, so memory stays flat however big the block is.
+    The transactions can only be iterated over once.
+    '''
+
+    __slots__ = ('stream',)
+
+    def __init__(self, version, prev_block, merkle_root, timestamp, bits, nonce, txn_count, stream=None):
+        super().__init__(version, prev_block, merkle_root, timestamp, bits, nonce, txn_count)
+        self.stream = stream
+
+    @classmethod
+    def parse(cls, s):
+        if not hasattr(s, 'read'):
+            s = BufferReader(s)
+        block = super().parse(s)
+        block.stream = s
+        return block
+
+    def __iter__(self):
+        if self.stream is None:
+            raise RuntimeError('the transactions of this block were already read')
+        s, self.stream = self.stream, None
+        for i in range(self.txn_count):
+            yield i, Tx.parse(s)
+
+    def __repr__(self):
+        return f"<BlockStream merkle_root={self.merkle_root} | {self.txn_count} txns>"
+
+
+def tx_end(buf, pos):
+    '''Returns the offset just past the transaction starting at `pos` in `buf`,
+    walking the varints only (no objects are built)
+    '''
+    return tx_layout(buf, pos)[1]
+
+
+def tx_stripped_spans(buf, pos):
+    '''(start, end) spans of the transaction at `pos` in `buf` that make up its
+    serialization without witness data, what the txid is the hash of
+    '''
+    return layout_stripped_spans(pos, *tx_layout(buf, pos))
+
+
+def layout_stripped_spans(pos, witness_start, end):
+    '''tx_stripped_spans for a transaction whose tx_layout is already known'''
+    if witness_start is None:
+        return [(pos, end)]
+    # version | marker, flag | inputs, outputs | witnesses | locktime
+    return [(pos, pos + 4), (pos + 6, witness_start), (end - 4, end)]
+
+
+def tx_layout(buf, pos):
+    '''Walks the transaction at `pos` in `buf`.
+    Returns (where its witness section starts or None if it has none, where it ends)
+    '''
+    # version
+    pos += 4
+    # BIP144 marker and flag
+    segwit = buf[pos] == 0 and buf[pos + 1] == 1
+    if segwit:
+        pos += 2
+    num_inputs, pos = read_varint_at(buf, pos)
+    for _ in range(num_inputs):
+        # prev_tx + prev_index
+        pos += 36
+        script_sig_length, pos = read_varint_at(buf, pos)
+        # script_sig + sequence
+        pos += script_sig_length + 4
+    num_outputs, pos = read_varint_at(buf, pos)
+    for _ in range(num_outputs):
+        # amount
+        pos += 8
+        script_pubkey_length, pos = read_varint_at(buf, pos)
+        pos += script_pubkey_length
+    witness_start = None
+    if segwit:
+        witness_start = pos
+        pos = witness_end(buf, pos, num_inputs)
+    # locktime
+    return witness_start, pos + 4
+
+
+def witness_end(buf, pos, num_inputs):
+    '''Returns the offset just past the witness stacks of `num_inputs` inputs'''
+    for _ in range(num_inputs):
+        num_items, pos = read_varint_at(buf, pos)
+        for _ in range(num_items):
+            item_length, pos = read_varint_at(buf, pos)
+            pos += item_length
+    return pos
+
+
+class LazyTxns:
+    '''Sequence of the transactions inside a block payload.
+
+    Only the byte offset of every transaction is recorded when the block is
+    parsed; a Tx is decoded the first time it's indexed or iterated over.
+    '''
+
+    __slots__ = ('buf', 'offsets', 'mempool', '_txns', '_txids')
+
+    def __init__(self, buf, offsets, mempool=None):
+        self.buf = buf
+        # offsets[i] is where tx i starts, offsets[-1] is where the last one ends
+        self.offsets = offsets
+        # where already decoded transactions are looked up before decoding one
+        self.mempool = mempool
+        self._txns = [None] * (len(offsets) - 1)
+        self._txids = None
+
+    @classmethod
+    def index(cls, s, count, mempool=None):
+        '''Records the offsets of `count` transactions starting at the current
+        position of `s` and leaves `s` positioned just past the last one
+        '''
+        if hasattr(s, 'getbuffer'):
+            buf = s.getbuffer()
+            pos = s.tell()
+        else:
+            buf = memoryview(s.read())
+            pos = 0
+        offsets = array('Q', [pos])
+        try:
+            for _ in range(count):
+                pos = tx_end(buf, pos)
+                offsets.append(pos)
+        except IndexError:
+            raise RuntimeError('block payload is truncated')
+        if pos > len(buf):
+            raise RuntimeError('block payload is truncated')
+        if hasattr(s, 'getbuffer'):
+            s.seek(pos)
+        return cls(buf, offsets, mempool)
+
+    def raw(self, i):
+        '''Returns a memoryview of the wire bytes of tx `i`'''
+        return self.buf[self.offsets[i]:self.offsets[i + 1]]
+
+    def txid(self, i):
+        '''Returns the txid of tx `i`, hashed straight from the block buffer
+        unless the Tx was already decoded
+        '''
+        if i < 0:
+            i += len(self)
+        tx = self._txns[i]
+        if tx is not None:
+            return tx.txid()
+        if self._txids is None:
+            self._txids = [None] * len(self)
+        txid = self._txids[i]
+        if txid is None:
+            txid = double_sha256_spans(self.buf, tx_stripped_spans(self.buf, self.offsets[i]))
+            self._txids[i] = txid
+        return txid
+
+    def txids(self):
+        '''The txids of every transaction, packed back to back in block order'''
+        return b''.join([self.txid(i) for i in range(len(self))])
+
+    def __len__(self):
+        return len(self._txns)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        tx = self._txns[i]
+        if tx is None:
+            if i < 0:
+                i += len(self)
+            if self.mempool is not None:
+                tx = self.mempool.get(self.txid(i), self.raw(i))
+            if tx is None:
+                tx = Tx.parse(BufferReader(self.buf, self.offsets[i]))
+                if self._txids is not None:
+                    tx._txid = self._txids[i]
+            self._txns[i] = tx
+        return tx
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"<LazyTxns {len(self)} txns>"
+
+
 class Tx:
 
-    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False):
+    __slots__ = (
+        'version', 'tx_ins', 'tx_outs', 'locktime', 'testnet', 'segwit',
+        # where the wire bytes this was parsed from live: a buffer and the span in it
+        '_buf', '_start', '_end',
+        # where each input's witness stack starts in those bytes (relative to
+        # _start) plus where the last one ends
+        '_witness_offsets',
+        # decoded witness stacks, filled in on demand
+        '_witnesses',
+        '_txid', '_wtxid',
+    )
+
+    def __init__(self, version, tx_ins, tx_outs, locktime, testnet=False, segwit=False, witnesses=None):
         self.version = version
         self.tx_ins = tx_ins
         self.tx_outs = tx_outs
         self.locktime = locktime
         self.testnet = testnet
+        self.segwit = segwit
+        self._buf = None
+        self._start = self._end = 0
+        self._witness_offsets = None
+        self._witnesses = witnesses
+        self._txid = self._wtxid = None
 
     def __repr__(self):
         return '<Tx version: {} ntx_ins: {} tx_outs: {} nlocktime: {}>'.format(
@@ -468,11 +828,22 @@ class Tx:
         '''Takes a byte stream and parses the transaction at the start
         return a Tx object
         '''
+        # when the stream can hand out its buffer we keep a view of our bytes
+        buf = s.getbuffer() if hasattr(s, 'getbuffer') else None
+        start = s.tell() if buf is not None else 0
         # s.read(n) will return n bytes
         # version has 4 bytes, little-endian, interpret as int
         version = little_endian_to_int(s.read(4))
+        # a segwit tx has a 0x00 marker and 0x01 flag where the input count
+        # would be (BIP144), a legacy tx can't have 0 inputs
+        first = s.read(1)[0]
+        segwit = first == 0
+        if segwit:
+            if s.read(1) != b'\x01':
+                raise RuntimeError('unknown segwit flag')
+            first = None
         # num_inputs is a varint, use read_varint(s)
-        num_inputs = read_varint(s)
+        num_inputs = read_varint(s, first)
         # each input needs parsing
         inputs = []
         for _ in range(num_inputs):
@@ -483,14 +854,143 @@ class Tx:
         outputs = []
         for _ in range(num_outputs):
             outputs.append(TxOut.parse(s))
+        witness_offsets = witnesses = None
+        if segwit:
+            if buf is not None:
+                # only note where each stack is, they're decoded if someone asks
+                witness_offsets = array('I')
+                for _ in range(num_inputs):
+                    witness_offsets.append(s.tell() - start)
+                    for _ in range(read_varint(s)):
+                        skip(s, read_varint(s))
+                witness_offsets.append(s.tell() - start)
+            else:
+                # these bytes can't be looked at again, so decode them now
+                witnesses = [read_witness(s) for _ in range(num_inputs)]
         # locktime is 4 bytes, little-endian
         locktime = little_endian_to_int(s.read(4))
         # return an instance of the class (cls(...))
-        return cls(version, inputs, outputs, locktime)
+        tx = cls(version, inputs, outputs, locktime, segwit=segwit, witnesses=witnesses)
+        if buf is not None:
+            tx._buf, tx._start, tx._end = buf, start, s.tell()
+            tx._witness_offsets = witness_offsets
+        return tx
+
+    @property
+    def raw(self):
+        '''memoryview of the exact wire bytes this Tx was parsed from, or None'''
+        if self._buf is None:
+            return None
+        return self._buf[self._start:self._end]
+
+    def detach(self):
+        '''Returns this Tx's wire bytes. When it was parsed off a buffer it's
+        moved onto its own copy of them, so it no longer keeps that (maybe far
+        bigger) buffer alive.
+        '''
+        if self._buf is None:
+            return self.serialize()
+        raw = self.raw.tobytes()
+        self._buf, self._start, self._end = memoryview(raw), 0, len(raw)
+        return raw
+
+    def witness(self, i):
+        '''Returns the witness stack of input `i` as a list of items'''
+        if not self.segwit:
+            return []
+        if self._witnesses is None:
+            self._witnesses = [None] * len(self.tx_ins)
+        if self._witnesses[i] is None:
+            start = self._start + self._witness_offsets[i]
+            self._witnesses[i] = read_witness(BufferReader(self._buf, start))
+        return self._witnesses[i]
+
+    def serialize(self, include_witness=True):
+        raw = self.raw
+        if raw is not None and (include_witness or not self.segwit):
+            return raw.tobytes()
+        segwit = include_witness and self.segwit
+        result = int_to_little_endian(self.version, 4)
+        if segwit:
+            result += b'\x00\x01'
+        result += encode_varint(len(self.tx_ins))
+        for tx_in in self.tx_ins:
+            result += tx_in.serialize()
+        result += encode_varint(len(self.tx_outs))
+        for tx_out in self.tx_outs:
+            result += tx_out.serialize()
+        if segwit:
+            for i in range(len(self.tx_ins)):
+                items = self.witness(i)
+                result += encode_varint(len(items))
+                for item in items:
+                    result += encode_varstr(item)
+        result += int_to_little_endian(self.locktime, 4)
+        return result
+
+    def stripped_spans(self):
+        '''(start, end) spans of `raw` that make up the serialization without
+        witness data, which is what the txid commits to
+        '''
+        size = self._end - self._start
+        if not self.segwit:
+            return [(0, size)]
+        # version | marker, flag | inputs, outputs | witnesses | locktime
+        return [(0, 4), (6, self._witness_offsets[0]), (self._witness_offsets[-1], size)]
+
+    def size(self):
+        '''Size on the wire, witness included'''
+        if self._buf is None:
+            return len(self.serialize())
+        return self._end - self._start
+
+    def stripped_size(self):
+        if self._buf is None:
+            return len(self.serialize(include_witness=False))
+        return sum(end - start for start, end in self.stripped_spans())
+
+    def weight(self):
+        # BIP141: non-witness bytes count 4 times, witness bytes once
+        return self.stripped_size() * 3 + self.size()
+
+    def vsize(self):
+        return -(-self.weight() // 4)
+
+    def txid(self):
+        '''double-sha256 of the witness-stripped bytes, in the byte order used
+        on the wire (inv, getdata, prev_tx)
+        '''
+        if self._txid is None:
+            if self._buf is None:
+                self._txid = double_sha256(self.serialize(include_witness=False))
+            else:
+                self._txid = double_sha256_spans(self._buf, [
+                    (self._start + start, self._start + end) for start, end in self.stripped_spans()])
+        return self._txid
+
+    def wtxid(self):
+        '''double-sha256 of all the wire bytes, witness included'''
+        if self._wtxid is None:
+            if self._buf is None:
+                self._wtxid = double_sha256(self.serialize())
+            else:
+                self._wtxid = double_sha256_spans(self._buf, [(self._start, self._end)])
+        return self._wtxid
+
+    def hash(self):
+        '''Returns the txid the way block explorers show it'''
+        return self.txid()[::-1]
+
+
+def read_witness(s):
+    '''Reads one input's witness stack, a list of byte strings'''
+    return [read_varstr(s) for _ in range(read_varint(s))]
 
 
 class TxIn:
 
+    __slots__ = ('prev_tx', 'prev_index', 'script_sig', 'sequence')
+
     def __init__(self, prev_tx, prev_index, script_sig, sequence):
         self.prev_tx = prev_tx
         self.prev_index = prev_index
@@ -522,9 +1022,18 @@ class TxIn:
         # return an instance of the class (cls(...))
         return cls(prev_tx, prev_index, script_sig, sequence)
 
+    def serialize(self):
+        result = self.prev_tx[::-1]
+        result += int_to_little_endian(self.prev_index, 4)
+        result += encode_varstr(self.script_sig)
+        result += int_to_little_endian(self.sequence, 4)
+        return result
+
 
 class TxOut:
 
+    __slots__ = ('amount', 'script_pubkey')
+
     def __init__(self, amount, script_pubkey):
         self.amount = amount
         self.script_pubkey = script_pubkey  # TODO parse it
@@ -546,3 +1055,163 @@ class TxOut:
         script_pubkey = s.read(script_pubkey_length)
         # return an instance of the class (cls(...))
         return cls(amount, script_pubkey)
+
+    def serialize(self):
+        result = int_to_little_endian(self.amount, 8)
+        result += encode_varstr(self.script_pubkey)
+        return result
+
+
+# BIP152 compact blocks
+
+SENDCMPCT = struct.Struct('<?Q')
+SHORT_ID_SIZE = 6
+
+
+class SendCmpct:
+
+    __slots__ = ('announce', 'version')
+
+    command = b"sendcmpct"
+
+    def __init__(self, announce=False, version=2):
+        # announce: whether new blocks should be pushed to us as cmpctblock
+        # right away (high bandwidth mode) rather than announced first
+        self.announce = announce
+        # 1 short ids are made from txids, 2 from wtxids
+        self.version = version
+
+    @classmethod
+    def parse(cls, s):
+        return cls(*SENDCMPCT.unpack(s.read(SENDCMPCT.size)))
+
+    def serialize(self):
+        return SENDCMPCT.pack(self.announce, self.version)
+
+    def __repr__(self):
+        return f"<SendCmpct announce={self.announce} version={self.version}>"
+
+
+def read_indexes(s):
+    # differentially encoded: each index is stored as its distance past the previous one
+    indexes = []
+    index = -1
+    for _ in range(read_varint(s)):
+        index += read_varint(s) + 1
+        indexes.append(index)
+    return indexes
+
+
+def encode_indexes(indexes):
+    result = encode_varint(len(indexes))
+    prev = -1
+    for index in indexes:
+        result += encode_varint(index - prev - 1)
+        prev = index
+    return result
+
+
+class CmpctBlock:
+    '''A block header plus 6-byte short ids of its transactions, some of them
+    (at least the coinbase) sent in full as `prefilled` (index, Tx) pairs.
+    '''
+
+    __slots__ = ('header', 'nonce', 'short_ids', 'prefilled')
+
+    command = b"cmpctblock"
+
+    def __init__(self, header, nonce, short_ids, prefilled):
+        # the raw 80 header bytes
+        self.header = header
+        self.nonce = nonce
+        self.short_ids = short_ids
+        self.prefilled = prefilled
+
+    @classmethod
+    def parse(cls, s):
+        header = s.read(80)
+        if len(header) != 80:
+            raise RuntimeError('cmpctblock payload is truncated')
+        nonce = little_endian_to_int(s.read(8))
+        try:
+            count = read_varint(s)
+            raw_ids = s.read(count * SHORT_ID_SIZE)
+            if len(raw_ids) != count * SHORT_ID_SIZE:
+                raise RuntimeError('cmpctblock payload is truncated')
+            short_ids = [int.from_bytes(raw_ids[i:i + SHORT_ID_SIZE], 'little')
+                         for i in range(0, len(raw_ids), SHORT_ID_SIZE)]
+            prefilled = []
+            index = -1
+            for _ in range(read_varint(s)):
+                index += read_varint(s) + 1
+                prefilled.append((index, Tx.parse(s)))
+        except IndexError:
+            # a varint past the end
+            raise RuntimeError('cmpctblock payload is truncated')
+        return cls(header, nonce, short_ids, prefilled)
+
+    def serialize(self):
+        result = self.header + int_to_little_endian(self.nonce, 8)
+        result += encode_varint(len(self.short_ids))
+        result += b"".join(short_id.to_bytes(SHORT_ID_SIZE, 'little') for short_id in self.short_ids)
+        result += encode_varint(len(self.prefilled))
+        prev = -1
+        for index, tx in self.prefilled:
+            result += encode_varint(index - prev - 1) + tx.serialize()
+            prev = index
+        return result
+
+    def pow(self):
+        return little_endian_to_int(double_sha256(self.header))
+
+    def __repr__(self):
+        return f"<CmpctBlock {len(self.short_ids)} short ids {len(self.prefilled)} prefilled>"
+
+
+class GetBlockTxn:
+
+    __slots__ = ('block_hash', 'indexes')
+
+    command = b"getblocktxn"
+
+    def __init__(self, block_hash, indexes):
+        self.block_hash = block_hash
+        self.indexes = indexes
+
+    @classmethod
+    def parse(cls, s):
+        block_hash = little_endian_to_int(s.read(32))
+        return cls(block_hash, read_indexes(s))
+
+    def serialize(self):
+        return int_to_little_endian(self.block_hash, 32) + encode_indexes(self.indexes)
+
+    def __repr__(self):
+        return f"<GetBlockTxn {len(self.indexes)} txns>"
+
+
+class BlockTxn:
+
+    __slots__ = ('block_hash', 'txns')
+
+    command = b"blocktxn"
+
+    def __init__(self, block_hash, txns):
+        self.block_hash = block_hash
+        self.txns = txns
+
+    @classmethod
+    def parse(cls, s):
+        block_hash = little_endian_to_int(s.read(32))
+        try:
+            txns = [Tx.parse(s) for _ in range(read_varint(s))]
+        except IndexError:
+            raise RuntimeError('blocktxn payload is truncated')
+        return cls(block_hash, txns)
+
+    def serialize(self):
+        result = int_to_little_endian(self.block_hash, 32) + encode_varint(len(self.txns))
+        return result + b"".join(tx.serialize() for tx in self.txns)
+
+    def __repr__(self):
+        return f"<BlockTxn {len(self.txns)} txns>"
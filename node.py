@@ -3,11 +3,8 @@ Prior Art:
 * https://github.com/petertodd/python-bitcoinlib/blob/master/examples/send-addrs-msg.py
 * https://github.com/jimmysong/pb-exercises/blob/master/session7/connect.py
 """
+import argparse
 import socket
-import time
-import io
-import struct
-import random
 import datetime
 import math
 
@@ -16,6 +13,8 @@ from utils import (
     services_int_to_dict,
     encode_command,
     int_to_little_endian,
+    little_endian_to_int,
+    BufferReader,
 )
 
 from models import (
@@ -23,6 +22,8 @@ from models import (
     Address,
     Version,
     Verack,
+    SendHeaders,
+    GetAddr,
     InventoryVector,
     InventoryItem,
     GetData,
@@ -30,10 +31,31 @@ from models import (
     GetHeaders,
     GetBlocks,
     Block,
-    Headers,
     Tx,
-    TxIn,
-    TxOut,
+    SendCmpct,
+    CmpctBlock,
+    GetBlockTxn,
+    BlockTxn,
+    frame_message,
+)
+from framer import MessageFramer
+from chain import HeaderChain
+from header_store import HeaderStore
+from scheduler import BlockDownloadScheduler
+from inventory import InventoryFilter
+from mempool import Mempool
+from compact import PartialBlock
+from addrman import AddrMan
+from capture import CaptureWriter
+from metrics import Metrics, OTHER_COMMAND
+import profiling
+import events
+from validation import (
+    read_header_records,
+    validate_headers,
+    check_merkle_root,
+    make_pool,
+    MEDIAN_TIME_SPAN,
 )
 
 
@@ -49,8 +71,68 @@ PEER = ("35.187.200.6", 8333)
 
 genesis = int("00000000000000000013424801fbec52484d7211c223beec97f02236a9b6ee03", 16)
 
-# just stores the integer representation of the headers
-blocks = [genesis]
+# the integer representation of the header hashes, indexed by height
+blocks = HeaderChain(genesis)
+
+# process pool that `headers` batches are checked on, set up in main()
+validation_pool = None
+
+# blocks are downloaded through a window of requests per peer, heights below
+# scheduled_height have already been handed to the scheduler
+scheduler = BlockDownloadScheduler()
+scheduled_height = 0
+# how far past the lowest missing block we queue up
+DOWNLOAD_AHEAD = 1024
+
+# inventory hashes we've already asked for
+known_inventory = InventoryFilter()
+
+# transactions we've been sent, blocks reuse them instead of decoding them again
+mempool = Mempool()
+
+# BIP152, version 2 short ids are made from wtxids
+COMPACT_VERSION = 2
+MSG_BLOCK = 2
+MSG_CMPCT_BLOCK = 4
+# BIP130, a peer may announce at most this many new blocks in one headers
+# message, anything longer is a reply to getheaders
+MAX_HEADERS_ANNOUNCEMENT = 8
+# whether we've sent a getheaders that hasn't been answered, a short headers
+# message is only an announcement if we haven't
+awaiting_headers = False
+# block hash -> PartialBlock waiting on a blocktxn, oldest first
+pending_compact = {}
+MAX_PENDING_COMPACT = 8
+
+# peer -> how much it has misbehaved, we hang up on it at the limit
+misbehavior = {}
+MISBEHAVING_LIMIT = 100
+
+# peers we've heard about through `addr`
+addresses = AddrMan()
+
+# counters and latencies, served over HTTP with --metrics-port
+metrics = Metrics()
+PEER_NAME = '%s:%s' % PEER
+
+# samples handlers with cProfile when BPW_PROFILE (or --profile) is set
+profiler = profiling.from_env()
+
+# headers we've synced so far, kept across restarts
+HEADER_STORE_PATH = 'headers.dat'
+header_store = None
+
+
+def load_header_store(path=HEADER_STORE_PATH):
+    '''Opens the header store and resumes the chain from its tip'''
+    global header_store
+    header_store = HeaderStore(path)
+    if len(header_store):
+        if little_endian_to_int(header_store[0][4:36]) != genesis:
+            raise RuntimeError(f'{path} does not start at our genesis')
+        blocks.truncate(1)
+        blocks.extend_packed(header_store.chain_hashes())
+    events.info('resuming', height=len(blocks) - 1)
 
 
 def construct_version_msg():
@@ -81,7 +163,7 @@ def connect():
 
 def send_version_msg(sock):
     version_msg = construct_version_msg()
-    sock.send(version_msg.serialize())
+    sock.sendall(version_msg.serialize())
 
 
 def construct_block_locator():
@@ -96,8 +178,9 @@ def construct_block_locator():
         hashes.append(header)
         height -= step
 
-    if not blocks.index(genesis):
-        blocks.append(genesis)
+    # the locator always ends with our starting point
+    if hashes[-1] != genesis:
+        hashes.append(genesis)
 
     return BlockLocator(items=hashes)
     
@@ -114,39 +197,45 @@ def construct_block_locator_for_blocks():
         hashes.append(header)
         height -= step
 
-    if not blocks.index(genesis):
-        blocks.append(genesis)
+    # the locator always ends with our starting point
+    if hashes[-1] != genesis:
+        hashes.append(genesis)
 
     return BlockLocator(items=hashes)
 
 
 def send_getheaders(sock):
+    global awaiting_headers
+    awaiting_headers = True
     locator = construct_block_locator()
     getheaders = GetHeaders(locator)
-    msg = Message(getheaders.command, getheaders.serialize())
-    sock.send(msg.serialize())
-    print('sent getheaders')
+    sock.sendall(frame_message(getheaders))
+    events.info('sent_getheaders')
 
 
 def send_getblocks(sock):
     locator = construct_block_locator_for_blocks()
     getblocks = GetBlocks(locator)
-    msg = Message(getblocks.command, getblocks.serialize())
-    sock.send(msg.serialize())
-    print('sent getblocks')
+    sock.sendall(frame_message(getblocks))
+    events.info('sent_getblocks')
 
 
 def handle_version(payload, sock):
     version_msg = Version.parse(payload)
-    print(services_int_to_dict(version_msg.services))
-    print(version_msg)
+    events.info('version', services=services_int_to_dict(version_msg.services))
+    events.debug('version_msg', version=version_msg)
 
 
 def handle_verack(payload, sock):
-    print('Received Verack')
+    events.info('verack')
     verack = Verack()
-    msg = Message(verack.command, verack.serialize())
-    sock.send(msg.serialize())
+    sock.sendall(frame_message(verack))
+    # new blocks are announced with their headers instead of an inv ...
+    sock.sendall(frame_message(SendHeaders()))
+    # ... or pushed to us as cmpctblock straight away
+    sock.sendall(frame_message(SendCmpct(announce=True, version=COMPACT_VERSION)))
+    # and who else is out there
+    sock.sendall(frame_message(GetAddr()))
 
     # FIXME just here for now ...
     send_getheaders(sock)
@@ -154,45 +243,226 @@ def handle_verack(payload, sock):
 
 def handle_inv(payload, sock):
     inv_vec = InventoryVector.parse(payload)
-    getdata = GetData(items=inv_vec.items)
-    msg = Message(getdata.command, getdata.serialize())
-    sock.send(msg.serialize())
-    print("sent getdata")
-
-def update_blocks(block_headers):
-    for header in block_headers.headers:
-        # this is naive ...
-        # we add it to the blocks if prev_block is our current tip
-        if header.prev_block == blocks[-1]:
-            blocks.append(header.pow())
-        else:
+    # skip whatever another announcement already made us ask for
+    items = known_inventory.filter_new(inv_vec.items)
+    if not items:
+        return
+    for item in items:
+        # announced blocks are fetched compact, we likely have most of their txns
+        if item.type == MSG_BLOCK:
+            item.type = MSG_CMPCT_BLOCK
+    getdata = GetData(items=items)
+    sock.sendall(frame_message(getdata))
+    events.info('sent_getdata', items=len(items), announced=len(inv_vec.items))
+
+def update_blocks(records, verdicts):
+    hashes = []
+    for verdict in verdicts:
+        # only take the run of headers that check out
+        if not verdict.valid:
+            events.warning('header_rejected', hash=f'{verdict.hash:064x}', reason=verdict.reason)
             break
+        hashes.append(verdict.hash)
+    added = blocks.connect(little_endian_to_int(records[4:36]), hashes)
+    if added and header_store is not None:
+        # whatever got connected is the tail of the valid run and ends at our tip,
+        # the store holds every height but the starting one
+        end = len(hashes) * 80
+        header_store.truncate(len(blocks) - 1 - added)
+        header_store.append(records[end - added * 80:end], blocks.tip)
+    return added
+
+def header_context(records):
+    '''The prev_hash and prev_timestamps to check a run of header records
+    against, from the stored headers the first one builds on
+    '''
+    prev_hash = little_endian_to_int(records[4:36])
+    height = blocks.height_of(prev_hash)
+    if height is None:
+        # it doesn't connect, there's nothing to check it against
+        return None, ()
+    timestamps = []
+    if header_store is not None:
+        # record i is the header at height i + 1
+        end = min(height, len(header_store))
+        timestamps = [little_endian_to_int(header_store[i][68:72])
+                      for i in range(max(0, end - MEDIAN_TIME_SPAN), end)]
+    return prev_hash, timestamps
+
+def at_tip():
+    '''Whether every block of our header chain has been downloaded or requested'''
+    return scheduled_height == len(blocks) and not len(scheduler)
+
 
 def handle_headers(payload, sock):
-    block_headers = Headers.parse(payload)
-    print(f'{len(block_headers.headers)} new headers')
-    update_blocks(block_headers)
+    global awaiting_headers
+    with metrics.timer('bpw_parse_seconds', (('command', 'headers'),)):
+        records = read_header_records(payload)
+    count = len(records) // 80
+    events.info('headers', count=count)
+    following = at_tip()
+    # a reply to our getheaders can be short too, near the tip or after a restart
+    announcement = 0 < count <= MAX_HEADERS_ANNOUNCEMENT and not awaiting_headers
+    awaiting_headers = False
+    added = 0
+    if records:
+        prev_hash, prev_timestamps = header_context(records)
+        verdicts = validate_headers(records, prev_hash, prev_timestamps, pool=validation_pool)
+        added = update_blocks(records, verdicts)
+
+    if announcement:
+        # an unsolicited announcement (BIP130)
+        if blocks.height_of(little_endian_to_int(records[4:36])) is None:
+            # it doesn't connect, we missed some blocks in between
+            send_getheaders(sock)
+        elif following and added:
+            # fetch the new tip right away, compact
+            send_block_requests(sock, MSG_CMPCT_BLOCK)
+        events.info('header_chain', headers=len(blocks))
+        return
 
     # after 500 headers, get the blocks
     if len(blocks) < 500:
         send_getheaders(sock)
     else:
-        items = [InventoryItem(2, int_to_little_endian(hash_, 32)) for hash_ in blocks[:10]]
-        getdata = GetData(items=items)
-        msg = Message(getdata.command, getdata.serialize())
-        sock.send(msg.serialize())
+        send_block_requests(sock)
+
+    events.info('header_chain', headers=len(blocks))
+
 
-    print(f'We now have {len(blocks)} headers')
+def schedule_blocks():
+    # only keep a bounded stretch of the chain queued up in the scheduler
+    global scheduled_height
+    end = min(len(blocks), scheduled_height + DOWNLOAD_AHEAD - len(scheduler))
+    if end > scheduled_height:
+        scheduler.add_blocks(scheduled_height, blocks[scheduled_height:end])
+        scheduled_height = end
+
+
+def send_block_requests(sock, inv_type=MSG_BLOCK):
+    schedule_blocks()
+    requests = scheduler.next_requests(sock)
+    if not requests:
+        return
+    items = [InventoryItem(inv_type, int_to_little_endian(hash_, 32)) for _, hash_ in requests]
+    getdata = GetData(items=items)
+    sock.sendall(frame_message(getdata))
+    events.info('requested_blocks', count=len(items))
 
 
 def handle_block(payload, sock):
-    block = Block.parse(payload)
-    print(block)
+    accept_block(payload, sock)
+
+
+def accept_block(payload, sock):
+    '''Checks and takes in a block payload, returns whether it was good'''
+    with metrics.timer('bpw_parse_seconds', (('command', 'block'),)):
+        block = Block.parse(payload, lazy=True, mempool=mempool)
+    # the repr is built on the writer thread, and only with DEBUG on
+    events.debug('block', block=block)
+    if not check_merkle_root(block):
+        # leave it outstanding, the scheduler re-requests it once it stalls
+        events.warning('block_rejected', hash=block.pretty(), reason='bad merkle root')
+        return False
+    # whatever it confirmed is out of the mempool now
+    mempool.remove(block.txns.txid(i) for i in range(len(block.txns)))
+    mempool.expire()
+    events.debug('mempool', mempool=mempool)
+    if scheduler.block_received(block.pow()) is not None:
+        send_block_requests(sock)
+    return True
+
+
+def request_full_block(block_hash, sock):
+    item = InventoryItem(MSG_BLOCK, int_to_little_endian(block_hash, 32))
+    sock.sendall(frame_message(GetData(items=[item])))
+
+
+def finish_compact_block(partial, sock):
+    if accept_block(BufferReader(partial.payload()), sock):
+        events.info('block_rebuilt', hash=f'{partial.block_hash:064x}')
+    else:
+        # most likely a short id matched the wrong mempool tx
+        request_full_block(partial.block_hash, sock)
+
+
+def misbehaving(sock, score, reason):
+    '''Adds to a peer's misbehavior score, disconnects it once that's over the limit'''
+    misbehavior[sock] = misbehavior.get(sock, 0) + score
+    metrics.inc('bpw_misbehaving_total', (('reason', reason),))
+    events.warning('misbehaving', reason=reason, score=misbehavior[sock])
+    if misbehavior[sock] >= MISBEHAVING_LIMIT:
+        raise ConnectionError(f'disconnecting misbehaving peer: {reason}')
+
+
+def handle_cmpctblock(payload, sock):
+    global scheduled_height
+    cmpct = CmpctBlock.parse(payload)
+    # in high bandwidth mode this is also how we hear about the header
+    following = at_tip()
+    header = bytes(cmpct.header)
+    verdict = validate_headers(header, *header_context(header))[0]
+    # rebuilding means short ids for the whole mempool, so only for headers that check out
+    if verdict.reason == 'time-too-new':
+        # could be our clock that's off, it's dropped but not held against the peer
+        events.warning('header_rejected', hash=f'{verdict.hash:064x}', reason=verdict.reason)
+        return
+    if not verdict.valid:
+        misbehaving(sock, MISBEHAVING_LIMIT, f'cmpctblock-{verdict.reason}')
+        return
+    if blocks.height_of(little_endian_to_int(header[4:36])) is None:
+        # it doesn't connect, we missed some blocks in between
+        send_getheaders(sock)
+        return
+    if update_blocks(header, [verdict]) and following:
+        # it's being delivered right now, so rather than schedule a request
+        # for it we track it as in flight, it's re-requested if that stalls
+        scheduler.expect(sock, len(blocks) - 1, verdict.hash)
+        scheduled_height = len(blocks)
+    partial = PartialBlock(cmpct, mempool, COMPACT_VERSION, validation_pool)
+    if partial.collided:
+        request_full_block(partial.block_hash, sock)
+        return
+    missing = partial.missing()
+    events.info('cmpctblock', cmpct=cmpct, missing=len(missing))
+    if not missing:
+        finish_compact_block(partial, sock)
+        return
+    pending_compact[partial.block_hash] = partial
+    if len(pending_compact) > MAX_PENDING_COMPACT:
+        del pending_compact[next(iter(pending_compact))]
+    sock.sendall(frame_message(GetBlockTxn(partial.block_hash, missing)))
+
+
+def handle_blocktxn(payload, sock):
+    blocktxn = BlockTxn.parse(payload)
+    partial = pending_compact.pop(blocktxn.block_hash, None)
+    if partial is None:
+        events.warning('unexpected_blocktxn', blocktxn=blocktxn)
+        return
+    try:
+        partial.fill(blocktxn.txns)
+    except RuntimeError as e:
+        events.warning('blocktxn_failed', error=e)
+        request_full_block(partial.block_hash, sock)
+        return
+    finish_compact_block(partial, sock)
+
+
+def handle_sendcmpct(payload, sock):
+    events.info('sendcmpct', sendcmpct=SendCmpct.parse(payload))
+
+
+def handle_addr(payload, sock):
+    received, added = addresses.add_message(payload)
+    events.info('addr', received=received, new=added, known=len(addresses))
 
 
 def handle_tx(payload, sock):
-    tx = Tx.parse(payload)
-    print("Received Tx: ", tx)
+    with metrics.timer('bpw_parse_seconds', (('command', 'tx'),)):
+        tx = Tx.parse(payload)
+    mempool.add(tx)
+    events.debug('tx', tx=tx)
 
 
 def handle_msg(msg, sock):
@@ -200,37 +470,94 @@ def handle_msg(msg, sock):
         b'version': handle_version,
         b'verack': handle_verack,
         b'inv': handle_inv,
+        b'addr': handle_addr,
         b'tx': handle_tx,
         b'block': handle_block,
         b'headers': handle_headers,
+        b'sendcmpct': handle_sendcmpct,
+        b'cmpctblock': handle_cmpctblock,
+        b'blocktxn': handle_blocktxn,
     }
     handler = handler_map.get(msg.command)
+    # the command comes from the peer, only the ones we handle get their own series
+    metrics.message(msg.command if handler else OTHER_COMMAND, PEER_NAME, len(msg.payload))
     if handler:
-        payload_stream = io.BytesIO(msg.payload)
-        handler(payload_stream, sock)
+        payload_stream = BufferReader(msg.payload)
+        with metrics.timer('bpw_handler_seconds', (('command', msg.command),)):
+            if profiler is None:
+                handler(payload_stream, sock)
+            else:
+                profiler.call(msg.command, handler, payload_stream, sock)
     else:
-        print(f"Unhandled command={msg.command}")
+        events.info('unhandled', command=msg.command)
 
 
-def main_loop(sock):
+def register_gauges(framer):
+    # only looked at when /metrics is scraped
+    metrics.gauge('bpw_header_height', lambda: len(blocks) - 1)
+    metrics.gauge('bpw_blocks_queued', lambda: len(scheduler.queue))
+    metrics.gauge('bpw_blocks_in_flight', lambda: len(scheduler.in_flight))
+    metrics.gauge('bpw_mempool_txns', lambda: len(mempool))
+    metrics.gauge('bpw_mempool_bytes', lambda: mempool.total_bytes)
+    metrics.gauge('bpw_compact_blocks_pending', lambda: len(pending_compact))
+    metrics.gauge('bpw_known_addresses', lambda: len(addresses))
+    metrics.gauge('bpw_receive_buffered_bytes', lambda: framer.end - framer.start)
+
+
+def main_loop(sock, capture=None):
+    framer = MessageFramer(sock, capture=capture, metrics=metrics)
+    register_gauges(framer)
     while True:
         try:
-            msg = Message.parse(sock)
+            msg = framer.read_message()
             handle_msg(msg, sock)
+            if scheduler.check_stalls():
+                send_block_requests(sock)
         except RuntimeError as e:
-            print(e)
-            continue
-        print()
-
-
-def main():
+            events.error('message_failed', error=e)
+        except ConnectionError as e:
+            # the peer is gone or has to go, and it's our only one
+            events.error('disconnected', error=e)
+            sock.close()
+            return
+
+
+def main(capture_path=None, metrics_port=None, profile_dir=None):
+    global validation_pool, profiler
+    if profile_dir:
+        profiler = profiling.Profiler(profile_dir)
+    validation_pool = make_pool()
+    load_header_store()
+    # every message we receive goes in here, `python capture.py` replays it
+    capture = CaptureWriter(capture_path) if capture_path else None
+    if metrics_port:
+        metrics.serve(metrics_port)
     sock = connect()
+    scheduler.add_peer(sock)
     send_version_msg(sock)
     try:
-        main_loop(sock)
+        main_loop(sock, capture)
     except KeyboardInterrupt:
         sock.close()
+    finally:
+        validation_pool.shutdown(cancel_futures=True)
+        header_store.close()
+        if capture is not None:
+            capture.close()
+        metrics.close()
+        if profiler is not None:
+            profiler.close()
+        events.close()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--capture', metavar='PATH', help='record every message received to PATH')
+    parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on localhost:PORT/metrics')
+    parser.add_argument('--profile', metavar='DIR', help='write sampled handler profiles to DIR')
+    parser.add_argument('--log-level', default='info', choices=events.LEVELS, help='drop events below this level')
+    parser.add_argument('--log-file', metavar='PATH', help='write events to PATH instead of stdout')
+    parser.add_argument('--log-json', action='store_true', help='write events as JSON lines')
+    args = parser.parse_args()
+    events.configure(args.log_level, args.log_file, args.log_json)
+    main(args.capture, args.metrics_port, args.profile)
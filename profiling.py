@@ -0,0 +1,224 @@
+'''
+Sampled profiling of message handlers, per command.
+
+    BPW_PROFILE=profiles python node.py      # or: python node.py --profile profiles
+
+Every `sample_every`th message of each command runs under cProfile (and,
+with BPW_PROFILE_MEMORY=1, tracemalloc). Every `window` seconds the
+profiles are written to the directory and started over:
+
+    <command>-<time>.pstats     python -m pstats, snakeviz, ...
+    <command>-<time>.folded     flamegraph.pl / speedscope input, built from
+                                the pstats call graph so it's approximate
+    <command>-<time>.memory.txt the lines that allocated the most during one
+                                sampled message, and the peak of all of them
+
+The other environment variables are BPW_PROFILE_SAMPLE (default 10) and
+BPW_PROFILE_WINDOW (seconds, default 60).
+'''
+import cProfile
+import os
+import re
+import time
+import tracemalloc
+
+PROFILE_SAMPLE_EVERY = 10
+PROFILE_WINDOW = 60
+# lines of allocation stats kept per command
+MEMORY_TOP = 50
+# how deep the folded stacks go
+FOLDED_MAX_DEPTH = 64
+# commands come off the wire, so only this many different ones are profiled per window
+MAX_COMMANDS = 64
+
+
+class CommandProfile:
+    '''What's been sampled for one command in the current window'''
+
+    __slots__ = ('seen', 'sampled', 'profile', 'memory_diff', 'memory_peak')
+
+    def __init__(self):
+        self.seen = 0
+        self.sampled = 0
+        self.profile = cProfile.Profile()
+        self.memory_diff = None
+        self.memory_peak = 0
+
+
+class Profiler:
+    '''Wraps handler calls, profiling a sample of them per command'''
+
+    def __init__(self, directory, sample_every=PROFILE_SAMPLE_EVERY, window=PROFILE_WINDOW,
+                 memory=False, clock=time.monotonic):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sample_every = sample_every
+        self.window = window
+        self.memory = memory
+        self.clock = clock
+        self.window_start = clock()
+        # command -> CommandProfile
+        self.commands = {}
+        # the CommandProfile being recorded into right now, there can only be one
+        self.active = None
+        self.memory_before = None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _sample(self, command):
+        # returns the CommandProfile to record into if this call is sampled
+        if self.active is not None:
+            # cProfile only runs one profile at a time, so whatever overlaps
+            # a sampled (awaiting) handler goes unsampled
+            return None
+        if self.clock() - self.window_start >= self.window:
+            self.flush()
+        entry = self.commands.get(command)
+        if entry is None:
+            if len(self.commands) >= MAX_COMMANDS:
+                return None
+            entry = self.commands[command] = CommandProfile()
+        entry.seen += 1
+        if (entry.seen - 1) % self.sample_every:
+            return None
+        entry.sampled += 1
+        return entry
+
+    def _start(self, entry):
+        # returns whether profiling started, it doesn't if something other
+        # than us is profiling the interpreter
+        try:
+            entry.profile.enable()
+        except ValueError:
+            entry.sampled -= 1
+            return False
+        self.active = entry
+        self.memory_before = None
+        if self.memory:
+            tracemalloc.reset_peak()
+            if entry.memory_diff is None:
+                self.memory_before = tracemalloc.take_snapshot()
+        return True
+
+    def _stop(self):
+        entry = self.active
+        entry.profile.disable()
+        if self.memory:
+            entry.memory_peak = max(entry.memory_peak, tracemalloc.get_traced_memory()[1])
+            if self.memory_before is not None:
+                entry.memory_diff = tracemalloc.take_snapshot().compare_to(self.memory_before, 'lineno')[:MEMORY_TOP]
+        self.active = None
+        self.memory_before = None
+
+    def call(self, command, handler, *args):
+        '''Returns handler(*args), profiled if this call is sampled'''
+        entry = self._sample(command)
+        if entry is None or not self._start(entry):
+            return handler(*args)
+        try:
+            return handler(*args)
+        finally:
+            self._stop()
+
+    async def call_async(self, command, handler, *args):
+        '''call() for a coroutine function. Other tasks that run while it's
+        suspended end up in its profile too, and aren't sampled themselves.
+        '''
+        entry = self._sample(command)
+        if entry is None or not self._start(entry):
+            return await handler(*args)
+        try:
+            return await handler(*args)
+        finally:
+            self._stop()
+
+    def flush(self):
+        '''Writes out the profiles of the current window and starts a new one.
+        Returns the paths written.
+        '''
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        paths = []
+        for command, entry in self.commands.items():
+            if not entry.sampled:
+                continue
+            name = command.decode('ascii', errors='ignore') if isinstance(command, bytes) else str(command)
+            # it's from the wire, keep it to something that's safe as a file name
+            name = re.sub('[^a-z0-9]', '', name.lower()) or 'unknown'
+            base = os.path.join(self.directory, f'{name}-{stamp}')
+            entry.profile.create_stats()
+            if entry.profile.stats:
+                entry.profile.dump_stats(base + '.pstats')
+                with open(base + '.folded', 'w') as f:
+                    f.writelines(f'{stack} {weight}\n' for stack, weight in folded_stacks(entry.profile.stats))
+                paths += [base + '.pstats', base + '.folded']
+            if entry.memory_diff is not None:
+                with open(base + '.memory.txt', 'w') as f:
+                    f.write(f'{entry.sampled} of {entry.seen} messages sampled, '
+                            f'peak traced memory {entry.memory_peak} bytes\n')
+                    f.writelines(f'{stat}\n' for stat in entry.memory_diff)
+                paths.append(base + '.memory.txt')
+        self.commands = {}
+        self.window_start = self.clock()
+        return paths
+
+    def close(self):
+        paths = self.flush()
+        if self.memory:
+            tracemalloc.stop()
+        return paths
+
+
+def function_name(func):
+    filename, line, name = func
+    return f'{os.path.basename(filename)}:{line}:{name}' if line else name
+
+
+def folded_stacks(stats):
+    '''Turns pstats data into folded stacks ("a;b;c microseconds").
+
+    cProfile only keeps caller -> callee edges, so a function's time is split
+    between its callers in proportion to how much of it each one accounted for.
+    '''
+    # func -> [(callee, cumulative time spent in callee when called from func)]
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumtime) in callers.items():
+            callees.setdefault(caller, []).append((func, cumtime))
+    roots = [func for func, (_, _, _, _, callers) in stats.items() if not callers]
+
+    folded = {}
+
+    def walk(func, stack, share):
+        _, _, tottime, cumtime, _ = stats[func]
+        if cumtime * share < 1e-6:
+            # below what the output can show, and it keeps the walk from blowing up
+            return
+        stack = stack + [function_name(func)]
+        weight = int(tottime * share * 1e6)
+        if weight:
+            key = ';'.join(stack)
+            folded[key] = folded.get(key, 0) + weight
+        if len(stack) >= FOLDED_MAX_DEPTH:
+            return
+        for callee, edge_time in callees.get(func, ()):
+            callee_cumtime = stats[callee][3]
+            # skip recursion, its time is already in the frames above
+            if callee_cumtime and function_name(callee) not in stack:
+                walk(callee, stack, share * edge_time / callee_cumtime)
+
+    for root in roots:
+        walk(root, [], 1.0)
+    return sorted(folded.items())
+
+
+def from_env(environ=os.environ):
+    '''A Profiler configured from the BPW_PROFILE* variables, or None'''
+    directory = environ.get('BPW_PROFILE')
+    if not directory:
+        return None
+    return Profiler(
+        directory,
+        sample_every=int(environ.get('BPW_PROFILE_SAMPLE', PROFILE_SAMPLE_EVERY)),
+        window=float(environ.get('BPW_PROFILE_WINDOW', PROFILE_WINDOW)),
+        memory=environ.get('BPW_PROFILE_MEMORY', '') not in ('', '0'),
+    )
@@ -0,0 +1,113 @@
+import heapq
+import time
+
+# how many blocks each peer may have in flight at once
+BLOCK_WINDOW = 16
+# a request that hasn't been answered after this many seconds goes to someone else
+STALL_TIMEOUT = 30
+
+
+class BlockDownloadScheduler:
+    '''Hands out block heights to download across peers.
+
+    Each peer gets a window of in-flight requests that's topped up as blocks
+    arrive. Lower heights always go out first, and requests that stall are put
+    back in the queue so the next peer with room picks them up.
+
+    Peers can be anything hashable (a socket, a host, ...).
+    '''
+
+    def __init__(self, window=BLOCK_WINDOW, stall_timeout=STALL_TIMEOUT, clock=time.monotonic):
+        self.window = window
+        self.stall_timeout = stall_timeout
+        self.clock = clock
+        # heights waiting to be requested, lowest first
+        self.queue = []
+        # height -> hash of every block we still need, and hash -> height
+        self.wanted = {}
+        self.heights = {}
+        # hash -> (peer, height, time requested)
+        self.in_flight = {}
+        # peer -> hashes requested from it
+        self.peers = {}
+
+    def add_peer(self, peer):
+        self.peers.setdefault(peer, set())
+
+    def remove_peer(self, peer):
+        '''Forgets `peer`, anything it still owed us goes back in the queue'''
+        for hash_ in self.peers.pop(peer, ()):
+            _, height, _ = self.in_flight.pop(hash_)
+            heapq.heappush(self.queue, height)
+
+    def add_blocks(self, start_height, hashes):
+        '''Queues the blocks at `start_height`, `start_height + 1`, ... for download'''
+        for height, hash_ in enumerate(hashes, start_height):
+            if height not in self.wanted:
+                self.wanted[height] = hash_
+                self.heights[hash_] = height
+                heapq.heappush(self.queue, height)
+
+    def next_requests(self, peer):
+        '''Returns the (height, hash) pairs `peer` should be asked for now'''
+        requested = self.peers[peer]
+        now = self.clock()
+        requests = []
+        while self.queue and len(requested) < self.window:
+            height = heapq.heappop(self.queue)
+            hash_ = self.wanted.get(height)
+            # skip entries for blocks that arrived while they sat in the queue
+            if hash_ is None or hash_ in self.in_flight:
+                continue
+            self.in_flight[hash_] = (peer, height, now)
+            requested.add(hash_)
+            requests.append((height, hash_))
+        return requests
+
+    def expect(self, peer, height, hash_):
+        '''Tracks a block `peer` is sending without having been asked, so it's
+        requested again if it doesn't turn up
+        '''
+        if hash_ in self.in_flight:
+            return
+        self.wanted[height] = hash_
+        self.heights[hash_] = height
+        self.in_flight[hash_] = (peer, height, self.clock())
+        self.peers.setdefault(peer, set()).add(hash_)
+
+    def block_received(self, hash_):
+        '''Marks a block as downloaded, returns its height or None if we didn't ask for it'''
+        entry = self.in_flight.pop(hash_, None)
+        if entry is not None:
+            peer, height, _ = entry
+            self.peers[peer].discard(hash_)
+        else:
+            # it may have turned up after stalling, when it's back in the queue.
+            # Its queue entry is skipped by next_requests once it's not wanted
+            height = self.heights.get(hash_)
+            if height is None:
+                return None
+        del self.wanted[height]
+        del self.heights[hash_]
+        return height
+
+    def check_stalls(self):
+        '''Requeues every request older than the stall timeout.
+        Returns the peers that were too slow.
+        '''
+        deadline = self.clock() - self.stall_timeout
+        stalled = set()
+        for hash_, (peer, height, requested_at) in list(self.in_flight.items()):
+            if requested_at < deadline:
+                del self.in_flight[hash_]
+                self.peers[peer].discard(hash_)
+                heapq.heappush(self.queue, height)
+                stalled.add(peer)
+        return stalled
+
+    def __len__(self):
+        '''Blocks still to download, in flight or not'''
+        return len(self.wanted)
+
+    def __repr__(self):
+        return f"<BlockDownloadScheduler {len(self.wanted)} wanted {len(self.in_flight)} in flight>"
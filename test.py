@@ -1,6 +1,8 @@
 import io
+import os
+import time
 
-import raw
+import models
 import utils
 import test_data as td
 
@@ -8,9 +10,9 @@ import test_data as td
 def test_parse_version():
     raw_version_msg = td.VERSION
     version_msg_bytestream = io.BytesIO(raw_version_msg)
-    msg = raw.Message.parse(version_msg_bytestream)
+    msg = models.Message.parse(version_msg_bytestream)
     payload_bytestream = io.BytesIO(msg.payload)
-    version_msg = raw.Version.parse(payload_bytestream)
+    version_msg = models.Version.parse(payload_bytestream)
 
     assert version_msg.version == 70015
 
@@ -41,5 +43,1020 @@ def test_parse_version():
 
 
 def test_parse_verack():
-    #verack_msg = raw.Version.parse(td.VERACK)
+    #verack_msg = models.Version.parse(td.VERACK)
     raise NotImplementedError()
+
+
+class Stream:
+    '''A stream with nothing but read(), no buffer a parser could point into'''
+
+    def __init__(self, data):
+        self.s = io.BytesIO(data)
+
+    def read(self, n):
+        return self.s.read(n)
+
+
+def make_tx(n):
+    # one input, two outputs, no witness
+    tx = utils.int_to_little_endian(1, 4)
+    tx += utils.encode_varint(1)
+    tx += bytes([n]) * 32 + utils.int_to_little_endian(0, 4)
+    tx += utils.encode_varstr(b'sig') + b'\xff' * 4
+    tx += utils.encode_varint(2)
+    tx += utils.int_to_little_endian(5000, 8) + utils.encode_varstr(b'xy')
+    tx += utils.int_to_little_endian(7, 8) + utils.encode_varstr(b'')
+    tx += utils.int_to_little_endian(0, 4)
+    return tx
+
+
+def make_block(txns):
+    return bytes(80) + utils.encode_varint(len(txns)) + b"".join(txns)
+
+
+def test_lazy_block_parse():
+    raw_block = make_block([make_tx(n) for n in range(3)])
+    eager = models.Block.parse(io.BytesIO(raw_block))
+    lazy = models.Block.parse(io.BytesIO(raw_block), lazy=True)
+
+    assert lazy.txn_count == len(lazy.txns) == 3
+    # nothing is decoded until it's asked for
+    assert lazy.txns._txns == [None, None, None]
+    assert lazy.txns.raw(1).tobytes() == make_tx(1)
+
+    for a, b in zip(eager.txns, lazy.txns):
+        assert repr(a) == repr(b)
+    assert lazy.txns[-1] is lazy.txns[2]
+
+
+def test_lazy_block_truncated():
+    raw_block = make_block([make_tx(0), make_tx(1)])[:-10]
+    try:
+        models.Block.parse(io.BytesIO(raw_block), lazy=True)
+    except RuntimeError:
+        pass
+    else:
+        assert False, "truncated block should not parse"
+
+
+def test_framer_reads_split_messages():
+    import socket
+    import threading
+    from framer import MessageFramer
+
+    big = models.Message(b'block', make_block([make_tx(n % 256) for n in range(5000)]))
+    small = models.Message(b'verack', b'')
+    data = small.serialize() + big.serialize() + small.serialize()
+
+    a, b = socket.socketpair()
+    sender = threading.Thread(target=lambda: (a.sendall(data), a.close()))
+    sender.start()
+    framer = MessageFramer(b, buffer_size=1024)
+    msgs = [framer.read_message() for _ in range(3)]
+    sender.join()
+    b.close()
+
+    assert [m.command for m in msgs] == [b'verack', b'block', b'verack']
+    assert msgs[1].payload == big.payload
+    assert isinstance(msgs[1].payload, memoryview)
+
+
+def test_header_chain():
+    from chain import HeaderChain
+
+    hashes = [utils.little_endian_to_int(utils.double_sha256(bytes([n % 256, n // 256]))) for n in range(3000)]
+    chain = HeaderChain(hashes[0])
+    assert chain.connect(hashes[0], hashes[1:]) == 2999
+    assert len(chain) == 3000
+    assert chain.tip == hashes[-1]
+    assert chain[1234] == hashes[1234]
+    assert chain.height_of(hashes[2999]) == 2999
+    assert 12345 not in chain
+
+    # already known headers are skipped
+    assert chain.connect(hashes[10], hashes[11:20]) == 0
+    # a shorter competing branch is ignored, a longer one replaces ours
+    fork = [n + 1 for n in range(5)]
+    assert chain.connect(hashes[2990], fork) == 0
+    fork = [n + 1 for n in range(20)]
+    assert chain.connect(hashes[2990], fork) == 20
+    assert len(chain) == 2991 + 20
+    assert hashes[2995] not in chain
+    assert chain.height_of(20) == 2991 + 19
+
+
+def mine_headers(count, prev_hash=0, timestamp=1500000000):
+    # regtest-style easy target, about every other nonce works
+    bits = bytes.fromhex('ffff7f20')
+    records = b''
+    for _ in range(count):
+        timestamp += 600
+        for nonce in range(1000):
+            header = (utils.int_to_little_endian(1, 4)
+                      + utils.int_to_little_endian(prev_hash, 32)
+                      + bytes(32)
+                      + utils.int_to_little_endian(timestamp, 4)
+                      + bits
+                      + utils.int_to_little_endian(nonce, 4))
+            hash_ = utils.little_endian_to_int(utils.double_sha256(header))
+            if hash_ < utils.bits_to_target(bits):
+                break
+        records += header
+        prev_hash = hash_
+    return records
+
+
+def test_validate_headers():
+    from concurrent.futures import ProcessPoolExecutor
+    from validation import validate_headers, read_header_records
+
+    records = mine_headers(600)
+    payload = utils.encode_varint(600) + b"".join(
+        records[i:i + 80] + b'\x00' for i in range(0, len(records), 80))
+    assert read_header_records(io.BytesIO(payload)) == records
+
+    verdicts = validate_headers(records, prev_hash=0)
+    assert all(v.valid for v in verdicts)
+    first = models.BlockHeader.parse(io.BytesIO(records[:80] + b'\x00'))
+    assert verdicts[0].hash == first.pow()
+
+    # break the link between header 300 and 299
+    bad = bytearray(records)
+    bad[300 * 80 + 4] ^= 1
+    with ProcessPoolExecutor(2) as pool:
+        verdicts = validate_headers(bytes(bad), prev_hash=0, pool=pool, chunk_size=100)
+    assert len(verdicts) == 600
+    assert verdicts[300].reason == 'bad-prevblk'
+    assert all(v.valid for v in verdicts[:300])
+
+
+def test_header_store(tmp_path):
+    from chain import HeaderChain
+    from header_store import HeaderStore
+
+    records = mine_headers(50)
+    path = str(tmp_path / 'headers.dat')
+    store = HeaderStore(path)
+    store.append(records[:40 * 80])
+    store.append(records[40 * 80:])
+    store.close()
+
+    store = HeaderStore(path)
+    assert len(store) == 50
+    assert store[-1] == records[-80:]
+    chain = HeaderChain(0)
+    chain.extend_packed(store.chain_hashes())
+    expected = models.BlockHeader.parse(io.BytesIO(records[-80:] + b'\x00')).pow()
+    assert chain.tip == store.tip_hash == expected
+    assert chain.height_of(expected) == 50
+    store.truncate(45)
+    store.close()
+
+    # die halfway through an append: records without a trailer after them
+    with open(path, 'r+b') as f:
+        f.seek(45 * 80)
+        f.write(records[45 * 80:48 * 80] + records[48 * 80:48 * 80 + 30])
+        f.truncate()
+    store = HeaderStore(path)
+    assert len(store) == 48
+    assert store[-1] == records[47 * 80:48 * 80]
+    store.close()
+
+
+def test_peer_manager_reconnects(monkeypatch):
+    import asyncio
+    import importlib
+    peers = importlib.import_module('async')
+    monkeypatch.setattr(peers, 'BACKOFF_BASE', 0.01)
+
+    connections = []
+
+    async def serve(reader, writer):
+        # answer the version, then hang up on them
+        connections.append(await peers.read_message(reader))
+        writer.write(peers.VERSION)
+        await writer.drain()
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        manager = peers.PeerManager(['127.0.0.1'], port, target=2)
+        task = asyncio.create_task(manager.run())
+        while len(connections) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        server.close()
+        return manager
+
+    manager = asyncio.run(asyncio.wait_for(run(), 5))
+    assert manager.peers == {}
+    assert all(msg.command.startswith(b'version') for msg in connections)
+
+
+def test_block_download_scheduler():
+    from scheduler import BlockDownloadScheduler
+
+    now = [0]
+    scheduler = BlockDownloadScheduler(window=4, stall_timeout=10, clock=lambda: now[0])
+    scheduler.add_peer('a')
+    scheduler.add_peer('b')
+    scheduler.add_blocks(0, [100 + n for n in range(10)])
+
+    assert scheduler.next_requests('a') == [(n, 100 + n) for n in range(4)]
+    assert [h for h, _ in scheduler.next_requests('b')] == [4, 5, 6, 7]
+    # windows are full
+    assert scheduler.next_requests('a') == []
+
+    assert scheduler.block_received(101) == 1
+    assert scheduler.block_received(999) is None
+    assert scheduler.next_requests('a') == [(8, 108)]
+
+    # b goes quiet, its requests move over to a as a's window frees up
+    now[0] = 5
+    for hash_ in (100, 102, 103, 108):
+        scheduler.block_received(hash_)
+    now[0] = 12
+    assert scheduler.check_stalls() == {'b'}
+    assert [h for h, _ in scheduler.next_requests('a')] == [4, 5, 6, 7]
+
+    scheduler.remove_peer('a')
+    scheduler.add_peer('c')
+    assert [h for h, _ in scheduler.next_requests('c')] == [4, 5, 6, 7]
+    assert len(scheduler) == 5
+
+    # c stalls too, but its blocks still count when they turn up late
+    now[0] = 30
+    assert scheduler.check_stalls() == {'c'}
+    assert scheduler.block_received(104) == 4
+    assert [h for h, _ in scheduler.next_requests('b')] == [5, 6, 7, 9]
+    assert len(scheduler) == 4
+
+
+def test_block_stream():
+    raw_block = make_block([make_tx(n) for n in range(3)])
+    eager = models.Block.parse(io.BytesIO(raw_block))
+
+    for source in (raw_block, io.BytesIO(raw_block)):
+        block = models.BlockStream.parse(source)
+        assert block.txn_count == 3
+        assert block.merkle_root == eager.merkle_root
+        txns = list(block)
+        assert [i for i, _ in txns] == [0, 1, 2]
+        assert [repr(tx) for _, tx in txns] == [repr(tx) for tx in eager.txns]
+        try:
+            list(block)
+        except RuntimeError:
+            pass
+        else:
+            assert False, "a block stream can only be read once"
+
+
+def test_txid_from_raw_bytes():
+    txid = '4a5e1e4baab89f3a32518a88c31bc87f618f76673e2cc77ab2127b7afdeda33b'
+
+    tx = models.Tx.parse(utils.BufferReader(td.GENESIS_COINBASE_TX))
+    assert tx.raw.obj is not None
+    assert tx.raw == td.GENESIS_COINBASE_TX
+    assert tx.hash().hex() == txid
+    assert tx.txid() is tx.txid()
+    assert tx.wtxid() == tx.txid()
+
+    # without a buffer to point into, the bytes are rebuilt from the fields
+    rebuilt = models.Tx.parse(Stream(td.GENESIS_COINBASE_TX))
+    assert rebuilt.raw is None
+    assert rebuilt.serialize() == td.GENESIS_COINBASE_TX
+    assert rebuilt.hash().hex() == txid
+
+
+def make_segwit_tx(n):
+    legacy = make_tx(n)
+    witness = utils.encode_varint(2) + utils.encode_varstr(b'\x30' * 71) + utils.encode_varstr(b'\x02' * 33)
+    return legacy[:4] + b'\x00\x01' + legacy[4:-4] + witness + legacy[-4:]
+
+
+def test_segwit_tx():
+    legacy = make_tx(7)
+    raw_tx = make_segwit_tx(7)
+
+    tx = models.Tx.parse(utils.BufferReader(raw_tx))
+    assert tx.segwit
+    assert repr(tx) == repr(models.Tx.parse(io.BytesIO(legacy)))
+    assert tx.txid() == utils.double_sha256(legacy)
+    assert tx.wtxid() == utils.double_sha256(raw_tx)
+    assert tx.size() == len(raw_tx)
+    assert tx.stripped_size() == len(legacy)
+    assert tx.weight() == 3 * len(legacy) + len(raw_tx)
+    assert tx.witness(0) == [b'\x30' * 71, b'\x02' * 33]
+    assert tx.serialize(include_witness=False) == legacy
+
+    # a block mixing both kinds indexes and decodes fine
+    raw_block = make_block([make_tx(1), raw_tx, make_tx(2)])
+    block = models.Block.parse(io.BytesIO(raw_block), lazy=True)
+    assert block.txns.raw(1) == raw_tx
+    assert block.txns[2].txid() == utils.double_sha256(make_tx(2))
+
+
+def test_segwit_tx_vector():
+    tx = models.Tx.parse(utils.BufferReader(td.SEGWIT_TX))
+    assert tx.segwit
+    assert len(tx.tx_ins) == 2 and len(tx.tx_outs) == 2
+    assert tx.witness(0) == []
+    assert [len(item) for item in tx.witness(1)] == [71, 33]
+    assert tx.locktime == 17
+
+    # without a buffer the witnesses are decoded right away and re-encoded on serialize
+    rebuilt = models.Tx.parse(Stream(td.SEGWIT_TX))
+    assert rebuilt.serialize() == td.SEGWIT_TX
+    assert rebuilt.txid() == tx.txid()
+    assert rebuilt.wtxid() == tx.wtxid() == utils.double_sha256(td.SEGWIT_TX)
+
+
+def test_merkle_root():
+    from merkle import merkle_root
+    from validation import check_merkle_root, check_block_payload
+
+    a, b, c = (utils.double_sha256(bytes([n])) for n in range(3))
+    ab = utils.double_sha256(a + b)
+    cc = utils.double_sha256(c + c)
+    assert merkle_root(a) == (a, False)
+    assert merkle_root(a + b + c) == (utils.double_sha256(ab + cc), False)
+    # same root, but with the last tx repeated
+    assert merkle_root(a + b + c + c) == (utils.double_sha256(ab + cc), True)
+
+    # the genesis block's merkle root is its coinbase txid
+    coinbase_txid = utils.double_sha256(td.GENESIS_COINBASE_TX)
+    raw_block = bytes(36) + coinbase_txid + bytes(12) + utils.encode_varint(1) + td.GENESIS_COINBASE_TX
+    assert check_block_payload(raw_block)
+
+    txns = [make_tx(1), make_segwit_tx(2), make_tx(3)]
+    root, _ = merkle_root(b''.join(models.Tx.parse(io.BytesIO(tx)).txid() for tx in txns))
+    raw_block = bytes(36) + root + bytes(12) + utils.encode_varint(3) + b''.join(txns)
+    block = models.Block.parse(io.BytesIO(raw_block), lazy=True)
+    assert check_merkle_root(block)
+    assert check_merkle_root(models.Block.parse(io.BytesIO(raw_block)))
+    assert not check_block_payload(raw_block[:-1])
+    assert not check_block_payload(raw_block[:81] + utils.encode_varint(2) + b''.join(txns[:2]))
+
+
+def test_frame_message():
+    def old_frame(command, payload):
+        header = models.NETWORK_MAGIC + utils.encode_command(command)
+        header += utils.int_to_little_endian(len(payload), 4) + utils.double_sha256(payload)[:4]
+        return header + payload
+
+    items = [models.InventoryItem(2, n.to_bytes(32, 'little')) for n in range(300)]
+    getdata = models.GetData(items=items)
+    expected_payload = utils.encode_varint(300) + b''.join(
+        utils.int_to_little_endian(2, 4) + n.to_bytes(32, 'little') for n in range(300))
+    assert getdata.serialize() == expected_payload
+    assert models.frame_message(getdata) == old_frame(b'getdata', expected_payload)
+    assert models.InventoryVector(items=items).serialize() == expected_payload
+
+    locator = models.BlockLocator(items=[1, 2, 3])
+    getheaders = models.GetHeaders(locator)
+    framed = models.frame_message(getheaders)
+    assert framed == old_frame(b'getheaders', getheaders.serialize())
+    assert len(getheaders.serialize()) == 4 + 1 + 3 * 32 + 32
+
+    # objects without serialize_into still get framed
+    assert models.frame_message(models.Verack()) == old_frame(b'verack', b'')
+
+    raw_header = bytes(range(80))
+    assert models.BlockHeader.parse(io.BytesIO(raw_header + b"\x00")).serialize() == raw_header
+
+
+def test_inventory_filter():
+    from inventory import InventoryFilter, RollingBloomFilter
+
+    bloom = RollingBloomFilter(capacity=100, fp_rate=0.001)
+    hashes = [n.to_bytes(32, 'little') for n in range(1000)]
+    for hash_ in hashes[:300]:
+        bloom.add(hash_)
+    # the last generation or two are remembered, older ones are dropped
+    assert all(hash_ in bloom for hash_ in hashes[200:300])
+    assert sum(hash_ in bloom for hash_ in hashes[:100]) < 5
+    assert sum(hash_ in bloom for hash_ in hashes[300:]) < 5
+
+    known = InventoryFilter(capacity=100, fp_rate=0.001, recent=10)
+    items = [models.InventoryItem(1, hash_) for hash_ in hashes[:20]]
+    assert known.filter_new(items) == items
+    assert known.filter_new(items) == []
+    assert known.filter_new(items[:5] + [models.InventoryItem(1, hashes[20])])[0].hash == hashes[20]
+    # blocks only count as seen while they're in the exact LRU
+    assert not known.seen(hashes[0], exact=True)
+    assert known.seen(hashes[0])
+    block = models.InventoryItem(2, hashes[0])
+    assert known.filter_new([block]) == [block]
+    assert known.filter_new([block]) == []
+
+
+def test_mempool():
+    from mempool import Mempool, entry_size
+
+    now = [0]
+    size = entry_size(make_tx(0), models.Tx.parse(io.BytesIO(make_tx(0))))
+    assert size > 3 * len(make_tx(0))
+    pool = Mempool(max_bytes=2 * size, expiry=100, clock=lambda: now[0])
+    raw_txns = [make_tx(1), make_segwit_tx(2), make_tx(3)]
+    # parsed off a buffer that's overwritten afterwards, like the framer's
+    buf = bytearray(raw_txns[0])
+    cached = models.Tx.parse(utils.BufferReader(buf))
+    pool.add(cached)
+    buf[:] = bytes(len(buf))
+    assert cached.serialize() == raw_txns[0]
+
+    raw_block = make_block(raw_txns)
+    block = models.Block.parse(io.BytesIO(raw_block), mempool=pool)
+    assert block.txns[0] is cached
+    assert [tx.serialize() for tx in block.txns] == raw_txns
+    assert (pool.hits, pool.misses) == (1, 2)
+
+    lazy = models.Block.parse(io.BytesIO(raw_block), lazy=True, mempool=pool)
+    assert lazy.txns[0] is cached
+    assert lazy.txns[1].serialize() == raw_txns[1]
+
+    # the oldest entry goes once the entries go over the limit
+    pool.add(models.Tx.parse(io.BytesIO(raw_txns[2])))
+    pool.add(models.Tx.parse(io.BytesIO(make_tx(4))))
+    assert cached.txid() not in pool
+    assert len(pool) == 2
+
+    now[0] = 101
+    assert pool.get(models.Tx.parse(io.BytesIO(raw_txns[2])).txid()) is None
+    assert pool.expire() == 1
+    assert len(pool) == pool.total_bytes == 0
+
+
+def test_compact_block(monkeypatch):
+    import struct
+    import compact
+    from compact import PartialBlock, iter_short_ids, short_id, short_id_key
+    from merkle import merkle_root
+    from mempool import Mempool
+    from validation import check_block_payload
+
+    # SipHash-2-4 reference vectors, key 00..0f
+    k0, k1 = struct.unpack('<QQ', bytes(range(16)))
+    assert utils.siphash24(k0, k1, b'') == 0x726fdb47dd0e0e31
+    assert utils.siphash24(k0, k1, bytes(range(15))) == 0xa129ca6149be45e5
+
+    raw_txns = [make_tx(0), make_segwit_tx(1), make_tx(2), make_tx(3)]
+    txns = [models.Tx.parse(io.BytesIO(tx)) for tx in raw_txns]
+    root, _ = merkle_root(b''.join(tx.txid() for tx in txns))
+    header = bytes(36) + root + bytes(12)
+    raw_block = header + utils.encode_varint(4) + b''.join(raw_txns)
+
+    key = short_id_key(header, 7)
+    short_ids = [short_id(key, tx.wtxid()) for tx in txns[1:]]
+    cmpct = models.CmpctBlock(header, 7, short_ids, [(0, txns[0])])
+    cmpct = models.CmpctBlock.parse(io.BytesIO(cmpct.serialize()))
+    assert cmpct.short_ids == short_ids and cmpct.prefilled[0][0] == 0
+
+    pool = Mempool()
+    pool.add(models.Tx.parse(io.BytesIO(raw_txns[1])))
+    pool.add(models.Tx.parse(io.BytesIO(raw_txns[3])))
+    partial = PartialBlock(cmpct, pool)
+    assert partial.missing() == [2]
+
+    # short ids in bulk, in process or a chunk at a time in workers
+    from concurrent.futures import ProcessPoolExecutor
+    hashes = [utils.double_sha256(bytes([n])) for n in range(7)]
+    expected = [short_id(key, hash_) for hash_ in hashes]
+    assert list(iter_short_ids(key, hashes)) == expected
+    with ProcessPoolExecutor(1) as workers:
+        assert list(iter_short_ids(key, hashes, workers, chunk_size=2)) == expected
+
+    # matching stops once every short id has a txn
+    hashed = []
+
+    def counting(k0, k1, hashes):
+        for id_ in utils.siphash24_hashes(k0, k1, hashes):
+            hashed.append(id_)
+            yield id_
+    monkeypatch.setattr(compact, 'siphash24_hashes', counting)
+    fresh = Mempool()
+    for tx in txns[1:] + [models.Tx.parse(io.BytesIO(make_tx(200 + n))) for n in range(20)]:
+        fresh.add(tx)
+    assert PartialBlock(cmpct, fresh).missing() == []
+    assert len(hashed) == 3
+
+    request = models.GetBlockTxn(partial.block_hash, partial.missing())
+    assert models.GetBlockTxn.parse(io.BytesIO(request.serialize())).indexes == [2]
+    blocktxn = models.BlockTxn(partial.block_hash, [txns[2]])
+    partial.fill(models.BlockTxn.parse(io.BytesIO(blocktxn.serialize())).txns)
+    assert partial.missing() == []
+    assert partial.payload() == raw_block
+    assert check_block_payload(raw_block)
+
+
+def test_headers_announcement(monkeypatch):
+    import node
+    from chain import HeaderChain
+    from scheduler import BlockDownloadScheduler
+
+    class Sock:
+        def __init__(self):
+            self.sent = []
+
+        def sendall(self, data):
+            self.sent.append(models.Message.parse(io.BytesIO(data)))
+
+    def headers_payload(records):
+        return utils.BufferReader(utils.encode_varint(len(records) // 80) + b''.join(
+            records[i:i + 80] + b'\x00' for i in range(0, len(records), 80)))
+
+    records = mine_headers(4)
+    hashes = [utils.little_endian_to_int(utils.double_sha256(records[i:i + 80]))
+              for i in range(0, len(records), 80)]
+    # we've synced and downloaded up to the first header
+    monkeypatch.setattr(node, 'blocks', HeaderChain(hashes[0]))
+    monkeypatch.setattr(node, 'scheduler', BlockDownloadScheduler())
+    monkeypatch.setattr(node, 'scheduled_height', 1)
+    monkeypatch.setattr(node, 'header_store', None)
+    monkeypatch.setattr(node, 'awaiting_headers', False)
+    sock = Sock()
+    node.scheduler.add_peer(sock)
+
+    # a new tip is fetched straight away, as a compact block
+    node.handle_headers(headers_payload(records[80:160]), sock)
+    assert [msg.command for msg in sock.sent] == [b'getdata']
+    items = models.InventoryVector.parse(io.BytesIO(sock.sent[0].payload)).items
+    assert [(item.type, item.hash) for item in items] == [(4, utils.int_to_little_endian(hashes[1], 32))]
+    assert node.blocks.tip == hashes[1]
+
+    # one that doesn't connect makes us fill the gap with getheaders
+    sock.sent.clear()
+    node.handle_headers(headers_payload(records[240:]), sock)
+    assert [msg.command for msg in sock.sent] == [b'getheaders']
+    assert node.blocks.tip == hashes[1]
+
+    # a pushed cmpctblock is only rebuilt if its header checks out and connects
+    import pytest
+    import socket
+    monkeypatch.setattr(node, 'misbehavior', {})
+    monkeypatch.setattr(node, 'pending_compact', {})
+
+    def no_rebuild(*args):
+        raise AssertionError('rebuilt a block with a bad header')
+
+    with monkeypatch.context() as m:
+        m.setattr(node, 'PartialBlock', no_rebuild)
+        bad_pow = records[160:232] + bytes.fromhex('94380517') + bytes(4)
+        with pytest.raises(ConnectionError):
+            node.handle_cmpctblock(io.BytesIO(models.CmpctBlock(bad_pow, 1, [], []).serialize()), sock)
+        # and the sync loop hangs up on it instead of dying
+        a, b = socket.socketpair()
+        a.sendall(models.Message(b'cmpctblock', models.CmpctBlock(bad_pow, 1, [], []).serialize()).serialize())
+        node.main_loop(b)
+        assert b.fileno() == -1
+        a.close()
+        # a clock a little behind ours isn't misbehaviour
+        node.misbehavior.clear()
+        future = mine_headers(1, hashes[1], timestamp=int(time.time()) + 3 * 60 * 60)
+        node.handle_cmpctblock(io.BytesIO(models.CmpctBlock(future, 1, [], []).serialize()), sock)
+        assert sock not in node.misbehavior
+        # cut short anywhere is a protocol error rather than an IndexError
+        payload = models.CmpctBlock(records[160:240], 1, [7], []).serialize()
+        for end in (50, 89, 92, 95):
+            with pytest.raises(RuntimeError):
+                node.handle_cmpctblock(io.BytesIO(payload[:end]), sock)
+        with pytest.raises(RuntimeError):
+            models.BlockTxn.parse(io.BytesIO(bytes(32)))
+        sock.sent.clear()
+        orphan = mine_headers(1, prev_hash=12345)
+        node.handle_cmpctblock(io.BytesIO(models.CmpctBlock(orphan, 1, [], []).serialize()), sock)
+        assert [msg.command for msg in sock.sent] == [b'getheaders']
+
+    # a good one is tracked by the scheduler, so it's re-requested if it never completes
+    node.scheduler.block_received(hashes[1])
+    node.handle_cmpctblock(io.BytesIO(models.CmpctBlock(records[160:240], 1, [], []).serialize()), sock)
+    assert node.blocks.tip == hashes[2]
+    assert node.scheduler.in_flight[hashes[2]][:2] == (sock, 2)
+
+    # a short reply to our own getheaders still gets the blocks downloaded
+    records = mine_headers(603, node.genesis)
+    hashes = [utils.little_endian_to_int(utils.double_sha256(records[i:i + 80]))
+              for i in range(0, len(records), 80)]
+    monkeypatch.setattr(node, 'blocks', HeaderChain(node.genesis))
+    monkeypatch.setattr(node, 'scheduler', BlockDownloadScheduler())
+    monkeypatch.setattr(node, 'scheduled_height', 0)
+    node.blocks.connect(node.genesis, hashes[:600])
+    node.scheduler.add_peer(sock)
+    node.send_getheaders(sock)
+    sock.sent.clear()
+    node.handle_headers(headers_payload(records[600 * 80:]), sock)
+    assert len(node.blocks) == 604
+    assert [msg.command for msg in sock.sent] == [b'getdata']
+    items = models.InventoryVector.parse(io.BytesIO(sock.sent[0].payload)).items
+    assert items[0].type == 2
+
+
+def test_headers_checked_against_store(tmp_path, monkeypatch):
+    import node
+    from chain import HeaderChain
+    from header_store import HeaderStore
+    from scheduler import BlockDownloadScheduler
+    from validation import make_pool, validate_headers
+
+    class Sock:
+        def sendall(self, data):
+            pass
+
+    store = HeaderStore(tmp_path / 'headers.dat')
+    monkeypatch.setattr(node, 'blocks', HeaderChain(node.genesis))
+    monkeypatch.setattr(node, 'scheduler', BlockDownloadScheduler())
+    monkeypatch.setattr(node, 'scheduled_height', 0)
+    monkeypatch.setattr(node, 'header_store', store)
+    monkeypatch.setattr(node, 'awaiting_headers', True)
+    records = mine_headers(20, node.genesis)
+    node.handle_headers(utils.BufferReader(utils.encode_varint(20) + b''.join(
+        records[i:i + 80] + b'\x00' for i in range(0, len(records), 80))), Sock())
+    assert len(node.blocks) == 21 and len(store) == 20
+
+    # a header at or below the median of the last 11 stored ones is refused
+    tip = node.blocks.tip
+    stale = mine_headers(1, tip, timestamp=1500000000)
+    assert node.header_context(stale) == (tip, [1500000000 + 600 * i for i in range(10, 21)])
+    node.handle_headers(utils.BufferReader(utils.encode_varint(1) + stale + b'\x00'), Sock())
+    assert node.blocks.tip == tip
+    fresh = mine_headers(1, tip, timestamp=1500000000 + 600 * 20)
+    node.handle_headers(utils.BufferReader(utils.encode_varint(1) + fresh + b'\x00'), Sock())
+    assert len(node.blocks) == 22
+    store.close()
+
+    # the pool's workers aren't forked from us
+    pool = make_pool(1)
+    try:
+        assert pool._mp_context.get_start_method() != 'fork'
+        assert all(v.valid for v in validate_headers(records, node.genesis, pool=pool, chunk_size=5))
+    finally:
+        pool.shutdown()
+
+
+def test_streaming_checksum():
+    import asyncio
+    import importlib
+    import pytest
+    import socket
+    from framer import MessageFramer
+    peers = importlib.import_module('async')
+
+    payload = bytes(range(256)) * 1000
+    data = models.Message(b'block', payload).serialize()
+    # several chunks, each hashed as it's read
+    assert models.Message.parse(io.BytesIO(data)).payload == payload
+    assert models.Message.parse(utils.BufferReader(data)).payload == payload
+    corrupt = data[:-1] + b'\x00'
+    with pytest.raises(RuntimeError):
+        models.Message.parse(io.BytesIO(corrupt))
+    with pytest.raises(RuntimeError):
+        models.Message.parse(io.BytesIO(data[:-1]))
+    # too big is refused off the length field alone, and it's a disconnect
+    # whichever reader sees it
+    with pytest.raises(ConnectionError):
+        models.Message.parse(io.BytesIO(data[:24]), max_payload=1000)
+    oversized = data[:16] + (utils.MAX_PAYLOAD_SIZE + 1).to_bytes(4, 'little') + data[20:24]
+    with pytest.raises(ConnectionError):
+        models.Message.parse(io.BytesIO(oversized))
+
+    a, b = socket.socketpair()
+    a.sendall(data[:24])
+    with pytest.raises(ConnectionError):
+        MessageFramer(b, max_payload=1000).read_message()
+    a.close()
+    b.close()
+
+    async def read(chunks, **kwargs):
+        reader = asyncio.StreamReader()
+        for chunk in chunks:
+            reader.feed_data(chunk)
+        reader.feed_eof()
+        return await peers.read_message(reader, **kwargs)
+
+    chunks = [data[i:i + 10000] for i in range(0, len(data), 10000)]
+    assert asyncio.run(read(chunks)).payload == payload
+    with pytest.raises(RuntimeError):
+        asyncio.run(read([corrupt]))
+    with pytest.raises(ConnectionError):
+        asyncio.run(read(chunks, max_payload=1000))
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(read(chunks[:-1]))
+
+
+def test_capture_replay(tmp_path, monkeypatch):
+    import pytest
+    import socket
+    import capture
+    import node
+    from framer import MessageFramer
+    from mempool import Mempool
+
+    txns = [make_tx(1), make_tx(2)]
+    root = utils.double_sha256(utils.double_sha256(txns[0]) + utils.double_sha256(txns[1]))
+    block = models.Message(b'block', bytes(36) + root + bytes(12) + utils.encode_varint(2) + b''.join(txns))
+    frames = [models.Message(b'verack', b'').serialize(), block.serialize()]
+
+    path = tmp_path / 'traffic.bpwc'
+    a, b = socket.socketpair()
+    a.sendall(b''.join(frames))
+    with capture.CaptureWriter(path) as writer:
+        framer = MessageFramer(b, capture=writer)
+        framer.peer = 'peer:8333'
+        assert [framer.read_message().command for _ in frames] == [b'verack', b'block']
+    a.close()
+    b.close()
+
+    records = list(capture.read_capture(path))
+    assert [(peer, frame) for _, peer, frame in records] == [('peer:8333', frame) for frame in frames]
+    # a capture cut off mid-record still replays what's whole
+    path.write_bytes(path.read_bytes()[:-10])
+    assert len(list(capture.read_capture(path))) == 1
+
+    # peer ids past 16 bits
+    many = tmp_path / 'many.bpwc'
+    with capture.CaptureWriter(many) as writer:
+        for n in range(70000):
+            writer.write(b'', f'peer{n}')
+    records = list(capture.read_capture(many))
+    assert len(records) == 70000 and records[-1][1] == 'peer69999'
+    # and an old capture is refused by name
+    old = tmp_path / 'old.bpwc'
+    old.write_bytes(capture.FILE_HEADER.pack(capture.CAPTURE_MAGIC, 1))
+    with pytest.raises(ValueError, match='version 1'):
+        list(capture.read_capture(old))
+
+    seen = []
+    path2 = tmp_path / 'again.bpwc'
+    with capture.CaptureWriter(path2) as writer:
+        for frame in frames:
+            writer.write(frame, 'peer:8333')
+    count, total, _ = capture.replay(path2, lambda peer, frame: seen.append(frame))
+    assert (count, total, seen) == (2, sum(map(len, frames)), frames)
+
+    # and through the node's own handlers
+    monkeypatch.setattr(node, 'mempool', Mempool())
+    assert capture.replay(path2, capture.node_dispatcher())[0] == 2
+
+    # a headers batch long enough that the replay goes on to request blocks
+    from chain import HeaderChain
+    from scheduler import BlockDownloadScheduler
+    monkeypatch.setattr(node, 'blocks', HeaderChain(node.genesis))
+    monkeypatch.setattr(node, 'scheduler', BlockDownloadScheduler())
+    monkeypatch.setattr(node, 'scheduled_height', 0)
+    monkeypatch.setattr(node, 'header_store', None)
+    records = mine_headers(600, node.genesis)
+    headers = models.Message(b'headers', utils.encode_varint(600) + b''.join(
+        records[i:i + 80] + b'\x00' for i in range(0, len(records), 80)))
+    path3 = tmp_path / 'headers.bpwc'
+    with capture.CaptureWriter(path3) as writer:
+        writer.write(headers.serialize(), 'peer:8333')
+    assert capture.replay(path3, capture.node_dispatcher())[0] == 1
+    assert len(node.blocks) == 601 and node.scheduler.in_flight
+
+
+def test_metrics(monkeypatch):
+    import urllib.request
+    import node
+    from metrics import Metrics
+
+    metrics = Metrics()
+    monkeypatch.setattr(node, 'metrics', metrics)
+    node.handle_msg(models.Message(b'tx', make_tx(1)), None)
+    node.handle_msg(models.Message(b'wtf', b'xyz'), None)
+    node.handle_msg(models.Message(b'wtf2', b'xyz'), None)
+    metrics.inc('bpw_checksum_failures_total')
+    metrics.gauge('bpw_queue_depth', lambda: 7)
+    metrics.observe('bpw_handler_seconds', (('command', 'x"y'),), 20)
+
+    text = metrics.render()
+    assert 'bpw_messages_total{command="tx"} 1' in text
+    assert f'bpw_message_bytes_total{{command="tx"}} {len(make_tx(1))}' in text
+    assert f'bpw_peer_messages_total{{peer="{node.PEER_NAME}"}} 3' in text
+    assert 'bpw_checksum_failures_total 1' in text
+    assert 'bpw_queue_depth 7' in text
+    assert '# TYPE bpw_handler_seconds histogram' in text
+    assert 'bpw_handler_seconds_count{command="tx"} 1' in text
+    assert 'bpw_parse_seconds_count{command="tx"} 1' in text
+    # commands without a handler share one series and aren't timed
+    assert 'bpw_messages_total{command="other"} 2' in text and 'wtf' not in text
+    assert 'bpw_handler_seconds_count{command="other"}' not in text
+    assert 'bpw_handler_seconds_bucket{command="x\\"y",le="10"} 0' in text
+    assert 'bpw_handler_seconds_bucket{command="x\\"y",le="+Inf"} 1' in text
+
+    server = metrics.serve(0)
+    try:
+        url = f'http://127.0.0.1:{server.server_address[1]}/metrics'
+        with urllib.request.urlopen(url) as response:
+            assert 'bpw_queue_depth 7' in response.read().decode()
+    finally:
+        metrics.close()
+
+
+def test_profiler(tmp_path):
+    import asyncio
+    import pstats
+    import profiling
+
+    calls = []
+
+    def handler(payload):
+        calls.append(payload)
+        return models.Tx.parse(io.BytesIO(payload))
+
+    async def async_handler(payload):
+        return handler(payload)
+
+    profiler = profiling.Profiler(str(tmp_path), sample_every=2, memory=True)
+    for n in range(4):
+        assert profiler.call(b'tx', handler, make_tx(n)).version == 1
+    asyncio.run(profiler.call_async(b'block', async_handler, make_tx(9)))
+    assert [profiler.commands[c].sampled for c in (b'tx', b'block')] == [2, 1]
+    paths = profiler.close()
+    assert len(calls) == 5
+
+    names = sorted(os.path.basename(path).split('-')[0] + os.path.splitext(path)[1] for path in paths)
+    assert names == ['block.folded', 'block.pstats', 'block.txt', 'tx.folded', 'tx.pstats', 'tx.txt']
+    tx_pstats = next(path for path in paths if os.path.basename(path).startswith('tx') and path.endswith('.pstats'))
+    assert any(name == 'parse' for _, _, name in pstats.Stats(tx_pstats).stats)
+    folded = open(tx_pstats.replace('.pstats', '.folded')).read()
+    assert ':parse;' in folded or ':parse ' in folded
+
+    # two sampled handlers overlapping only profiles the first
+    async def slow_handler(payload):
+        await asyncio.sleep(0.01)
+        return handler(payload)
+
+    async def overlap():
+        return await asyncio.gather(*(profiler.call_async(b'tx', slow_handler, make_tx(n)) for n in range(2)))
+
+    profiler = profiling.Profiler(str(tmp_path / 'overlap'), sample_every=1)
+    assert len(asyncio.run(overlap())) == 2
+    assert profiler.commands[b'tx'].sampled == 1 and profiler.active is None
+
+    # commands are the peer's to pick, they can't name files or pile up
+    profiler = profiling.Profiler(str(tmp_path / 'junk'), sample_every=1)
+    for n in range(profiling.MAX_COMMANDS + 10):
+        profiler.call(b'../../x%d' % n, handler, make_tx(1))
+    assert len(profiler.commands) == profiling.MAX_COMMANDS
+    paths = profiler.close()
+    assert paths and all(os.path.dirname(path) == str(tmp_path / 'junk') for path in paths)
+    assert os.path.basename(paths[0]).startswith('x')
+
+    assert profiling.from_env({}) is None
+    from_env = profiling.from_env({'BPW_PROFILE': str(tmp_path), 'BPW_PROFILE_SAMPLE': '5'})
+    assert from_env.sample_every == 5 and not from_env.memory
+
+
+def test_event_sink(tmp_path):
+    import json
+    import events
+
+    class Repr:
+        formatted = 0
+
+        def __repr__(self):
+            Repr.formatted += 1
+            return 'repr'
+
+    path = tmp_path / 'events.jsonl'
+    sink = events.EventSink(events.INFO, str(path), json_lines=True, queue_size=3, flush_interval=60)
+    # below the level, so never queued or formatted
+    sink.debug('block', block=Repr())
+    sink.info('headers', count=2000)
+    sink.warning('rejected', obj=Repr())
+    assert Repr.formatted == 0 and len(sink.queue) == 2
+    sink.info('a')
+    # the queue is full, these are counted instead of waited on
+    sink.info('b')
+    sink.info('c')
+    assert sink.dropped == 2
+    sink.close()
+    assert Repr.formatted == 1
+
+    records = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [r['event'] for r in records] == ['headers', 'rejected', 'a', 'events_dropped']
+    assert records[0]['count'] == 2000 and records[0]['level'] == 'INFO'
+    assert records[1]['obj'] == 'repr' and records[-1]['count'] == 2
+
+    # text lines, written by the background thread
+    path = tmp_path / 'events.log'
+    sink = events.EventSink(events.DEBUG, str(path), flush_interval=0.01)
+    sink.debug('tx', size=250)
+    for _ in range(100):
+        if path.exists() and path.read_text():
+            break
+        time.sleep(0.01)
+    assert path.read_text().split()[1:] == ['DEBUG', 'tx', 'size=250']
+    sink.close()
+
+
+def test_addrman():
+    import random
+    import struct
+    import addrman
+
+    now = 1700000000
+    table = addrman.AddrMan(capacity=100, group_capacity=20, clock=lambda: now)
+
+    def entry(host, port=8333, age=0, services=1):
+        return struct.pack('<IQ', now - age, services) + addrman.address_key(host, port)
+
+    entries = [entry(f'8.{n // 20}.{n % 20}.1', age=7200) for n in range(40)]
+    # a duplicate, a local address, no port and one we last heard of two months ago
+    entries += [entry('8.0.0.1', services=8), entry('192.168.1.2'), entry('8.9.9.9', port=0),
+                entry('8.9.9.9', age=60 * 24 * 3600)]
+    entries.append(entry('2001:db8::1', port=18333))
+    payload = utils.encode_varint(len(entries)) + b''.join(entries)
+    assert table.add_message(utils.BufferReader(payload)) == (len(entries), 41)
+    assert len(table) == 41 and len(table.groups) == 3
+    assert ('8.0.0.1', 8333) in table and ('192.168.1.2', 8333) not in table
+    assert table.services[table.index[addrman.address_key('8.0.0.1', 8333)]] == 9
+
+    # a group can't grow past its capacity, fresher addresses replace staler ones
+    table.add_entries(struct.unpack('<IQ18s', entry(f'8.0.{n}.2')) for n in range(20))
+    group = table.groups[addrman.network_group(addrman.address_key('8.0.0.1', 8333))]
+    assert len(group) == 20 and any(table.times[slot] == now for slot in group)
+    # the table can't either
+    table.add_entries(struct.unpack('<IQ18s', entry(f'9.{n}.0.1')) for n in range(100))
+    assert len(table) == 100
+
+    # removing keeps the arrays and the buckets consistent
+    for n in range(100):
+        table.remove_slot(random.randrange(len(table)))
+        for slot in range(len(table)):
+            key = table.key(slot)
+            assert table.index[key] == slot
+            assert table.groups[addrman.network_group(key)][table.group_positions[slot]] == slot
+    assert len(table) == 0 and table.groups == {} and table.select() is None
+
+    table.add('8.8.8.8', 8333)
+    table.add('2001:db8::2', 18333)
+    assert {table.select() for _ in range(50)} == {('8.8.8.8', 8333), ('2001:db8::2', 18333)}
+    table.attempt('8.8.8.8', 8333)
+    assert table.chance(table.index[addrman.address_key('8.8.8.8', 8333)]) < 1
+    # what was just tried backs off, so a table of dead addresses doesn't spin
+    assert {table.select() for _ in range(50)} == {('2001:db8::2', 18333)}
+    table.attempt('2001:db8::2', 18333)
+    assert table.select() is None
+    now += 2 * addrman.RETRY_BACKOFF
+    assert table.select() is not None
+    table.good('8.8.8.8', 8333)
+    assert table.chance(table.index[addrman.address_key('8.8.8.8', 8333)]) == 1
+
+    too_many = utils.encode_varint(1001) + entry('8.8.8.8') * 1001
+    try:
+        addrman.read_addr(utils.BufferReader(too_many))
+        assert False
+    except RuntimeError:
+        pass
+
+
+def test_peer_writer():
+    import asyncio
+    import importlib
+    from metrics import Metrics
+    peers = importlib.import_module('async')
+
+    received = []
+
+    async def serve(reader, writer):
+        received.append(await reader.read(1024))
+        # and then never read again
+        await asyncio.sleep(5)
+
+    async def run():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        _, stream_writer = await asyncio.open_connection('127.0.0.1', port)
+        metrics = Metrics()
+        writer = peers.PeerWriter(stream_writer, high_water=64 * 1024, max_buffered=1024 * 1024, metrics=metrics)
+
+        # small messages in one tick go out together
+        writer.write(peers.VERACK)
+        writer.write(peers.GETADDR)
+        await writer.drain()
+        assert metrics.counters[('bpw_outbound_writes_total', ())] == 1
+        while not received:
+            await asyncio.sleep(0.01)
+        assert received == [peers.VERACK + peers.GETADDR]
+
+        # the peer stopped reading, so the buffer fills until we give up on it
+        chunk = bytes(64 * 1024)
+        for _ in range(200):
+            writer.write(chunk)
+            if writer.dropped:
+                break
+            await asyncio.sleep(0)
+        assert writer.dropped and writer.buffered() <= 1024 * 1024
+        assert metrics.counters[('bpw_slow_peers_dropped_total', ())] == 1
+        try:
+            await writer.drain()
+            assert False
+        except peers.SlowPeerError:
+            pass
+        writer.close()
+        server.close()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
@@ -13,9 +13,114 @@ def double_sha256(s):
     return hashlib.sha256(hashlib.sha256(s).digest()).digest()
 
 
-def read_varint(s):
+def double_sha256_spans(buf, spans):
+    '''double_sha256 of buf[start:end] for each (start, end) in `spans` joined
+    together, without building the joined bytes
+    '''
+    sha = hashlib.sha256()
+    with memoryview(buf) as view:
+        for start, end in spans:
+            sha.update(view[start:end])
+    return hashlib.sha256(sha.digest()).digest()
+
+
+def _sipround(v0, v1, v2, v3):
+    mask = 0xffffffffffffffff
+    v0 = (v0 + v1) & mask
+    v1 = ((v1 << 13) | (v1 >> 51)) & mask ^ v0
+    v0 = ((v0 << 32) | (v0 >> 32)) & mask
+    v2 = (v2 + v3) & mask
+    v3 = ((v3 << 16) | (v3 >> 48)) & mask ^ v2
+    v0 = (v0 + v3) & mask
+    v3 = ((v3 << 21) | (v3 >> 43)) & mask ^ v0
+    v2 = (v2 + v1) & mask
+    v1 = ((v1 << 17) | (v1 >> 47)) & mask ^ v2
+    v2 = ((v2 << 32) | (v2 >> 32)) & mask
+    return v0, v1, v2, v3
+
+
+def siphash24(k0, k1, data):
+    '''SipHash-2-4 of `data` under the 128-bit key (k0, k1), as a 64-bit int'''
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+    full = len(data) // 8
+    words = list(struct.unpack_from(f'<{full}Q', data))
+    # the last word is the leftover bytes with the length in its top byte
+    words.append(((len(data) & 0xff) << 56) | int.from_bytes(data[full * 8:], 'little'))
+    for m in words:
+        v3 ^= m
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+        v0 ^= m
+    v2 ^= 0xff
+    for _ in range(4):
+        v0, v1, v2, v3 = _sipround(v0, v1, v2, v3)
+    return v0 ^ v1 ^ v2 ^ v3
+
+
+def siphash24_hashes(k0, k1, hashes):
+    '''siphash24 of each of a run of 32-byte hashes, yielded one at a time.
+
+    Same result as calling siphash24 on every hash, a third faster: the key
+    setup is done once, there's no padding to work out for a fixed length,
+    and the rounds are inline instead of calls.
+    '''
+    mask = 0xffffffffffffffff
+    i0 = k0 ^ 0x736f6d6570736575
+    i1 = k1 ^ 0x646f72616e646f6d
+    i2 = k0 ^ 0x6c7967656e657261
+    i3 = k1 ^ 0x7465646279746573
+    unpack = struct.Struct('<4Q').unpack
+    # the leftover word of 32 bytes is just the length
+    last = 32 << 56
+    for hash_ in hashes:
+        v0, v1, v2, v3 = i0, i1, i2, i3
+        for m in unpack(hash_) + (last,):
+            v3 ^= m
+            for _ in range(2):
+                v0 = (v0 + v1) & mask
+                v1 = ((v1 << 13) | (v1 >> 51)) & mask ^ v0
+                v0 = ((v0 << 32) | (v0 >> 32)) & mask
+                v2 = (v2 + v3) & mask
+                v3 = ((v3 << 16) | (v3 >> 48)) & mask ^ v2
+                v0 = (v0 + v3) & mask
+                v3 = ((v3 << 21) | (v3 >> 43)) & mask ^ v0
+                v2 = (v2 + v1) & mask
+                v1 = ((v1 << 17) | (v1 >> 47)) & mask ^ v2
+                v2 = ((v2 << 32) | (v2 >> 32)) & mask
+            v0 ^= m
+        v2 ^= 0xff
+        for _ in range(4):
+            v0 = (v0 + v1) & mask
+            v1 = ((v1 << 13) | (v1 >> 51)) & mask ^ v0
+            v0 = ((v0 << 32) | (v0 >> 32)) & mask
+            v2 = (v2 + v3) & mask
+            v3 = ((v3 << 16) | (v3 >> 48)) & mask ^ v2
+            v0 = (v0 + v3) & mask
+            v3 = ((v3 << 21) | (v3 >> 43)) & mask ^ v0
+            v2 = (v2 + v1) & mask
+            v1 = ((v1 << 17) | (v1 >> 47)) & mask ^ v2
+            v2 = ((v2 << 32) | (v2 >> 32)) & mask
+        yield v0 ^ v1 ^ v2 ^ v3
+
+
+def bits_to_target(bits):
+    '''Turns the compact `bits` field of a header into the proof-of-work target'''
+    # last byte is exponent
+    exponent = bits[-1]
+    # the first three bytes are the coefficient in little endian
+    coefficient = little_endian_to_int(bits[:-1])
+    # the formula is:
+    # coefficient * 2**(8*(exponent-3))
+    return coefficient * 2**(8*(exponent-3))
+
+
+def read_varint(s, first=None):
     # https://en.bitcoin.it/wiki/Protocol_documentation#Variable_length_integer
-    i = s.read(1)[0]
+    # `first` is the first byte, for callers that already had to read it
+    i = s.read(1)[0] if first is None else first
     if i == 0xfd:
         # 0xfd means the next two bytes are the number
         return little_endian_to_int(s.read(2))
@@ -30,6 +135,28 @@ def read_varint(s):
         return i
 
 
+def read_varint_at(buf, pos):
+    '''Like read_varint, but reads from a buffer at an offset instead of a stream.
+    Returns (value, offset just past the varint)'''
+    i = buf[pos]
+    if i == 0xfd:
+        return little_endian_to_int(buf[pos + 1:pos + 3]), pos + 3
+    elif i == 0xfe:
+        return little_endian_to_int(buf[pos + 1:pos + 5]), pos + 5
+    elif i == 0xff:
+        return little_endian_to_int(buf[pos + 1:pos + 9]), pos + 9
+    else:
+        return i, pos + 1
+
+
+def skip(s, n):
+    '''Moves a stream `n` bytes forward, without reading them when it can seek'''
+    if hasattr(s, 'seek'):
+        s.seek(n, 1)
+    else:
+        s.read(n)
+
+
 def encode_varint(i):
     '''encodes an integer as a varint'''
     if i < 0xfd:
@@ -44,6 +171,28 @@ def encode_varint(i):
         raise RuntimeError('integer too large: {}'.format(i))
 
 
+def varint_size(i):
+    '''How many bytes encode_varint(i) takes'''
+    if i < 0xfd:
+        return 1
+    elif i < 0x10000:
+        return 3
+    elif i < 0x100000000:
+        return 5
+    else:
+        return 9
+
+
+def encode_varint_into(buf, offset, i):
+    '''Writes encode_varint(i) into `buf` at `offset`, returns the offset past it'''
+    if i < 0xfd:
+        buf[offset] = i
+        return offset + 1
+    encoded = encode_varint(i)
+    buf[offset:offset + len(encoded)] = encoded
+    return offset + len(encoded)
+
+
 def read_varstr(s):
     length = read_varint(s)
     string = s.read(length)
@@ -84,13 +233,64 @@ def make_nonce(bytes_of_entropy):
 
 def recvall(sock, n):
     # Helper function to recv n bytes or return None if EOF is hit
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if not count:
             return None
-        data += packet
-    return data
+        received += count
+    return bytes(data)
+
+
+# the biggest payload we'll take from a peer, Core's limit (blocks are at most
+# 4 MB). It's checked before a buffer for the payload is allocated, and a peer
+# going over it is dropped, there's no way to skip the payload and carry on
+MAX_PAYLOAD_SIZE = 4_000_000
+# payloads are read and hashed this much at a time
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+
+
+def finish_checksum(sha):
+    '''The 4-byte message checksum, from a sha256 object that was fed the whole payload'''
+    return hashlib.sha256(sha.digest()).digest()[:4]
+
+
+def read_payload(s, n, max_size=MAX_PAYLOAD_SIZE, chunk_size=PAYLOAD_CHUNK_SIZE):
+    '''Reads an `n` byte payload off a socket or stream in chunks, feeding each
+    one to sha256 as it lands, so the checksum is ready with the last byte.
+    Returns (payload, checksum).
+    '''
+    if n > max_size:
+        raise ConnectionError(f'payload of {n} bytes is over the {max_size} byte limit')
+    if n <= chunk_size:
+        # one chunk anyway, skip the bookkeeping
+        payload = consume_stream(s, n) or b''
+        if len(payload) < n:
+            raise RuntimeError(f"Tried to read {n} bytes, only received {len(payload)} bytes")
+        return payload, double_sha256(payload)[:4]
+    payload = bytearray(n)
+    sha = hashlib.sha256()
+    received = 0
+    view = memoryview(payload)
+    while received < n:
+        chunk = view[received:received + chunk_size]
+        if hasattr(s, 'recv_into'):
+            count = s.recv_into(chunk)
+        elif hasattr(s, 'readinto'):
+            count = s.readinto(chunk)
+        else:
+            data = s.read(len(chunk))
+            count = len(data)
+            chunk[:count] = data
+        if not count:
+            break
+        sha.update(chunk[:count])
+        received += count
+    if received < n:
+        raise RuntimeError(f"Tried to read {n} bytes, only received {received} bytes")
+    return payload, finish_checksum(sha)
 
 
 def consume_stream(s, n):
@@ -102,6 +302,42 @@ def consume_stream(s, n):
         raise RuntimeError("Can't consume stream")
 
 
+class BufferReader:
+    '''File-like reader over a bytes-like object that never copies the whole buffer.
+
+    `read` hands out small `bytes` like BytesIO does, while `getbuffer` returns the
+    shared memoryview so parsers can slice out raw spans without a copy.
+    '''
+
+    def __init__(self, buf, pos=0):
+        # share an existing memoryview rather than making another one on top of it
+        self.buf = buf if isinstance(buf, memoryview) else memoryview(buf)
+        self.pos = pos
+
+    def read(self, n=-1):
+        start = self.pos
+        if n is None or n < 0:
+            end = len(self.buf)
+        else:
+            end = min(start + n, len(self.buf))
+        self.pos = end
+        return self.buf[start:end].tobytes()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += len(self.buf)
+        self.pos = max(0, pos)
+        return self.pos
+
+    def getbuffer(self):
+        return self.buf
+
+
 def encode_command(cmd):
     padding_needed = 12 - len(cmd)
     padding = b"\x00" * padding_needed
@@ -0,0 +1,147 @@
+import multiprocessing
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import (
+    little_endian_to_int,
+    double_sha256,
+    bits_to_target,
+    read_varint,
+    BufferReader,
+)
+from models import Block
+from merkle import merkle_root
+
+HEADER_SIZE = 80
+# batches smaller than this are checked in-process, shipping them to the pool costs more
+CHUNK_SIZE = 250
+# a header's timestamp must be above the median of the previous 11 ...
+MEDIAN_TIME_SPAN = 11
+# ... and at most 2 hours ahead of our clock
+MAX_FUTURE_BLOCK_TIME = 2 * 60 * 60
+
+HeaderVerdict = namedtuple('HeaderVerdict', ['hash', 'valid', 'reason'])
+
+
+def read_header_records(s):
+    '''Reads the payload of a `headers` message into one buffer of 80-byte records'''
+    count = read_varint(s)
+    records = bytearray()
+    for _ in range(count):
+        records += s.read(HEADER_SIZE)
+        # txn_count, always 0 in a headers message
+        read_varint(s)
+    if len(records) != count * HEADER_SIZE:
+        raise RuntimeError('headers payload is truncated')
+    return bytes(records)
+
+
+def check_headers(records, prev_hash=None, prev_timestamps=(), now=None):
+    '''Checks a run of consecutive 80-byte header records.
+
+    `prev_hash` is the hash the first header should build on (None skips that
+    check) and `prev_timestamps` are the timestamps of the headers before it,
+    oldest first, for the median time past rule.
+    Returns a HeaderVerdict per header.
+    '''
+    if now is None:
+        now = time.time()
+    timestamps = list(prev_timestamps[-MEDIAN_TIME_SPAN:])
+    verdicts = []
+    for start in range(0, len(records), HEADER_SIZE):
+        header = records[start:start + HEADER_SIZE]
+        hash_ = little_endian_to_int(double_sha256(header))
+        prev_block = little_endian_to_int(header[4:36])
+        timestamp = little_endian_to_int(header[68:72])
+
+        if prev_hash is not None and prev_block != prev_hash:
+            reason = 'bad-prevblk'
+        elif hash_ >= bits_to_target(header[72:76]):
+            reason = 'high-hash'
+        elif len(timestamps) == MEDIAN_TIME_SPAN and timestamp <= sorted(timestamps)[MEDIAN_TIME_SPAN // 2]:
+            reason = 'time-too-old'
+        elif timestamp > now + MAX_FUTURE_BLOCK_TIME:
+            reason = 'time-too-new'
+        else:
+            reason = None
+        verdicts.append(HeaderVerdict(hash_, reason is None, reason))
+
+        prev_hash = hash_
+        timestamps.append(timestamp)
+        if len(timestamps) > MEDIAN_TIME_SPAN:
+            del timestamps[0]
+    return verdicts
+
+
+def _check_chunk(records, prev_record, prev_timestamps, now):
+    # runs in a worker, the hash the chunk builds on is recomputed here so the
+    # parent never has to hash anything
+    prev_hash = little_endian_to_int(double_sha256(prev_record))
+    return check_headers(records, prev_hash, prev_timestamps, now)
+
+
+def validate_headers(records, prev_hash=None, prev_timestamps=(), pool=None, chunk_size=CHUNK_SIZE):
+    '''Checks proof-of-work, prev-hash linkage and timestamps for a batch of
+    80-byte header records, spread across `pool` (a ProcessPoolExecutor) when
+    there's one and the batch is big enough.
+    Returns a HeaderVerdict per header, in order.
+    '''
+    now = time.time()
+    chunk_bytes = chunk_size * HEADER_SIZE
+    if pool is None or len(records) <= chunk_bytes:
+        return check_headers(records, prev_hash, prev_timestamps, now)
+
+    timestamps = [little_endian_to_int(records[start + 68:start + 72])
+                  for start in range(0, len(records), HEADER_SIZE)]
+    timestamps = list(prev_timestamps) + timestamps
+    offset = len(prev_timestamps)
+
+    futures = [pool.submit(check_headers, records[:chunk_bytes], prev_hash, prev_timestamps, now)]
+    for start in range(chunk_bytes, len(records), chunk_bytes):
+        first = offset + start // HEADER_SIZE
+        futures.append(pool.submit(
+            _check_chunk,
+            records[start:start + chunk_bytes],
+            records[start - HEADER_SIZE:start],
+            timestamps[max(0, first - MEDIAN_TIME_SPAN):first],
+            now,
+        ))
+
+    verdicts = []
+    for future in futures:
+        verdicts.extend(future.result())
+    return verdicts
+
+
+def check_merkle_root(block):
+    '''Returns whether the block's transactions hash up to its merkle_root'''
+    if not block.txn_count:
+        return False
+    root, mutated = merkle_root(block.txids())
+    return not mutated and little_endian_to_int(root) == block.merkle_root
+
+
+def check_block_payload(payload):
+    '''check_merkle_root for a raw `block` payload, a plain function so it can
+    run in a worker
+    '''
+    try:
+        return check_merkle_root(Block.parse(BufferReader(payload), lazy=True))
+    except (RuntimeError, IndexError):
+        return False
+
+
+def check_blocks(payloads, pool=None):
+    '''Runs check_block_payload over raw block payloads, on `pool` if given'''
+    if pool is None:
+        return [check_block_payload(payload) for payload in payloads]
+    return list(pool.map(check_block_payload, payloads))
+
+
+def make_pool(workers=None):
+    '''A pool for the checks above. The workers don't fork the node, with its
+    sockets, threads and mmap, they come from a fork server or are spawned
+    '''
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))